@@ -70,7 +70,7 @@ class DocumentGenerator:
 
             if wiki_images:
                 doc.add_heading("Изображения", level=3)
-                for i, imgb in enumerate(wiki_images[:3]):
+                for i, imgb in enumerate(wiki_images):
                     try:
                         imgb.seek(0)
                         doc.add_picture(imgb, width=Inches(4.0))
@@ -1,17 +1,179 @@
 # api/gemini_api.py
 import re
+import copy
 import json
+import time
 import aiohttp
 import asyncio
-from typing import Optional, List, Tuple, Dict
-
-from config.config import API_BASE, GEMINI_MODEL, GEMINI_API_KEY, MAX_OUTPUT_TOKENS, TEMPERATURE
-from utils.utils import GEMINI_SEMAPHORE, get_aiohttp_session
+from typing import Any, Awaitable, Callable, Optional, List, Tuple, Dict
+
+from config.config import (
+    API_BASE, GEMINI_MODEL, GEMINI_API_KEY, MAX_OUTPUT_TOKENS, TEMPERATURE, GEMINI_STRUCTURED_OUTPUT,
+    GEMINI_SHARD_SIZE, WIKI_IMPROVE_MAX_CHARS, WIKI_SECTION_MAX_CHARS
+)
+from utils.utils import GEMINI_LIMITER, GEMINI_BREAKER, GEMINI_RETRY, get_aiohttp_session
+from utils.retry import parse_retry_after
+from utils.limiter import OnPosition
+from api.gemini_cache import gemini_cache
+from api.wiki_cache import wiki_cache
+from api.json_stream import JSONArrayStream
+from database.storage import storage
 import logging
 
 logger = logging.getLogger("tg-edu-bot")
 
+# Меняйте при любой правке шаблонов промптов: версия входит в ключ кэша ответов.
+PROMPT_VERSION = "2"
+# То же для промптов улучшения статей Википедии (ключ кэша wiki_cache).
+WIKI_PROMPT_VERSION = "1"
+
+# Колбэк потокового режима: (вопрос, всего вопросов).
+OnQuestion = Callable[[Dict, int], Awaitable[None]]
+# Получатель расхода токенов: (функция, расход, выдано вопросов).
+Billing = Callable[[str, Dict[str, int], int], None]
+
+# Ответы, по которым ограничитель понимает, что API перегружен.
+_THROTTLE_RE = re.compile(r"^(HTTP ошибка (429|503)|Таймаут)")
+# Ответы, которые говорят о сбое самого сервиса и учитываются предохранителем.
+_OUTAGE_RE = re.compile(r"^(HTTP ошибка 5\d\d|Таймаут|Неизвестная ошибка)")
+
+_JSON_DECODER = json.JSONDecoder()
+
+# Уровни сложности, которые по очереди получают части большого теста.
+_SHARD_DIFFICULTY = ("базовый", "средний", "повышенный")
+
+# Шаблоны промптов собираются один раз при импорте; в запросе остаётся только format().
+_OPEN_PROMPT = (
+    "Ты — опытный педагог и автор образовательных тестов. Создай ровно {N} открытых вопросов, "
+    "требующих краткого ответа (1-3 предложения). Каждый вопрос должен быть уникальным по "
+    "формулировке и уровню сложности. Предмет: {SUBJECT}. Тема: {TOPIC}. Класс: {GRADE}. "
+    "Язык: {LANG}. Верни строго JSON-массив длины {N}. Каждый элемент: "
+    "{{\"question\": \"строка\", \"answer\": \"строка\"}}. "
+    "Без дополнительных комментариев, объяснений или блоков кода — только чистый JSON."
+)
+_CLOSED_PROMPT = (
+    "Ты — опытный педагог и автор образовательных тестов. Создай ровно {N} закрытых вопросов "
+    "с четырьмя вариантами ответа. Каждый вопрос должен быть уникальным по формулировке и "
+    "уровню сложности. Предмет: {SUBJECT}. Тема: {TOPIC}. Класс: {GRADE}. Язык: {LANG}. "
+    "Верни строго JSON-массив длины {N}. Каждый элемент: "
+    "{{\"question\": \"строка\", \"options\": [\"вариант1\", \"вариант2\", \"вариант3\", \"вариант4\"], "
+    "\"answer\": число от 1 до 4}}. Без дополнительных комментариев, объяснений или блоков кода — "
+    "только чистый JSON."
+)
+_MODIFY_PREFIX = {
+    "change_topic": ("Сохрани математические формулы и логику решения для каждого вопроса, но измени "
+                     "тему, контекст и формулировки, чтобы ответы остались аналогичными. "),
+    "change_variables": ("Сохрани тему, структуру и логику решения, но измени числовые значения, "
+                         "переменные и детали, чтобы ответы изменились соответственно. ")
+}
+
+# Оценка выходных токенов на один вопрос (русский текст) и запас сверх неё.
+_TOKENS_PER_QUESTION = {"open": 140, "closed": 190}
+_BUDGET_HEADROOM = 1.5
+
+# Заголовки разделов в тексте статьи Википедии: "== Раздел ==", "=== Подраздел ===".
+_WIKI_HEADING_RE = re.compile(r"^(={2,6})\s*(.+?)\s*\1\s*$", re.MULTILINE)
+# Служебные разделы в конце статьи: в plain-тексте от них остаются одни заголовки.
+_WIKI_SKIP_SECTIONS = {"примечания", "литература", "ссылки", "см. также", "источники",
+                       "notes", "references", "external links", "see also", "further reading"}
+# Грубая оценка: сколько символов русского текста приходится на один токен.
+_CHARS_PER_TOKEN = 3
+# Во сколько раз ответ может быть длиннее входа при редактуре и во сколько раз короче при пересказе.
+_IMPROVE_GROWTH = 1.3
+_SUMMARY_RATIO = 0.3
+
+_IMPROVE_PROMPT = (
+    "Ты — редактор образовательного контента. Улучши этот текст: сделай его более связным, "
+    "добавь структуру (абзацы), удали повторы, сделай язык ясным и увлекательным. "
+    "Сохрани все ключевые факты. Язык: {LANG}. Это фрагмент статьи «{TITLE}». "
+    "Не добавляй заголовок раздела. Верни улучшенный текст без дополнительных комментариев."
+)
+_SUMMARY_PROMPT = (
+    "Ты — редактор образовательного контента. Кратко перескажи этот фрагмент статьи «{TITLE}» "
+    "для школьника: оставь определения, ключевые факты, даты и формулы, убери второстепенные детали. "
+    "Язык: {LANG}. Не добавляй заголовок раздела. Верни только пересказ без дополнительных комментариев."
+)
+
+
+class _Subscriber:
+    __slots__ = ("user_id", "on_question", "on_queue", "sent", "lock")
+
+    def __init__(self, user_id, on_question: Optional[OnQuestion], on_queue: Optional[OnPosition]):
+        self.user_id = user_id
+        self.on_question = on_question
+        self.on_queue = on_queue
+        self.sent = 0
+        self.lock = asyncio.Lock()
+
+
+class _Flight:
+    """Общая генерация для одинаковых одновременных вызовов call_gemini и её подписчики.
+
+    Каждый вызов с тем же ключом подписывается на задачу: получает вопросы по
+    мере прихода (присоединившимся позже сначала досылаются уже показанные),
+    свою позицию в очереди к ИИ и долю расхода токенов. Отменённый вызов
+    отписывается, и его колбэки больше не вызываются, а сама генерация
+    продолжается для остальных.
+    """
+
+    def __init__(self, owner_id):
+        self.owner_id = owner_id
+        self.task: Optional["asyncio.Task"] = None
+        self.subscribers: List[_Subscriber] = []
+        self.streamed: List[Dict] = []
+        self.total = 0
+
+    def subscribe(self, user_id, on_question: Optional[OnQuestion],
+                  on_queue: Optional[OnPosition]) -> _Subscriber:
+        sub = _Subscriber(user_id, on_question, on_queue)
+        self.subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, sub: _Subscriber) -> None:
+        if sub in self.subscribers:
+            self.subscribers.remove(sub)
+
+    async def catch_up(self, sub: _Subscriber) -> None:
+        if sub.on_question is None:
+            return
+        async with sub.lock:
+            while sub.sent < len(self.streamed) and sub in self.subscribers:
+                item = self.streamed[sub.sent]
+                sub.sent += 1
+                try:
+                    await sub.on_question(dict(item), self.total)
+                except Exception:
+                    logger.exception("Ошибка обработчика очередного вопроса")
+
+    async def on_question(self, item: Dict, total: int) -> None:
+        self.streamed.append(dict(item))
+        self.total = total
+        await asyncio.gather(*(self.catch_up(sub) for sub in list(self.subscribers)))
+
+    async def on_queue(self, position: int) -> None:
+        for sub in list(self.subscribers):
+            if sub.on_queue is None:
+                continue
+            try:
+                await sub.on_queue(position)
+            except Exception:
+                logger.exception("Ошибка обработчика позиции в очереди")
+
+    def bill(self, feature: str, spent: Dict[str, int], questions: int) -> None:
+        """Делит расход поровну между подписчиками, дождавшимися результата."""
+        users = [sub.user_id for sub in self.subscribers] or [self.owner_id]
+        n = len(users)
+        for i, user_id in enumerate(users):
+            share = {k: v // n + (1 if i < v % n else 0) for k, v in spent.items()}
+            GeminiAPI._record_usage(user_id, feature, share, questions // n + (1 if i < questions % n else 0))
+
+
 class GeminiAPI:
+    # Незавершённые генерации по ключу кэша: одинаковые одновременные запросы ждут одну задачу.
+    _inflight: Dict[str, _Flight] = {}
+    # Сколько вопросов удалось сохранить из частично годных ответов вместо полной перегенерации.
+    generation_stats: Dict[str, float] = {"topups": 0, "salvaged": 0, "tokens_saved": 0, "seconds_saved": 0.0}
+
     @staticmethod
     def sanitize_text(text: str) -> str:
         if not text:
@@ -20,237 +182,768 @@ class GeminiAPI:
 
     @staticmethod
     def extract_json_array(text: str) -> Optional[List]:
+        """Находит в ответе модели JSON-массив, даже если вокруг него есть текст или ```-блоки.
+
+        Перебирает открывающие скобки по порядку и пробует разобрать значение с
+        этого места через raw_decode, пока не найдёт массив вопросов.
+        """
         if not text:
             return None
 
-        text = re.sub(r"```(?:json)?", "", text).strip()
-
+        text = text.strip()
         try:
             obj = json.loads(text)
             if isinstance(obj, list):
                 return obj
+            if isinstance(obj, dict):
+                # Обёртка вида {"note": [...], "questions": [...]}: берём список именно вопросов.
+                for value in obj.values():
+                    if GeminiAPI._is_question_list(value):
+                        return value
         except json.JSONDecodeError:
             pass
 
-        matches = re.findall(r'($$   \s*\{.*?\}\s*   $$)', text, re.DOTALL)
-        for match in matches:
+        pos = text.find("[")
+        while pos != -1:
             try:
-                obj = json.loads(match)
-                if isinstance(obj, list):
-                    return obj
+                obj, end = _JSON_DECODER.raw_decode(text, pos)
             except json.JSONDecodeError:
+                pos = text.find("[", pos + 1)
                 continue
-
+            if GeminiAPI._is_question_list(obj):
+                return obj
+            # Внутри разобранного значения может лежать нужный массив — ищем и там.
+            pos = text.find("[", pos + 1)
+
+        # Ответ оборван (например, по maxOutputTokens): забираем целые объекты из начала
+        # массива, недостающие вопросы дозапросит _generate. Если перед массивом была
+        # пометка в скобках вроде "[черновик]", пробуем со следующей скобки.
+        pos = text.find("[")
+        while pos != -1:
+            items = [x for x in JSONArrayStream().feed(text[pos:]) if isinstance(x, dict)]
+            if items:
+                return items
+            pos = text.find("[", pos + 1)
         return None
 
     @staticmethod
-    async def call_api(session: aiohttp.ClientSession, url: str, headers: Dict, payload: Dict, timeout: int = 120) -> Tuple[Optional[Dict], Optional[str]]:
+    def _is_question_list(obj) -> bool:
+        return (isinstance(obj, list) and bool(obj)
+                and all(isinstance(x, dict) and "question" in x for x in obj))
+
+    @staticmethod
+    def _response_schema(qtype: str) -> Dict:
+        """Схема структурированного ответа Gemini (responseSchema) для списка вопросов."""
+        if qtype == "open":
+            item = {
+                "type": "OBJECT",
+                "properties": {"question": {"type": "STRING"}, "answer": {"type": "STRING"}},
+                "required": ["question", "answer"]
+            }
+        else:
+            item = {
+                "type": "OBJECT",
+                "properties": {
+                    "question": {"type": "STRING"},
+                    "options": {"type": "ARRAY", "items": {"type": "STRING"}, "minItems": 4, "maxItems": 4},
+                    "answer": {"type": "INTEGER"}
+                },
+                "required": ["question", "options", "answer"]
+            }
+        return {"type": "ARRAY", "items": item}
+
+    @staticmethod
+    def _is_throttled(error: Optional[str]) -> bool:
+        return bool(error and _THROTTLE_RE.match(error))
+
+    @staticmethod
+    def _record_outcome(error: Optional[str]) -> None:
+        # Предохранитель считает только признаки недоступности сервиса; 429 и
+        # ошибки разбора ответа означают, что API на связи.
+        if error and _OUTAGE_RE.match(error):
+            GEMINI_BREAKER.record_failure()
+        else:
+            GEMINI_BREAKER.record_success()
+
+    @staticmethod
+    def _record_usage(user_id, feature: str, spent: Dict[str, int], questions: int) -> None:
+        """Пишет расход токенов в gemini_usage в фоне, не задерживая ответ пользователю."""
+        if not any(spent.values()) and not questions:
+            return
+        try:
+            storage.record_usage(
+                user_id if isinstance(user_id, int) else None, feature, spent["requests"],
+                spent["prompt_tokens"], spent["output_tokens"], questions, spent["latency_ms"]
+            )
+        except RuntimeError as e:
+            logger.warning("Расход токенов не записан: %s", e)
+
+    @staticmethod
+    def _breaker_error() -> str:
+        return (f"Сервис ИИ временно недоступен, повторите попытку "
+                f"через {int(GEMINI_BREAKER.retry_in()) + 1} с")
+
+    @staticmethod
+    async def call_api(session: aiohttp.ClientSession, url: str, headers: Dict, payload: Dict,
+                       timeout: int = 120) -> Tuple[Optional[Dict], Optional[str], Optional[float]]:
+        """Возвращает (данные, ошибка, пауза до повтора из Retry-After)."""
         try:
             async with session.post(url, headers=headers, json=payload, timeout=timeout) as resp:
                 if resp.status != 200:
                     text = await resp.text()
-                    return None, f"HTTP ошибка {resp.status}: {text[:400]}"
+                    retry_after = parse_retry_after(resp.headers.get("Retry-After"), text)
+                    return None, f"HTTP ошибка {resp.status}: {text[:400]}", retry_after
 
                 data = await resp.json()
-                return data, None
+                return data, None, None
 
         except asyncio.TimeoutError:
-            return None, "Таймаут запроса к API"
+            return None, "Таймаут запроса к API", None
         except Exception as e:
-            return None, f"Неизвестная ошибка: {str(e)}"
+            return None, f"Неизвестная ошибка: {str(e)}", None
 
     @staticmethod
     async def call_gemini(subject: str, topic: str, grade: str, language: str, n_questions: int,
                           qtype: str = "closed", context_examples: Optional[List] = None,
-                          modify_mode: Optional[str] = None) -> Tuple[Optional[List], Optional[str]]:
+                          modify_mode: Optional[str] = None,
+                          use_cache: bool = True,
+                          on_question: Optional[OnQuestion] = None,
+                          user_id: Optional[int] = None,
+                          on_queue: Optional[OnPosition] = None,
+                          feature: Optional[str] = None,
+                          store: bool = True) -> Tuple[Optional[List], Optional[str]]:
+        """Генерирует вопросы. Если передан on_question, ответ читается потоком и
+        колбэк вызывается для каждого проверенного вопроса сразу по его получении.
+        on_queue получает номер в очереди к ИИ, пока запрос ждёт свободного слота.
+        feature — под каким именем учитывать расход токенов. store=False вместе с
+        use_cache=False не кладёт результат в кэш: так генерирует банк вопросов,
+        чьи вопросы не должны достаться другому пользователю из кэша."""
         if not API_BASE or not GEMINI_MODEL or not GEMINI_API_KEY:
             return None, "Настройки API для ИИ не заданы"
+        feature = feature or ("modify" if modify_mode else "generate")
+
+        cache_key = gemini_cache.make_key(
+            PROMPT_VERSION, subject, topic, grade, language, n_questions, qtype,
+            context_examples, modify_mode
+        )
+        if use_cache:
+            cached = await gemini_cache.get(cache_key)
+            if cached is not None:
+                logger.info("Ответ Gemini взят из кэша")
+                return cached
+        else:
+            gemini_cache.bypassed += 1
+            return await GeminiAPI._generate_and_store(
+                cache_key, subject, topic, grade, language, n_questions, qtype, context_examples, modify_mode,
+                on_question, user_id, on_queue, feature, store=store
+            )
 
-        if qtype == "open":
-            prompt = (
-                "Ты — опытный педагог и автор образовательных тестов. Создай ровно {N} открытых вопросов, "
-                "требующих краткого ответа (1-3 предложения). Каждый вопрос должен быть уникальным по "
-                "формулировке и уровню сложности. Предмет: {SUBJECT}. Тема: {TOPIC}. Класс: {GRADE}. "
-                "Язык: {LANG}. Верни строго JSON-массив длины {N}. Каждый элемент: "
-                "{{\"question\": \"строка\", \"answer\": \"строка\"}}. "
-                "Без дополнительных комментариев, объяснений или блоков кода — только чистый JSON."
-            ).format(
-                N=n_questions,
-                SUBJECT=subject or "Предмет",
-                TOPIC=topic or "Тема",
-                GRADE=grade or "",
-                LANG=language or "Русский"
+        flight = GeminiAPI._inflight.get(cache_key)
+        if flight is None:
+            flight = _Flight(user_id)
+            sub = flight.subscribe(user_id, on_question, on_queue)
+            # Потоковый режим выбирает первый вызов: он определяет, как читать ответ API.
+            flight.task = asyncio.ensure_future(GeminiAPI._generate_and_store(
+                cache_key, subject, topic, grade, language, n_questions, qtype, context_examples, modify_mode,
+                flight.on_question if on_question is not None else None, user_id, flight.on_queue, feature,
+                billing=flight.bill
+            ))
+            GeminiAPI._inflight[cache_key] = flight
+            flight.task.add_done_callback(lambda t: GeminiAPI._forget_inflight(cache_key, flight))
+        else:
+            gemini_cache.coalesced += 1
+            logger.info("Присоединяюсь к уже идущей генерации с тем же ключом")
+            sub = flight.subscribe(user_id, on_question, on_queue)
+
+        try:
+            await flight.catch_up(sub)
+            # shield: отмена одного ожидающего не должна прерывать общий запрос к API.
+            tests, raw_text = await asyncio.shield(flight.task)
+        finally:
+            flight.unsubscribe(sub)
+        return copy.deepcopy(tests), raw_text
+
+    @staticmethod
+    def _forget_inflight(cache_key: str, flight: _Flight) -> None:
+        if GeminiAPI._inflight.get(cache_key) is flight:
+            del GeminiAPI._inflight[cache_key]
+        task = flight.task
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Ошибка общей генерации Gemini: %s", task.exception())
+
+    @staticmethod
+    async def _generate_and_store(cache_key: str, subject: str, topic: str, grade: str, language: str,
+                                  n_questions: int, qtype: str, context_examples: Optional[List],
+                                  modify_mode: Optional[str],
+                                  on_question: Optional[OnQuestion] = None, user_id: Optional[int] = None,
+                                  on_queue: Optional[OnPosition] = None,
+                                  feature: str = "generate",
+                                  billing: Optional[Billing] = None,
+                                  store: bool = True) -> Tuple[Optional[List], Optional[str]]:
+        if n_questions > GEMINI_SHARD_SIZE:
+            tests, raw_text = await GeminiAPI._generate_sharded(
+                subject, topic, grade, language, n_questions, qtype, context_examples, modify_mode,
+                on_question, user_id, on_queue, feature, billing
             )
         else:
-            prompt = (
-                "Ты — опытный педагог и автор образовательных тестов. Создай ровно {N} закрытых вопросов "
-                "с четырьмя вариантами ответа. Каждый вопрос должен быть уникальным по формулировке и "
-                "уровню сложности. Предмет: {SUBJECT}. Тема: {TOPIC}. Класс: {GRADE}. Язык: {LANG}. "
-                "Верни строго JSON-массив длины {N}. Каждый элемент: "
-                "{{\"question\": \"строка\", \"options\": [\"вариант1\", \"вариант2\", \"вариант3\", \"вариант4\"], "
-                "\"answer\": число от 1 до 4}}. Без дополнительных комментариев, объяснений или блоков кода — "
-                "только чистый JSON."
-            ).format(
-                N=n_questions,
-                SUBJECT=subject or "Предмет",
-                TOPIC=topic or "Тема",
-                GRADE=grade or "",
-                LANG=language or "Русский"
+            tests, raw_text = await GeminiAPI._generate(
+                subject, topic, grade, language, n_questions, qtype, context_examples, modify_mode,
+                on_question, user_id, on_queue, feature=feature, billing=billing
             )
+        if tests is not None and store:
+            await gemini_cache.set(cache_key, tests, raw_text)
+        return tests, raw_text
+
+    @staticmethod
+    def _shard_sizes(n_questions: int, shard_size: int) -> List[int]:
+        shards = -(-n_questions // max(1, shard_size))
+        base, extra = divmod(n_questions, shards)
+        return [base + 1 if i < extra else base for i in range(shards)]
+
+    @staticmethod
+    async def _generate_sharded(subject: str, topic: str, grade: str, language: str, n_questions: int,
+                                qtype: str, context_examples: Optional[List], modify_mode: Optional[str],
+                                on_question: Optional[OnQuestion] = None, user_id: Optional[int] = None,
+                                on_queue: Optional[OnPosition] = None,
+                                feature: str = "generate",
+                                billing: Optional[Billing] = None) -> Tuple[Optional[List], Optional[str]]:
+        """Большой тест делится на части по GEMINI_SHARD_SIZE вопросов, которые генерируются
+        параллельно с разной сложностью; время ответа определяет самая медленная часть."""
+        sizes = GeminiAPI._shard_sizes(n_questions, GEMINI_SHARD_SIZE)
+        merged: List[Dict] = []
+        seen = set()
+
+        def take(item: Dict) -> bool:
+            norm = item["question"].casefold()
+            if norm in seen or len(merged) >= n_questions:
+                return False
+            seen.add(norm)
+            merged.append(item)
+            return True
+
+        async def forward(item: Dict, _total: int) -> None:
+            # Части генерируются независимо и могут повторять друг друга: в чат уходит
+            # только то, что попадёт в итоговый тест, с его сквозным номером.
+            if not take(item):
+                return
+            item["index"] = len(merged)
+            await on_question(dict(item), n_questions)
+
+        callback = forward if on_question is not None else None
+
+        def merge(tests: Optional[List]) -> None:
+            # В потоковом режиме вопросы уже приняты в forward, здесь добавятся только пропущенные.
+            for item in tests or []:
+                take(item)
+
+        raw_parts = []
+        last_error = None
+
+        async def run_shards(shard_sizes: List[int], exclude: Optional[List[Dict]]) -> None:
+            nonlocal last_error
+            results = await asyncio.gather(*[
+                GeminiAPI._generate(
+                    subject, topic, grade, language, size, qtype, context_examples, modify_mode,
+                    callback, user_id, on_queue, exclude=exclude, feature=feature, billing=billing,
+                    hint=(f"Это часть {i + 1} из {len(shard_sizes)} большого теста. "
+                          f"Уровень сложности вопросов этой части: "
+                          f"{_SHARD_DIFFICULTY[i % len(_SHARD_DIFFICULTY)]}."),
+                    partial=True
+                )
+                for i, size in enumerate(shard_sizes)
+            ])
+            for size, (tests, text) in zip(shard_sizes, results):
+                if tests is None or len(tests) < size:
+                    # Часть не добрала вопросы: то, что она успела принять, всё равно идёт в тест.
+                    last_error = text
+                else:
+                    raw_parts.append(text)
+                merge(tests)
+
+        await run_shards(sizes, None)
+
+        missing = n_questions - len(merged)
+        if missing:
+            # Повторяем только то, чего не хватает: недобранные части и выброшенные повторы.
+            # Дозапрос тоже делится на части, чтобы не возвращаться к одному огромному промпту.
+            logger.info(f"Догенерирую {missing} из {n_questions} вопросов после параллельных частей")
+            await run_shards(GeminiAPI._shard_sizes(missing, GEMINI_SHARD_SIZE), list(merged))
+            if len(merged) < n_questions:
+                return None, last_error or (f"Неверное количество или структура вопросов: ожидалось "
+                                            f"{n_questions}, получено {len(merged)}")
+
+        for i, item in enumerate(merged, start=1):
+            item["index"] = i
+        return merged, "\n".join(raw_parts)
+
+    @staticmethod
+    def _output_budget(n_questions: int, qtype: str) -> int:
+        """maxOutputTokens по размеру ответа: n вопросов данного типа плюс запас на обёртку."""
+        per_question = _TOKENS_PER_QUESTION.get(qtype, _TOKENS_PER_QUESTION["closed"])
+        budget = int((n_questions * per_question + 64) * _BUDGET_HEADROOM)
+        return max(256, min(MAX_OUTPUT_TOKENS, budget))
+
+    @staticmethod
+    def _build_prompt(subject: str, topic: str, grade: str, language: str, n_questions: int,
+                      qtype: str, context_examples: Optional[List], modify_mode: Optional[str],
+                      accepted: Optional[List[Dict]] = None, hint: Optional[str] = None) -> str:
+        template = _OPEN_PROMPT if qtype == "open" else _CLOSED_PROMPT
+        prompt = template.format(
+            N=n_questions,
+            SUBJECT=subject or "Предмет",
+            TOPIC=topic or "Тема",
+            GRADE=grade or "",
+            LANG=language or "Русский"
+        )
 
         if context_examples:
             try:
-                ctx = json.dumps(context_examples, ensure_ascii=False, indent=2)
+                ctx = json.dumps(context_examples, ensure_ascii=False, separators=(",", ":"))
                 prompt += f"\n\nИспользуй эти примеры для вдохновения:\n{ctx}"
             except Exception as e:
                 logger.error(f"Ошибка при добавлении контекста: {e}")
 
-        if modify_mode:
-            if modify_mode == "change_topic":
-                prompt = ("Сохрани математические формулы и логику решения для каждого вопроса, но измени "
-                          "тему, контекст и формулировки, чтобы ответы остались аналогичными. ") + prompt
-            elif modify_mode == "change_variables":
-                prompt = ("Сохрани тему, структуру и логику решения, но измени числовые значения, "
-                          "переменные и детали, чтобы ответы изменились соответственно. ") + prompt
+        if hint:
+            prompt += f"\n\n{hint}"
 
-        payload = {
-            "contents": [{"parts": [{"text": prompt}]}],
-            "generationConfig": {
-                "temperature": TEMPERATURE,
-                "maxOutputTokens": MAX_OUTPUT_TOKENS
-            }
-        }
+        if accepted:
+            listed = "\n".join(f"- {item['question']}" for item in accepted)
+            prompt += f"\n\nЭти вопросы уже есть в тесте, не повторяй их и не перефразируй:\n{listed}"
+
+        if modify_mode in _MODIFY_PREFIX:
+            prompt = _MODIFY_PREFIX[modify_mode] + prompt
+        return prompt
+
+    @staticmethod
+    def _validate_item(item, qtype: str, i: int) -> Optional[Dict]:
+        """Проверяет один вопрос из ответа модели; None — вопрос отбракован."""
+        if qtype == "open":
+            try:
+                question = GeminiAPI.sanitize_text(item["question"])
+                answer = GeminiAPI.sanitize_text(item.get("answer", ""))
+            except (KeyError, TypeError, AttributeError) as e:
+                logger.warning(f"Отсутствует ключ в вопросе {i+1}: {e}")
+                return None
+            if not question or not answer:
+                logger.warning(f"Пустые поля в вопросе {i+1}")
+                return None
+            return {"question": question, "answer_text": answer}
+
+        try:
+            question = GeminiAPI.sanitize_text(item["question"])
+            options = [GeminiAPI.sanitize_text(x) for x in item["options"]]
+            answer = int(item["answer"])
+        except (KeyError, ValueError, TypeError) as e:
+            logger.warning(f"Ошибка валидации закрытого вопроса {i+1}: {e}")
+            return None
+        if len(options) != 4:
+            logger.warning(f"Неверное количество вариантов в вопросе {i+1}: {len(options)}")
+            return None
+        if answer < 1 or answer > 4:
+            logger.warning(f"Неверный индекс ответа в вопросе {i+1}: {answer}")
+            return None
+        if not question or any(not opt for opt in options):
+            logger.warning(f"Пустые поля или варианты ответа в вопросе {i+1}")
+            return None
+        return {"question": question, "options": options, "answer": answer}
+
+    @staticmethod
+    async def _call_stream(session: aiohttp.ClientSession, url: str, headers: Dict, payload: Dict,
+                           on_item: Callable[[Any], Awaitable[None]],
+                           timeout: int = 120) -> Tuple[Optional[str], Optional[Dict], Optional[str], Optional[float]]:
+        """Читает ответ streamGenerateContent (SSE) и отдаёт элементы массива по мере их закрытия."""
+        parser = JSONArrayStream()
+        parts: List[str] = []
+        usage = None
+        try:
+            async with session.post(url, headers=headers, json=payload, timeout=timeout) as resp:
+                if resp.status != 200:
+                    text = await resp.text()
+                    retry_after = parse_retry_after(resp.headers.get("Retry-After"), text)
+                    return None, None, f"HTTP ошибка {resp.status}: {text[:400]}", retry_after
+
+                async for line in resp.content:
+                    line = line.strip()
+                    if not line.startswith(b"data:"):
+                        continue
+                    try:
+                        event = json.loads(line[5:])
+                        piece = event["candidates"][0]["content"]["parts"][0].get("text", "")
+                    except (json.JSONDecodeError, KeyError, IndexError, TypeError):
+                        continue
+                    usage = event.get("usageMetadata") or usage
+                    parts.append(piece)
+                    for item in parser.feed(piece):
+                        await on_item(item)
+
+        except asyncio.TimeoutError:
+            return "".join(parts), usage, "Таймаут запроса к API", None
+        except Exception as e:
+            return "".join(parts), usage, f"Неизвестная ошибка: {str(e)}", None
+        return "".join(parts), usage, None, None
 
+    @staticmethod
+    async def _generate(subject: str, topic: str, grade: str, language: str, n_questions: int,
+                        qtype: str, context_examples: Optional[List],
+                        modify_mode: Optional[str],
+                        on_question: Optional[OnQuestion] = None, user_id: Optional[int] = None,
+                        on_queue: Optional[OnPosition] = None, exclude: Optional[List[Dict]] = None,
+                        hint: Optional[str] = None,
+                        feature: str = "generate",
+                        billing: Optional[Billing] = None,
+                        partial: bool = False) -> Tuple[Optional[List], Optional[str]]:
+        """Один запрос на n_questions вопросов с повторами и дозапросами. exclude — уже
+        готовые вопросы, которые нельзя повторять, hint — дополнительное указание в промпт,
+        billing — куда записать расход вместо user_id (общие генерации делят его между вызовами).
+        С partial при неудаче возвращаются уже принятые вопросы и текст ошибки — так
+        части большого теста не теряют то, что успели получить."""
         session = get_aiohttp_session()
         url = f"{API_BASE}/models/{GEMINI_MODEL}:generateContent"
+        stream_url = f"{API_BASE}/models/{GEMINI_MODEL}:streamGenerateContent?alt=sse"
         headers = {"Content-Type": "application/json", "x-goog-api-key": GEMINI_API_KEY}
 
+        accepted: List[Dict] = []
+        exclude = list(exclude or [])
+        seen = {item["question"].casefold() for item in exclude}
+        raw_parts: List[str] = []
         last_error = None
+        retry_after = None
+        progressed = True
+
+        async def accept(item, i: int) -> bool:
+            if len(accepted) >= n_questions:
+                return False
+            valid = GeminiAPI._validate_item(item, qtype, i)
+            if valid is None:
+                return False
+            norm = valid["question"].casefold()
+            if norm in seen:
+                logger.warning(f"Повтор вопроса {i+1} отброшен")
+                return False
+            seen.add(norm)
+            valid["index"] = len(accepted) + 1
+            accepted.append(valid)
+            if on_question is not None:
+                try:
+                    await on_question(dict(valid), n_questions)
+                except Exception:
+                    logger.exception("Ошибка обработчика очередного вопроса")
+            return True
 
-        async with GEMINI_SEMAPHORE:
-            for attempt in range(1, 4):
-                data, error = await GeminiAPI.call_api(session, url, headers, payload)
+        spent = {"requests": 0, "prompt_tokens": 0, "output_tokens": 0, "latency_ms": 0}
+        delivered = 0
 
-                if error:
-                    last_error = error
-                    wait_time = 1.5 * attempt
-                    logger.warning(f"Попытка {attempt} не удалась: {error}. Жду {wait_time} сек.")
+        def failed(error: Optional[str]) -> Tuple[Optional[List], Optional[str]]:
+            nonlocal delivered
+            if partial and accepted:
+                delivered = len(accepted)
+                return accepted, error
+            return None, error
+
+        try:
+            for attempt in range(1, GEMINI_RETRY.attempts + 1):
+                if not progressed:
+                    # Пауза вне слота ограничителя: ожидающий повтора запрос не занимает место других.
+                    wait_time = GEMINI_RETRY.delay(attempt - 1, retry_after)
+                    logger.warning(f"Попытка {attempt - 1} не удалась: {last_error}. Жду {wait_time:.1f} сек.")
                     await asyncio.sleep(wait_time)
+                if not GEMINI_BREAKER.allow():
+                    return failed(GeminiAPI._breaker_error())
+
+                need = n_questions - len(accepted)
+                prompt = GeminiAPI._build_prompt(
+                    subject, topic, grade, language, need, qtype, context_examples, modify_mode,
+                    exclude + accepted, hint
+                )
+                payload = {
+                    "contents": [{"parts": [{"text": prompt}]}],
+                    "generationConfig": {
+                        "temperature": TEMPERATURE,
+                        "maxOutputTokens": GeminiAPI._output_budget(need, qtype)
+                    }
+                }
+                if GEMINI_STRUCTURED_OUTPUT:
+                    payload["generationConfig"]["responseMimeType"] = "application/json"
+                    payload["generationConfig"]["responseSchema"] = GeminiAPI._response_schema(qtype)
+                if accepted:
+                    GeminiAPI.generation_stats["topups"] += 1
+                    logger.info(f"Дозапрашиваю {need} из {n_questions} вопросов")
+
+                before = len(accepted)
+                received = 0
+
+                async def on_item(item):
+                    nonlocal received
+                    received += 1
+                    await accept(item, received - 1)
+
+                async with GEMINI_LIMITER.slot(user_id, on_queue):
+                    started = time.monotonic()
+                    if on_question is not None:
+                        # Потоковый режим: вопросы уходят в чат по мере закрытия объектов в ответе.
+                        raw_text, usage, error, retry_after = await GeminiAPI._call_stream(
+                            session, stream_url, headers, payload, on_item
+                        )
+                    else:
+                        data, error, retry_after = await GeminiAPI.call_api(session, url, headers, payload)
+                    elapsed = time.monotonic() - started
+                    GEMINI_LIMITER.record(elapsed, GeminiAPI._is_throttled(error))
+                GeminiAPI._record_outcome(error)
+                if on_question is None:
+                    usage = (data or {}).get("usageMetadata")
+                spent["requests"] += 1
+                spent["latency_ms"] += int(elapsed * 1000)
+                spent["prompt_tokens"] += (usage or {}).get("promptTokenCount") or 0
+                spent["output_tokens"] += (usage or {}).get("candidatesTokenCount") or 0
+
+                if on_question is not None:
+                    parsed_count = received
+                    if raw_text:
+                        raw_parts.append(raw_text)
+                    if error and len(accepted) == before:
+                        last_error = error
+                        progressed = False
+                        continue
+                    if received == 0 and not error:
+                        # Поток не распознал массив — разбираем весь ответ так же, как без потока.
+                        parsed = GeminiAPI.extract_json_array(raw_text)
+                        if parsed is None:
+                            last_error = f"Не удалось извлечь JSON: {(raw_text or '')[:400]}"
+                            progressed = False
+                            continue
+                        parsed_count = len(parsed)
+                        for i, item in enumerate(parsed):
+                            await accept(item, i)
+                else:
+                    if error:
+                        last_error = error
+                        progressed = False
+                        continue
+
+                    try:
+                        raw_text = data["candidates"][0]["content"]["parts"][0]["text"]
+                    except (KeyError, IndexError, TypeError):
+                        last_error = "Неверный формат ответа от API"
+                        progressed = False
+                        continue
+
+                    parsed = GeminiAPI.extract_json_array(raw_text)
+                    if parsed is None:
+                        last_error = f"Не удалось извлечь JSON: {raw_text[:400]}"
+                        progressed = False
+                        continue
+                    raw_parts.append(raw_text)
+                    parsed_count = len(parsed)
+                    for i, item in enumerate(parsed):
+                        await accept(item, i)
+
+                fresh = len(accepted) - before
+                progressed = fresh > 0
+                if len(accepted) < n_questions:
+                    last_error = (f"Неверное количество или структура вопросов: ожидалось {n_questions}, "
+                                  f"получено {len(accepted)}")
+                    if fresh:
+                        # Без дозапроса эти вопросы пришлось бы сгенерировать заново.
+                        share = fresh / max(parsed_count, 1)
+                        tokens = (usage or {}).get("candidatesTokenCount") or 0
+                        GeminiAPI.generation_stats["salvaged"] += fresh
+                        GeminiAPI.generation_stats["tokens_saved"] += int(tokens * share)
+                        GeminiAPI.generation_stats["seconds_saved"] += elapsed * share
                     continue
 
-                try:
-                    raw_text = data["candidates"][0]["content"]["parts"][0]["text"]
-                except (KeyError, IndexError, TypeError):
-                    last_error = "Неверный формат ответа от API"
-                    continue
+                delivered = len(accepted)
+                return accepted, "\n".join(raw_parts)
 
-                parsed = GeminiAPI.extract_json_array(raw_text)
-                if parsed is None:
-                    last_error = f"Не удалось извлечь JSON: {raw_text[:400]}"
-                    continue
+            return failed(last_error)
+        finally:
+            if billing is not None:
+                billing(feature, spent, delivered)
+            else:
+                GeminiAPI._record_usage(user_id, feature, spent, delivered)
 
-                validated = []
-                validation_error = False
+    @staticmethod
+    def _split_sections(text: str) -> List[Tuple[str, str]]:
+        """Делит текст статьи на (заголовок, текст) по заголовкам второго уровня.
+
+        Подразделы остаются внутри своего раздела (их заголовки становятся
+        отдельными абзацами), служебные разделы вроде «Примечания» отбрасываются.
+        Преамбула статьи идёт первой с пустым заголовком.
+        """
+        sections: List[Tuple[str, str]] = []
+        title, parts, pos = "", [], 0
+        for match in _WIKI_HEADING_RE.finditer(text):
+            parts.append(text[pos:match.start()])
+            pos = match.end()
+            if len(match.group(1)) > 2:
+                parts.append("\n\n" + match.group(2) + "\n\n")
+                continue
+            sections.append((title, "".join(parts)))
+            title, parts = match.group(2), []
+        parts.append(text[pos:])
+        sections.append((title, "".join(parts)))
+        return [
+            (title, body.strip()) for title, body in sections
+            if body.strip() and title.strip().lower() not in _WIKI_SKIP_SECTIONS
+        ]
 
-                if qtype == "open":
-                    for i, item in enumerate(parsed):
-                        try:
-                            question = GeminiAPI.sanitize_text(item["question"])
-                            answer = GeminiAPI.sanitize_text(item.get("answer", ""))
-
-                            if not question or not answer:
-                                logger.warning(f"Пустые поля в вопросе {i+1}")
-                                validation_error = True
-                                break
-
-                            validated.append({
-                                "question": question,
-                                "answer_text": answer,
-                                "index": i + 1
-                            })
-
-                        except KeyError as e:
-                            logger.warning(f"Отсутствует ключ в вопросе {i+1}: {e}")
-                            validation_error = True
-                            break
-                        except Exception as e:
-                            logger.error(f"Ошибка валидации открытого вопроса {i+1}: {e}")
-                            validation_error = True
-                            break
-                else:
-                    for i, item in enumerate(parsed):
-                        try:
-                            question = GeminiAPI.sanitize_text(item["question"])
-                            options = [GeminiAPI.sanitize_text(x) for x in item["options"]]
-                            answer = int(item["answer"])
-
-                            if len(options) != 4:
-                                logger.warning(f"Неверное количество вариантов в вопросе {i+1}: {len(options)}")
-                                validation_error = True
-                                break
-
-                            if answer < 1 or answer > 4:
-                                logger.warning(f"Неверный индекс ответа в вопросе {i+1}: {answer}")
-                                validation_error = True
-                                break
-
-                            if any(not opt for opt in options):
-                                logger.warning(f"Пустые варианты ответа в вопросе {i+1}")
-                                validation_error = True
-                                break
-
-                            validated.append({
-                                "question": question,
-                                "options": options,
-                                "answer": answer,
-                                "index": i + 1
-                            })
-
-                        except (KeyError, ValueError, TypeError) as e:
-                            logger.warning(f"Ошибка валидации закрытого вопроса {i+1}: {e}")
-                            validation_error = True
-                            break
-                        except Exception as e:
-                            logger.error(f"Неизвестная ошибка валидации вопроса {i+1}: {e}")
-                            validation_error = True
-                            break
-
-                if validation_error or len(validated) != n_questions:
-                    last_error = f"Неверное количество или структура вопросов: ожидалось {n_questions}, получено {len(validated)}"
-                    continue
+    @staticmethod
+    def _split_long(body: str, limit: int) -> List[str]:
+        """Режет слишком длинный раздел по границам абзацев на куски не больше limit символов."""
+        pieces, current = [], ""
+        for para in re.split(r"\n\s*\n", body):
+            para = para.strip()
+            if not para:
+                continue
+            while len(para) > limit:
+                # Абзац длиннее лимита — режем по последнему концу предложения.
+                cut = para.rfind(". ", 0, limit)
+                cut = cut + 1 if cut > 0 else limit
+                if current:
+                    pieces.append(current)
+                    current = ""
+                pieces.append(para[:cut].strip())
+                para = para[cut:].strip()
+            if current and len(current) + len(para) + 2 > limit:
+                pieces.append(current)
+                current = ""
+            current = f"{current}\n\n{para}" if current else para
+        if current:
+            pieces.append(current)
+        return pieces
 
-                return validated, raw_text
+    @staticmethod
+    def _wiki_chunks(text: str, section_limit: int = WIKI_SECTION_MAX_CHARS) -> List[Tuple[str, str]]:
+        """Куски статьи для параллельной обработки: разделы по заголовкам, длинные — по абзацам.
+
+        Заголовок раздела остаётся только у первого куска, чтобы при сборке он
+        встретился в тексте один раз.
+        """
+        chunks = []
+        for title, body in GeminiAPI._split_sections(text):
+            for i, piece in enumerate(GeminiAPI._split_long(body, section_limit)):
+                chunks.append((title if i == 0 else "", piece))
+        return chunks
+
+    @staticmethod
+    def _text_budget(chars: int, summary: bool) -> int:
+        """maxOutputTokens для фрагмента текста: по его длине, с запасом на рост или сжатие."""
+        ratio = _SUMMARY_RATIO if summary else _IMPROVE_GROWTH
+        return max(256, min(MAX_OUTPUT_TOKENS, int(chars / _CHARS_PER_TOKEN * ratio) + 128))
 
-        return None, last_error
+    @staticmethod
+    async def call_gemini_for_text_improvement(text: str, language: str = "Русский",
+                                               user_id: Optional[int] = None,
+                                               on_queue: Optional[OnPosition] = None,
+                                               title: str = "", revision: Optional[int] = None) -> str:
+        """Улучшает статью по разделам: разделы обрабатываются параллельно и собираются по порядку.
+
+        Если статья длиннее WIKI_IMPROVE_MAX_CHARS, включается режим пересказа:
+        преамбула редактируется целиком, а остальные разделы кратко пересказываются,
+        чтобы ответ не упирался в лимит токенов. Раздел, который не удалось
+        обработать, попадает в результат в исходном виде.
+
+        С заданными title и revision результат кэшируется: пока статью не правили,
+        повторный запрос обходится без обращения к ИИ.
+        """
+        chunks = GeminiAPI._wiki_chunks(text)
+        if not chunks:
+            return text
+        summary = len(text) > WIKI_IMPROVE_MAX_CHARS
+
+        cache_key = None
+        if title and revision:
+            cache_key = wiki_cache.make_key(WIKI_PROMPT_VERSION + ("s" if summary else ""),
+                                            language, title, revision)
+            cached = await wiki_cache.get(cache_key)
+            if cached is not None:
+                logger.info("Статья '%s' (ревизия %s) взята из кэша", title, revision)
+                return cached
+
+        if summary:
+            logger.info("Статья '%s' длиннее %s символов (%s): режим пересказа, разделов: %s",
+                        title, WIKI_IMPROVE_MAX_CHARS, len(text), len(chunks))
+
+        started = time.monotonic()
+        # Позицию в очереди показываем только по первому куску: остальные встанут сразу за ним.
+        results = await asyncio.gather(*(
+            GeminiAPI._improve_chunk(body, language, title, summary and (i > 0 or bool(heading)),
+                                     user_id, on_queue if i == 0 else None)
+            for i, (heading, body) in enumerate(chunks)
+        ))
+        logger.info("Статья '%s' обработана по %s фрагментам за %.1f с",
+                    title, len(chunks), time.monotonic() - started)
+
+        parts = []
+        for (heading, _), (improved, _) in zip(chunks, results):
+            if heading:
+                parts.append(heading)
+            parts.append(improved)
+        improved_text = "\n\n".join(parts)
+        # Статью с необработанными разделами не кэшируем: в следующий раз попробуем снова.
+        if cache_key and all(ok for _, ok in results):
+            await wiki_cache.set(cache_key, improved_text)
+        return improved_text
 
     @staticmethod
-    async def call_gemini_for_text_improvement(text: str, language: str = "Русский") -> str:
-        prompt = (
-            "Ты — редактор образовательного контента. Улучши этот текст: сделай его более связным, "
-            "добавь структуру (заголовки, абзацы), удали повторы, сделай язык ясным и увлекательным. "
-            "Сохрани все ключевые факты. Язык: {LANG}. Верни улучшенный текст без дополнительных комментариев."
-        ).format(LANG=language)
+    async def _improve_chunk(text: str, language: str, title: str, summary: bool,
+                             user_id: Optional[int] = None,
+                             on_queue: Optional[OnPosition] = None) -> Tuple[str, bool]:
+        prompt = (_SUMMARY_PROMPT if summary else _IMPROVE_PROMPT).format(LANG=language, TITLE=title or "—")
 
         payload = {
             "contents": [{"parts": [{"text": prompt + "\n\nОригинальный текст:\n" + text}]}],
-            "generationConfig": {"temperature": 0.1, "maxOutputTokens": MAX_OUTPUT_TOKENS}
+            "generationConfig": {"temperature": 0.1,
+                                 "maxOutputTokens": GeminiAPI._text_budget(len(text), summary)}
         }
 
         session = get_aiohttp_session()
         url = f"{API_BASE}/models/{GEMINI_MODEL}:generateContent"
         headers = {"Content-Type": "application/json", "x-goog-api-key": GEMINI_API_KEY}
 
-        async with GEMINI_SEMAPHORE:
+        if not GEMINI_BREAKER.allow():
+            logger.warning("Улучшение текста пропущено: %s", GeminiAPI._breaker_error())
+            return text, False
+
+        async with GEMINI_LIMITER.slot(user_id, on_queue):
+            started = time.monotonic()
+            answered = False
             try:
                 async with session.post(url, headers=headers, json=payload, timeout=120) as resp:
                     if resp.status != 200:
                         logger.warning(f"Ошибка API при улучшении текста: {resp.status}")
-                        return text
+                        GEMINI_LIMITER.record(time.monotonic() - started, resp.status in (429, 503))
+                        GeminiAPI._record_outcome(f"HTTP ошибка {resp.status}")
+                        return text, False
 
                     data = await resp.json()
-                    improved_text = data["candidates"][0]["content"]["parts"][0]["text"].strip()
-                    return improved_text
-
+                    elapsed = time.monotonic() - started
+                    GEMINI_LIMITER.record(elapsed)
+                    GeminiAPI._record_outcome(None)
+                    answered = True
+                    usage = data.get("usageMetadata") or {}
+                    GeminiAPI._record_usage(user_id, "wiki", {
+                        "requests": 1,
+                        "prompt_tokens": usage.get("promptTokenCount") or 0,
+                        "output_tokens": usage.get("candidatesTokenCount") or 0,
+                        "latency_ms": int(elapsed * 1000)
+                    }, 0)
+                    candidate = data["candidates"][0]
+                    if candidate.get("finishReason") == "MAX_TOKENS":
+                        # Обрезанный ответ потерял бы конец раздела — лучше оставить исходный текст.
+                        logger.warning("Улучшение фрагмента обрезано по лимиту токенов, оставлен исходный текст")
+                        return text, False
+                    improved_text = candidate["content"]["parts"][0]["text"].strip()
+                    return (improved_text, True) if improved_text else (text, False)
+
+            except asyncio.TimeoutError:
+                logger.error("Таймаут улучшения текста")
+                GEMINI_LIMITER.record(time.monotonic() - started, True)
+                GeminiAPI._record_outcome("Таймаут")
+                return text, False
             except Exception as e:
                 logger.error(f"Ошибка улучшения текста: {e}")
-                return text
\ No newline at end of file
+                if not answered:
+                    # Сбой соединения или чтения ответа — такой же сигнал перегрузки, как таймаут.
+                    GEMINI_LIMITER.record(time.monotonic() - started, True)
+                    GeminiAPI._record_outcome(f"Неизвестная ошибка: {e}")
+                return text, False
@@ -0,0 +1,75 @@
+# api/gemini_cache.py
+import copy
+import json
+import time
+import hashlib
+from typing import Any, Dict, List, Optional, Tuple
+
+import db
+from database.storage import storage
+from config.config import GEMINI_CACHE_SIZE, GEMINI_CACHE_TTL
+from utils.cache import TieredCache, normalize
+
+
+class GeminiCache(TieredCache):
+    """Кэш ответов call_gemini: LRU с TTL в памяти поверх таблицы gemini_cache в SQLite."""
+
+    def __init__(self, maxsize: int = GEMINI_CACHE_SIZE, ttl: float = GEMINI_CACHE_TTL):
+        super().__init__(storage.run, "Gemini", maxsize=maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.bypassed = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(prompt_version: str, subject: str, topic: str, grade: str, language: str,
+                 n_questions: int, qtype: str, context_examples: Optional[List] = None,
+                 modify_mode: Optional[str] = None) -> str:
+        parts = {
+            "v": prompt_version,
+            "subject": normalize(subject),
+            "topic": normalize(topic),
+            "grade": normalize(grade),
+            "language": normalize(language),
+            "n": int(n_questions),
+            "qtype": qtype,
+            "ctx": context_examples or [],
+            "mode": modify_mode or ""
+        }
+        raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _disk_get(self, key: str) -> Optional[Dict]:
+        row = db.get_connection().execute(
+            "SELECT payload, created_at FROM gemini_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if time.time() - row["created_at"] > self.ttl:
+            return None
+        return db.unpack_payload(row["payload"])
+
+    def _disk_set(self, key: str, value: Dict) -> None:
+        conn = db.get_connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO gemini_cache (key, payload, created_at) VALUES (?, ?, ?)",
+                (key, db.pack_payload(value), time.time())
+            )
+            self._writes += 1
+            if self._writes % 100 == 0:
+                conn.execute("DELETE FROM gemini_cache WHERE created_at < ?", (time.time() - self.ttl,))
+
+    async def get(self, key: str) -> Optional[Tuple[List, str]]:
+        value = await super().get(key)
+        if value is None:
+            return None
+        return copy.deepcopy(value["tests"]), value["raw"]
+
+    async def set(self, key: str, tests: List, raw: str) -> None:
+        await super().set(key, {"tests": copy.deepcopy(tests), "raw": raw})
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "bypassed": self.bypassed, "coalesced": self.coalesced}
+
+
+gemini_cache = GeminiCache()
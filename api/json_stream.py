@@ -0,0 +1,85 @@
+# api/json_stream.py
+import json
+import logging
+from typing import Any, List
+
+logger = logging.getLogger("tg-edu-bot")
+
+
+class JSONArrayStream:
+    """Инкрементальный разбор JSON-массива объектов, приходящего кусками.
+
+    feed() принимает очередной фрагмент текста и возвращает объекты верхнего
+    уровня массива, которые успели закрыться. Обёртки вида ```json и текст
+    до массива пропускаются; массивом считается только скобка [, за которой
+    (после пробелов) идёт {, поэтому пометки вроде "[Черновик]" не мешают.
+    """
+
+    def __init__(self):
+        self._buf = ""
+        self._pos = 0
+        self._in_array = False
+        self._opening = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._start = -1
+        self.done = False
+
+    def feed(self, chunk: str) -> List[Any]:
+        if self.done or not chunk:
+            return []
+        self._buf += chunk
+        items = []
+        buf = self._buf
+        i = self._pos
+        n = len(buf)
+        while i < n:
+            ch = buf[i]
+            if not self._in_array:
+                if self._opening and not ch.isspace():
+                    self._opening = False
+                    if ch == "{":
+                        self._in_array = True
+                    # Этот символ разбираем заново: либо как начало объекта, либо как обычный текст.
+                    continue
+                if ch == "[":
+                    self._opening = True
+                i += 1
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                if self._depth == 0:
+                    self._start = i
+                self._depth += 1
+            elif ch in "}]":
+                if self._depth == 0:
+                    if ch == "]":
+                        self.done = True
+                        break
+                else:
+                    self._depth -= 1
+                    if self._depth == 0:
+                        raw = buf[self._start:i + 1]
+                        try:
+                            items.append(json.loads(raw))
+                        except json.JSONDecodeError as e:
+                            logger.warning("Не удалось разобрать элемент потока: %s", e)
+                        self._start = -1
+            i += 1
+
+        # Уже разобранный префикс больше не нужен.
+        cut = self._start if self._start >= 0 else i
+        self._buf = buf[cut:]
+        self._pos = i - cut
+        if self._start >= 0:
+            self._start = 0
+        return items
@@ -0,0 +1,52 @@
+# api/wiki_cache.py
+import time
+from typing import Any, Dict, Optional
+
+import db
+from database.storage import storage
+from config.config import WIKI_CACHE_SIZE, WIKI_CACHE_DISK_SIZE
+from utils.cache import TieredCache, normalize
+
+
+class WikiCache(TieredCache):
+    """Кэш улучшенных статей Википедии: LRU в памяти поверх таблицы wiki_cache в SQLite.
+
+    Ключ включает номер ревизии, поэтому записи не устаревают по времени: правка
+    статьи даёт новый ключ, а старая запись со временем вытесняется по LRU.
+    """
+
+    def __init__(self, maxsize: int = WIKI_CACHE_SIZE, disk_maxsize: int = WIKI_CACHE_DISK_SIZE):
+        super().__init__(storage.run, "статей Википедии", maxsize=maxsize)
+        self.disk_maxsize = disk_maxsize
+
+    @staticmethod
+    def make_key(prompt_version: str, lang: str, title: str, revision: Any) -> str:
+        return "|".join((prompt_version, normalize(lang), normalize(title), str(revision)))
+
+    def _disk_get(self, key: str) -> Optional[str]:
+        conn = db.get_connection()
+        with conn:
+            row = conn.execute("SELECT payload FROM wiki_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE wiki_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+        return db.unpack_payload(row["payload"])
+
+    def _disk_set(self, key: str, text: str) -> None:
+        now = time.time()
+        conn = db.get_connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO wiki_cache (key, payload, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, db.pack_payload(text), now, now)
+            )
+            self._writes += 1
+            if self._writes % 50 == 0:
+                conn.execute("""
+                    DELETE FROM wiki_cache WHERE key NOT IN (
+                        SELECT key FROM wiki_cache ORDER BY last_access DESC LIMIT ?
+                    )
+                """, (self.disk_maxsize,))
+
+
+wiki_cache = WikiCache()
@@ -0,0 +1,114 @@
+"""Микробенчмарк db.py: операций в секунду до и после пула соединений и UPSERT.
+
+«До» — функции из исходной версии db.py (новое соединение на каждый вызов,
+SELECT, затем UPDATE или INSERT), «после» — текущий db.py. Обе версии работают
+с отдельными временными базами.
+
+    python benchmarks/bench_db.py [--ops 3000]
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import tempfile
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+_tmp = tempfile.mkdtemp(prefix="bench_db_")
+os.environ["DB_PATH"] = os.path.join(_tmp, "pooled.sqlite3")
+
+import db  # noqa: E402
+
+LEGACY_PATH = os.path.join(_tmp, "legacy.sqlite3")
+
+
+def legacy_connection():
+    conn = sqlite3.connect(LEGACY_PATH, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                           check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys = ON;")
+    return conn
+
+
+def legacy_init():
+    conn = legacy_connection()
+    conn.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, username TEXT, phone TEXT, "
+                 "accepted INTEGER DEFAULT 0, created_at TEXT, updated_at TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS tests (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, "
+                 "meta TEXT, tests TEXT, created_at TEXT)")
+    conn.commit()
+    conn.close()
+
+
+def legacy_add_or_update_user(user_id, username, phone, accepted=False):
+    now = datetime.utcnow().isoformat()
+    conn = legacy_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM users WHERE id = ?", (user_id,))
+    if cur.fetchone():
+        cur.execute("UPDATE users SET username = ?, phone = ?, accepted = ?, updated_at = ? WHERE id = ?",
+                    (username, phone, int(bool(accepted)), now, user_id))
+    else:
+        cur.execute("INSERT INTO users (id, username, phone, accepted, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (user_id, username, phone, int(bool(accepted)), now))
+    conn.commit()
+    conn.close()
+
+
+def legacy_get_user(user_id):
+    conn = legacy_connection()
+    row = conn.execute("SELECT id, username, phone, accepted, created_at, updated_at FROM users WHERE id = ?",
+                       (user_id,)).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def legacy_save_test(user_id, meta, tests):
+    conn = legacy_connection()
+    cur = conn.execute("INSERT INTO tests (user_id, meta, tests, created_at) VALUES (?, ?, ?, ?)",
+                       (user_id, json.dumps(meta, ensure_ascii=False), json.dumps(tests, ensure_ascii=False),
+                        datetime.utcnow().isoformat()))
+    conn.commit()
+    conn.close()
+    return cur.lastrowid
+
+
+def measure(func, ops: int) -> float:
+    started = time.perf_counter()
+    for i in range(ops):
+        func(i)
+    return ops / (time.perf_counter() - started)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ops", type=int, default=3000)
+    ops = parser.parse_args().ops
+
+    legacy_init()
+    db.init_db()
+    meta = {"subject": "Математика", "topic": "Дроби", "grade": "5", "language": "Русский", "qtype": "closed"}
+    tests = [{"index": i, "question": f"Вопрос {i}", "options": ["1", "2", "3", "4"], "answer": 1}
+             for i in range(1, 11)]
+
+    cases = [
+        ("add_or_update_user",
+         lambda i: legacy_add_or_update_user(i % 500, f"user{i}", "+7000", i % 2 == 0),
+         lambda i: db.add_or_update_user(i % 500, f"user{i}", "+7000", i % 2 == 0)),
+        ("get_user", lambda i: legacy_get_user(i % 500), lambda i: db.get_user(i % 500)),
+        ("save_test", lambda i: legacy_save_test(i % 500, meta, tests), lambda i: db.save_test(i % 500, meta, tests)),
+    ]
+    print(f"{ops} операций на случай, база во временном каталоге {_tmp}")
+    print(f"{'операция':<20} {'до, оп/с':>10} {'после, оп/с':>12} {'ускорение':>10}")
+    for name, before, after in cases:
+        old = measure(before, ops)
+        new = measure(after, ops)
+        print(f"{name:<20} {old:>10.0f} {new:>12.0f} {new / old:>9.1f}x")
+    db.close_connections()
+
+
+if __name__ == "__main__":
+    main()
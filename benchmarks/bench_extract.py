@@ -0,0 +1,77 @@
+"""Бенчмарк извлечения JSON-массива из ответов Gemini на корпусе записанных ответов.
+
+Для каждого извлекателя печатает долю ответов, из которых получено ожидаемое
+число вопросов (каждая неудача — лишний платный перезапрос), и среднее время
+разбора одного ответа. Прежний извлекатель на регулярных выражениях
+воспроизведён здесь для сравнения.
+
+    python benchmarks/bench_extract.py [--rounds 200]
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("TELEGRAM_API_TOKEN", "123456:bench")
+os.chdir(tempfile.mkdtemp(prefix="bench_extract_"))
+
+from api.gemini_api import GeminiAPI  # noqa: E402
+
+CORPUS = os.path.join(ROOT, "tests", "data", "gemini_responses.jsonl")
+
+
+def legacy_extract(text):
+    if not text:
+        return None
+    text = re.sub(r"```(?:json)?", "", text).strip()
+    try:
+        obj = json.loads(text)
+        if isinstance(obj, list):
+            return obj
+    except json.JSONDecodeError:
+        pass
+    for match in re.findall(r'($$   \s*\{.*?\}\s*   $$)', text, re.DOTALL):
+        try:
+            obj = json.loads(match)
+            if isinstance(obj, list):
+                return obj
+        except json.JSONDecodeError:
+            continue
+    return None
+
+
+def run(extract, corpus, rounds: int):
+    ok = 0
+    for case in corpus:
+        items = extract(case["text"])
+        got = len(items) if items else 0
+        ok += got == case["expected"]
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for case in corpus:
+            extract(case["text"])
+    elapsed = time.perf_counter() - started
+    return ok / len(corpus), elapsed / (rounds * len(corpus)) * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    with open(CORPUS, "r", encoding="utf-8") as f:
+        corpus = [json.loads(line) for line in f if line.strip()]
+
+    print(f"ответов в корпусе: {len(corpus)}")
+    for name, extract in (("прежний", legacy_extract), ("текущий", GeminiAPI.extract_json_array)):
+        rate, us = run(extract, corpus, max(1, args.rounds))
+        print(f"{name:>8}: успешно {rate:6.1%}, {us:8.1f} мкс/ответ")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Бенчмарк очереди отложенной записи: записей в секунду при 1, 10 и 100 одновременных писателях.
+
+Сравнивает AsyncStorage.writes (групповой коммит) с записью по одной транзакции
+на операцию в том же потоке ввода-вывода. Каждый писатель сохраняет
+регистрации и тесты по очереди, дожидаясь подтверждения каждой записи.
+
+    python benchmarks/bench_write_queue.py [--writes 2000]
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+_tmp = tempfile.mkdtemp(prefix="bench_writes_")
+os.environ.setdefault("TELEGRAM_API_TOKEN", "123456:bench")
+os.environ["DB_PATH"] = os.path.join(_tmp, "bench.sqlite3")
+os.chdir(_tmp)
+
+import db  # noqa: E402
+from database.database_manager import DatabaseManager  # noqa: E402
+from database.storage import AsyncStorage  # noqa: E402
+
+META = {"subject": "Математика", "topic": "Дроби", "grade": "5", "language": "Русский", "qtype": "closed"}
+TESTS = [{"index": i, "question": f"Вопрос {i}", "options": ["1", "2", "3", "4"], "answer": 1}
+         for i in range(1, 11)]
+
+
+async def run(writers: int, total: int, batched: bool) -> float:
+    storage = AsyncStorage()
+    per_writer = max(1, total // writers)
+
+    async def write(uid: int, i: int) -> None:
+        if batched:
+            if i % 2:
+                await storage.save_test(uid, META, TESTS)
+            else:
+                await storage.add_or_update_user(uid, f"user{uid}", "+7000", True)
+        elif i % 2:
+            await storage.run(DatabaseManager.save_test, uid, META, TESTS)
+        else:
+            await storage.run(DatabaseManager.add_or_update_user, uid, f"user{uid}", "+7000", True)
+
+    async def writer(w: int) -> None:
+        for i in range(per_writer):
+            await write(w * 100000 + i // 2, i)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(writer(w) for w in range(writers)))
+    elapsed = time.perf_counter() - started
+    await storage.close()
+    return writers * per_writer / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writes", type=int, default=2000)
+    total = parser.parse_args().writes
+
+    db.init_db()
+    print(f"{total} записей на случай, база во временном каталоге {_tmp}")
+    print(f"{'писателей':>9} {'по одной, зап/с':>16} {'пачками, зап/с':>15} {'ускорение':>10}")
+    for writers in (1, 10, 100):
+        single = asyncio.run(run(writers, total, batched=False))
+        batched = asyncio.run(run(writers, total, batched=True))
+        print(f"{writers:>9} {single:>16.0f} {batched:>15.0f} {batched / single:>9.1f}x")
+    db.close_connections()
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,48 @@ MAX_OUTPUT_TOKENS = int(os.getenv("MAX_OUTPUT_TOKENS", "5000"))
 TEMPERATURE = float(os.getenv("TEMPERATURE", "0.8"))
 ADMIN = int(os.getenv("ADMIN", "7787510838"))
 
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "600"))
+WRITE_BATCH_MAX_SIZE = int(os.getenv("WRITE_BATCH_MAX_SIZE", "64"))
+WRITE_BATCH_WINDOW_MS = float(os.getenv("WRITE_BATCH_WINDOW_MS", "0"))
+STATS_RECONCILE_INTERVAL = int(os.getenv("STATS_RECONCILE_INTERVAL", "21600"))
+ARTIFACTS_MAX_BYTES = int(os.getenv("ARTIFACTS_MAX_BYTES", str(500 * 1024 * 1024)))
+ARTIFACTS_TTL = float(os.getenv("ARTIFACTS_TTL", str(7 * 24 * 3600)))
+ARTIFACTS_GC_INTERVAL = int(os.getenv("ARTIFACTS_GC_INTERVAL", "1800"))
+GEMINI_CACHE_SIZE = int(os.getenv("GEMINI_CACHE_SIZE", "512"))
+GEMINI_CACHE_TTL = float(os.getenv("GEMINI_CACHE_TTL", str(24 * 3600)))
+GEMINI_CONCURRENCY_INITIAL = int(os.getenv("GEMINI_CONCURRENCY_INITIAL", "3"))
+GEMINI_CONCURRENCY_MIN = int(os.getenv("GEMINI_CONCURRENCY_MIN", "1"))
+GEMINI_CONCURRENCY_MAX = int(os.getenv("GEMINI_CONCURRENCY_MAX", "8"))
+GEMINI_LATENCY_TARGET = float(os.getenv("GEMINI_LATENCY_TARGET", "30"))
+GEMINI_RETRY_ATTEMPTS = int(os.getenv("GEMINI_RETRY_ATTEMPTS", "3"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "1.5"))
+GEMINI_BACKOFF_CAP = float(os.getenv("GEMINI_BACKOFF_CAP", "20"))
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))
+GEMINI_BREAKER_RESET = float(os.getenv("GEMINI_BREAKER_RESET", "30"))
+GEMINI_STRUCTURED_OUTPUT = os.getenv("GEMINI_STRUCTURED_OUTPUT", "1").lower() not in ("0", "false", "no")
+GEMINI_SHARD_SIZE = int(os.getenv("GEMINI_SHARD_SIZE", "8"))
+QUESTION_BANK_INTERVAL = int(os.getenv("QUESTION_BANK_INTERVAL", "900"))
+QUESTION_BANK_TARGET = int(os.getenv("QUESTION_BANK_TARGET", "40"))
+QUESTION_BANK_BATCH = int(os.getenv("QUESTION_BANK_BATCH", "10"))
+QUESTION_BANK_TOPICS = int(os.getenv("QUESTION_BANK_TOPICS", "10"))
+QUESTION_BANK_DEMAND_DAYS = int(os.getenv("QUESTION_BANK_DEMAND_DAYS", "14"))
+QUESTION_BANK_MIN_DEMAND = int(os.getenv("QUESTION_BANK_MIN_DEMAND", "3"))
+WIKI_IMPROVE_MAX_CHARS = int(os.getenv("WIKI_IMPROVE_MAX_CHARS", "30000"))
+WIKI_SECTION_MAX_CHARS = int(os.getenv("WIKI_SECTION_MAX_CHARS", "6000"))
+WIKI_API_URL = os.getenv("WIKI_API_URL", "https://{lang}.wikipedia.org/w/api.php")
+WIKI_TIMEOUT = float(os.getenv("WIKI_TIMEOUT", "20"))
+WIKI_SEARCH_CACHE_SIZE = int(os.getenv("WIKI_SEARCH_CACHE_SIZE", "512"))
+WIKI_SEARCH_CACHE_TTL = float(os.getenv("WIKI_SEARCH_CACHE_TTL", "3600"))
+WIKI_PAGE_CACHE_SIZE = int(os.getenv("WIKI_PAGE_CACHE_SIZE", "128"))
+WIKI_PAGE_CACHE_TTL = float(os.getenv("WIKI_PAGE_CACHE_TTL", "3600"))
+WIKI_IMAGES_COUNT = int(os.getenv("WIKI_IMAGES_COUNT", "3"))
+WIKI_IMAGE_WIDTH = int(os.getenv("WIKI_IMAGE_WIDTH", "800"))
+WIKI_IMAGE_MAX_BYTES = int(os.getenv("WIKI_IMAGE_MAX_BYTES", str(5 * 1024 * 1024)))
+WIKI_IMAGE_TIMEOUT = float(os.getenv("WIKI_IMAGE_TIMEOUT", "15"))
+WIKI_CACHE_SIZE = int(os.getenv("WIKI_CACHE_SIZE", "128"))
+WIKI_CACHE_DISK_SIZE = int(os.getenv("WIKI_CACHE_DISK_SIZE", "2000"))
+
 if not TELEGRAM_API_TOKEN:
     raise RuntimeError("TELEGRAM_API_TOKEN не указан")
 
@@ -1,16 +1,26 @@
+import io
 import os
+import csv
 import json
-import threading
-import tempfile
+import sqlite3
 import shutil
 import logging
-from datetime import datetime
-from typing import Dict, List, Optional
+from datetime import datetime, timedelta
+from typing import BinaryIO, Dict, List, Optional, Tuple
 
-from config.config import DATA_DIR
+from config.config import DATA_DIR, USER_CACHE_SIZE, USER_CACHE_TTL
+import db
+from db import get_connection
+from utils.cache import TTLCache, MISSING
 
 logger = logging.getLogger(__name__)
-_user_file_lock = threading.Lock()
+
+_USER_COLUMNS = "id, username, phone, accepted, created_at, updated_at"
+
+# Кэш записей пользователей: uid -> dict или None (пользователя нет).
+# Все изменяющие методы обновляют его сразу после коммита.
+_user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
 
 class DatabaseManager:
     @staticmethod
@@ -27,94 +37,196 @@ class DatabaseManager:
         return os.path.join(DATA_DIR, "users.json")
 
     @staticmethod
-    def _read_users() -> Dict[str, Dict]:
-        path = DatabaseManager.get_users_file_path()
-        try:
-            with _user_file_lock:
-                with open(path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    if isinstance(data, dict):
-                        return data
-                    logger.warning("Файл пользователей не в формате dict — верну пустой словарь.")
-                    return {}
-        except FileNotFoundError:
-            logger.info("Файл пользователей не найден: %s. Верну пустой словарь.", path)
-            return {}
-        except json.JSONDecodeError:
-            logger.exception("Ошибка разбора JSON в файле пользователей; верну пустой словарь.")
-            return {}
-        except Exception as e:
-            logger.exception("Неожиданная ошибка при чтении файла пользователей: %s", e)
-            return {}
+    def _row_to_user(row: sqlite3.Row) -> Dict:
+        return {
+            "id": row["id"],
+            "username": row["username"] or "",
+            "phone": row["phone"] or "",
+            "accepted": bool(row["accepted"]),
+            "registered_at": row["created_at"],
+            "updated_at": row["updated_at"]
+        }
+
+    @staticmethod
+    def _fetch_user(conn: sqlite3.Connection, uid: int) -> Optional[Dict]:
+        row = conn.execute(f"SELECT {_USER_COLUMNS} FROM users WHERE id = ?", (uid,)).fetchone()
+        return DatabaseManager._row_to_user(row) if row else None
 
     @staticmethod
-    def _write_users(users: Dict[str, Dict]) -> None:
-        path = DatabaseManager.get_users_file_path()
-        dirpath = os.path.dirname(path)
-        os.makedirs(dirpath, exist_ok=True)
-        tmp_fd = None
-        tmp_path = None
+    def import_users_json(path: Optional[str] = None) -> int:
+        """Одноразовый перенос users.json в таблицу users.
+
+        Уже существующие в SQLite записи не перезаписываются. После успешного
+        импорта файл переименовывается в users.json.imported, поэтому повторный
+        вызов ничего не делает.
+        """
+        path = path or DatabaseManager.get_users_file_path()
+        if not os.path.exists(path):
+            return 0
         try:
-            with _user_file_lock:
-                tmp_fd, tmp_path = tempfile.mkstemp(prefix="users_", dir=dirpath, text=True)
-                with os.fdopen(tmp_fd, "w", encoding="utf-8") as f:
-                    json.dump(users, f, ensure_ascii=False, indent=2)
-                    f.flush()
-                    os.fsync(f.fileno())
-                shutil.move(tmp_path, path)
-        except Exception as e:
-            logger.exception("Ошибка при записи файла пользователей: %s", e)
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            logger.exception("Не удалось прочитать %s для импорта", path)
+            return 0
+        if not isinstance(data, dict):
+            logger.warning("Файл пользователей не в формате dict — импорт пропущен.")
+            return 0
+
+        rows = []
+        for key, user in data.items():
             try:
-                if tmp_path and os.path.exists(tmp_path):
-                    os.remove(tmp_path)
-            except Exception:
-                logger.exception("Не смог удалить временный файл пользователей.")
-            raise
+                uid = int(user.get("id", key))
+            except (TypeError, ValueError, AttributeError):
+                logger.warning("Пропускаю некорректную запись пользователя %r", key)
+                continue
+            rows.append((
+                uid,
+                user.get("username") or "",
+                user.get("phone") or "",
+                int(bool(user.get("accepted"))),
+                user.get("registered_at") or datetime.utcnow().isoformat(),
+                user.get("updated_at")
+            ))
+
+        conn = get_connection()
+        with conn:
+            cur = conn.executemany(
+                "INSERT OR IGNORE INTO users (id, username, phone, accepted, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            imported = cur.rowcount
+
+        _user_cache.clear()
+        shutil.move(path, path + ".imported")
+        logger.info("Импортировано пользователей из %s: %s из %s", path, imported, len(rows))
+        return imported
 
     @staticmethod
-    def add_or_update_user(uid: int, username: str, phone: str, accepted: bool = False) -> None:
+    def _add_or_update_user_tx(conn: sqlite3.Connection, uid: int, username: str, phone: str,
+                               accepted: bool = False) -> Dict:
         if not isinstance(uid, int):
             raise ValueError("uid должен быть int")
-        users = DatabaseManager._read_users()
-        key = str(uid)
-        now = datetime.utcnow().isoformat()
-        existing = users.get(key)
-        if existing:
-            existing["username"] = username or existing.get("username", "")
-            existing["phone"] = phone or existing.get("phone", "")
-            existing["accepted"] = bool(accepted) or existing.get("accepted", False)
-            existing["updated_at"] = now
-            users[key] = existing
-            logger.info("Обновлен пользователь %s", uid)
-        else:
-            users[key] = {
-                "id": uid,
-                "username": username or "",
-                "phone": phone or "",
-                "accepted": bool(accepted),
-                "registered_at": now,
-                "updated_at": None
-            }
-            logger.info("Добавлен новый пользователь %s", uid)
-        DatabaseManager._write_users(users)
+        conn.execute(
+            """
+            INSERT INTO users (id, username, phone, accepted, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, NULL)
+            ON CONFLICT(id) DO UPDATE SET
+                username = COALESCE(NULLIF(excluded.username, ''), users.username),
+                phone = COALESCE(NULLIF(excluded.phone, ''), users.phone),
+                accepted = MAX(users.accepted, excluded.accepted),
+                updated_at = excluded.created_at
+            """,
+            (uid, username or "", phone or "", int(bool(accepted)), datetime.utcnow().isoformat())
+        )
+        return DatabaseManager._fetch_user(conn, uid)
+
+    @staticmethod
+    def add_or_update_user(uid: int, username: str, phone: str, accepted: bool = False) -> None:
+        conn = get_connection()
+        with conn:
+            user = DatabaseManager._add_or_update_user_tx(conn, uid, username, phone, accepted)
+        _user_cache.set(uid, user)
+        logger.info("Сохранён пользователь %s", uid)
 
     @staticmethod
     def get_user(uid: int) -> Optional[Dict]:
         if not isinstance(uid, int):
             logger.warning("get_user: uid не int")
             return None
-        users = DatabaseManager._read_users()
-        user = users.get(str(uid))
+        user = _user_cache.get(uid, MISSING)
+        if user is MISSING:
+            conn = get_connection()
+            user = DatabaseManager._fetch_user(conn, uid)
+            _user_cache.set(uid, user)
         if user:
             logger.debug("Найден пользователь %s", uid)
-            return user
+            return dict(user)
         logger.info("Пользователь %s не найден", uid)
         return None
 
+    @staticmethod
+    def get_cached_user(uid: int):
+        """Запись из кэша без обращения к БД; MISSING, если её там нет."""
+        user = _user_cache.get(uid, MISSING)
+        if user is MISSING or user is None:
+            return user
+        return dict(user)
+
+    @staticmethod
+    def user_cache_stats() -> Dict:
+        return _user_cache.stats()
+
     @staticmethod
     def list_users() -> List[Dict]:
-        users = DatabaseManager._read_users()
-        return list(users.values())
+        conn = get_connection()
+        rows = conn.execute(f"SELECT {_USER_COLUMNS} FROM users ORDER BY id").fetchall()
+        return [DatabaseManager._row_to_user(r) for r in rows]
+
+    @staticmethod
+    def list_users_page(after_id: Optional[int] = None, before_id: Optional[int] = None, limit: int = 20,
+                        accepted_only: bool = False, since: Optional[str] = None) -> Tuple[List[Dict], bool]:
+        """Страница пользователей по возрастанию id (keyset-пагинация).
+
+        after_id — листать вперёд от id, before_id — назад. since — дата ISO,
+        начиная с которой зарегистрирован пользователь. Возвращает
+        (пользователи, есть ли ещё записи в направлении листания).
+        """
+        where, params = [], []
+        if after_id is not None:
+            where.append("id > ?")
+            params.append(after_id)
+        if before_id is not None:
+            where.append("id < ?")
+            params.append(before_id)
+        if accepted_only:
+            where.append("accepted != 0")
+        if since:
+            where.append("created_at >= ?")
+            params.append(since)
+        order = "DESC" if before_id is not None and after_id is None else "ASC"
+        sql = f"SELECT {_USER_COLUMNS} FROM users"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY id {order} LIMIT ?"
+        params.append(limit + 1)
+        rows = get_connection().execute(sql, params).fetchall()
+        has_more = len(rows) > limit
+        users = [DatabaseManager._row_to_user(r) for r in rows[:limit]]
+        if order == "DESC":
+            users.reverse()
+        return users, has_more
+
+    @staticmethod
+    def iter_users(accepted_only: bool = False, since: Optional[str] = None, chunk_size: int = 500):
+        after_id = None
+        while True:
+            users, has_more = DatabaseManager.list_users_page(
+                after_id=after_id, limit=chunk_size, accepted_only=accepted_only, since=since
+            )
+            yield from users
+            if not has_more or not users:
+                return
+            after_id = users[-1]["id"]
+
+    @staticmethod
+    def export_users_csv(fileobj: BinaryIO, accepted_only: bool = False, since: Optional[str] = None) -> int:
+        """Пишет пользователей в CSV (UTF-8 с BOM) порциями, не держа весь список в памяти."""
+        text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+        writer = csv.writer(text)
+        writer.writerow(["id", "username", "phone", "accepted", "registered_at", "updated_at"])
+        count = 0
+        for user in DatabaseManager.iter_users(accepted_only=accepted_only, since=since):
+            writer.writerow([
+                user["id"], user["username"], user["phone"], int(user["accepted"]),
+                user["registered_at"] or "", user["updated_at"] or ""
+            ])
+            count += 1
+        text.flush()
+        text.detach()
+        fileobj.seek(0)
+        return count
 
     @staticmethod
     def user_exists(uid: int) -> bool:
@@ -125,14 +237,17 @@ class DatabaseManager:
         if not isinstance(uid, int):
             logger.warning("set_accepted: uid не int")
             return False
-        users = DatabaseManager._read_users()
-        key = str(uid)
-        if key not in users:
+        conn = get_connection()
+        with conn:
+            cur = conn.execute(
+                "UPDATE users SET accepted = ?, updated_at = ? WHERE id = ?",
+                (int(bool(accepted)), datetime.utcnow().isoformat(), uid)
+            )
+            user = DatabaseManager._fetch_user(conn, uid)
+        _user_cache.set(uid, user)
+        if cur.rowcount == 0:
             logger.info("set_accepted: пользователь %s не найден", uid)
             return False
-        users[key]["accepted"] = bool(accepted)
-        users[key]["updated_at"] = datetime.utcnow().isoformat()
-        DatabaseManager._write_users(users)
         logger.info("Пользователь %s помечен accepted=%s", uid, accepted)
         return True
 
@@ -141,14 +256,17 @@ class DatabaseManager:
         if not isinstance(uid, int):
             logger.warning("update_user_phone: uid не int")
             return False
-        users = DatabaseManager._read_users()
-        key = str(uid)
-        if key not in users:
+        conn = get_connection()
+        with conn:
+            cur = conn.execute(
+                "UPDATE users SET phone = ?, updated_at = ? WHERE id = ?",
+                (phone, datetime.utcnow().isoformat(), uid)
+            )
+            user = DatabaseManager._fetch_user(conn, uid)
+        _user_cache.set(uid, user)
+        if cur.rowcount == 0:
             logger.info("update_user_phone: пользователь %s не найден", uid)
             return False
-        users[key]["phone"] = phone
-        users[key]["updated_at"] = datetime.utcnow().isoformat()
-        DatabaseManager._write_users(users)
         logger.info("У пользователя %s обновлён телефон", uid)
         return True
 
@@ -157,11 +275,11 @@ class DatabaseManager:
         if not isinstance(uid, int):
             logger.warning("remove_user: uid не int")
             return False
-        users = DatabaseManager._read_users()
-        key = str(uid)
-        if key in users:
-            users.pop(key)
-            DatabaseManager._write_users(users)
+        conn = get_connection()
+        with conn:
+            cur = conn.execute("DELETE FROM users WHERE id = ?", (uid,))
+        _user_cache.set(uid, None)
+        if cur.rowcount:
             logger.info("Пользователь %s удалён", uid)
             return True
         logger.info("remove_user: пользователь %s не найден", uid)
@@ -171,54 +289,133 @@ class DatabaseManager:
     def get_or_create_user(uid: int, username: str = "", phone: str = "", accepted: bool = False) -> Dict:
         if not isinstance(uid, int):
             raise ValueError("uid должен быть int")
-        users = DatabaseManager._read_users()
-        key = str(uid)
-        if key in users:
+        conn = get_connection()
+        with conn:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO users (id, username, phone, accepted, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (uid, username or "", phone or "", int(bool(accepted)), datetime.utcnow().isoformat())
+            )
+            user = DatabaseManager._fetch_user(conn, uid)
+        _user_cache.set(uid, user)
+        if cur.rowcount:
+            logger.info("get_or_create_user: создан новый пользователь %s", uid)
+        else:
             logger.debug("get_or_create_user: возвращаю существующего %s", uid)
-            return users[key]
-        now = datetime.utcnow().isoformat()
-        users[key] = {
-            "id": uid,
-            "username": username or "",
-            "phone": phone or "",
-            "accepted": bool(accepted),
-            "registered_at": now,
-            "updated_at": None
-        }
-        DatabaseManager._write_users(users)
-        logger.info("get_or_create_user: создан новый пользователь %s", uid)
-        return users[key]
+        return dict(user)
 
     @staticmethod
-    def save_test(uid: int, meta: Dict, tests: List) -> str:
-        DatabaseManager.init()
-        ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    def save_test(uid: int, meta: Dict, tests: List) -> int:
+        """Сохраняет тест в архив (таблица tests) и возвращает его id."""
         safe_uid = int(uid) if isinstance(uid, int) else 0
-        file_name = f"tests_{safe_uid}_{ts}.json"
-        file_path = os.path.join(DATA_DIR, file_name)
-        test_data = {
-            "meta": meta,
-            "tests": tests,
-            "created_at": datetime.utcnow().isoformat()
-        }
         try:
-            dirpath = os.path.dirname(file_path)
-            os.makedirs(dirpath, exist_ok=True)
-            tmp_fd, tmp_path = tempfile.mkstemp(prefix="tests_", dir=dirpath, text=True)
-            with os.fdopen(tmp_fd, "w", encoding="utf-8") as f:
-                json.dump(test_data, f, ensure_ascii=False, indent=2)
-                f.flush()
-                os.fsync(f.fileno())
-            shutil.move(tmp_path, file_path)
-            logger.info("Тест сохранён в файл %s", file_path)
-            return file_path
-        except Exception as e:
-            logger.exception("Не удалось сохранить тест в файл %s: %s", file_path, e)
+            test_id = db.save_test(safe_uid, meta, tests)
+        except sqlite3.Error as e:
+            logger.exception("Не удалось сохранить тест пользователя %s: %s", safe_uid, e)
+            raise
+        logger.info("Тест %s пользователя %s сохранён в архив", test_id, safe_uid)
+        return test_id
+
+    @staticmethod
+    def apply_batch(ops: List[Tuple[str, tuple]]) -> List:
+        """Применяет пачку изменений одной транзакцией (group commit).
+
+        ops — список (имя операции, аргументы); поддерживаются add_or_update_user,
+        save_test и record_usage. Каждая операция выполняется в своей точке сохранения, поэтому
+        ошибка одной не откатывает остальные: на её месте в результате окажется
+        исключение.
+        """
+        results: List = []
+        touched: Dict[int, Dict] = {}
+        conn = get_connection()
+        with conn:
+            conn.execute("BEGIN")
+            for name, args in ops:
+                conn.execute("SAVEPOINT batch_op")
+                try:
+                    if name == "add_or_update_user":
+                        user = DatabaseManager._add_or_update_user_tx(conn, *args)
+                        touched[user["id"]] = user
+                        result = None
+                    elif name == "save_test":
+                        uid, meta, tests = args
+                        result = db.insert_test(conn, int(uid) if isinstance(uid, int) else 0, meta, tests)
+                    elif name == "record_usage":
+                        result = db.add_usage(conn, *args)
+                    else:
+                        raise ValueError(f"Неизвестная операция: {name}")
+                    conn.execute("RELEASE batch_op")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO batch_op")
+                    conn.execute("RELEASE batch_op")
+                    logger.warning("Операция %s в пачке не выполнена: %s", name, e)
+                    result = e
+                results.append(result)
+        for uid, user in touched.items():
+            _user_cache.set(uid, user)
+        logger.debug("Записана пачка из %s операций", len(ops))
+        return results
+
+    @staticmethod
+    def get_test(test_id: int) -> Optional[Dict]:
+        return db.get_test(test_id)
+
+    @staticmethod
+    def list_user_tests(uid: int, limit: int = 10, before: Optional[Tuple[str, int]] = None
+                        ) -> Tuple[List[Dict], Optional[Tuple[str, int]]]:
+        return db.list_user_tests(uid, limit, before)
+
+    @staticmethod
+    def count_tests() -> int:
+        return db.get_counters("tests_total").get("tests_total", 0)
+
+    @staticmethod
+    def get_stats(top_subjects: int = 5) -> Dict:
+        """Сводка для /stats из счётчиков stats_counters, без сканирования таблиц.
+
+        Читаются только фиксированные ключи, счётчик за сегодня и top_subjects
+        предметов: объём работы не растёт с историей.
+        """
+        today = datetime.utcnow().strftime("%Y-%m-%d")
+        counters = db.get_counter_values([
+            "users_total", "users_accepted", "tests_total", f"tests_day:{today}", "bytes_stored",
+            "artifacts_bytes", "artifacts_reclaimed_bytes"
+        ])
+        subjects = [(name or "—", count) for name, count in db.top_counters("tests_subject:", top_subjects)]
+        # Типов вопросов всего два-три, их можно прочитать целиком.
+        qtypes = {k.split(":", 1)[1] or "—": v for k, v in db.get_counters("tests_qtype:").items() if v > 0}
+        db_size = 0
+        for path in (db.DB_PATH, db.DB_PATH + "-wal"):
             try:
-                with open(file_path, "w", encoding="utf-8") as f:
-                    json.dump(test_data, f, ensure_ascii=False, indent=2)
-                logger.info("Тест сохранён через fallback в %s", file_path)
-                return file_path
-            except Exception as e2:
-                logger.exception("Альтернативная запись также не удалась: %s", e2)
-                raise
\ No newline at end of file
+                db_size += os.path.getsize(path)
+            except OSError:
+                pass
+        return {
+            "users_total": counters.get("users_total", 0),
+            "users_accepted": counters.get("users_accepted", 0),
+            "tests_total": counters.get("tests_total", 0),
+            "tests_today": counters.get(f"tests_day:{today}", 0),
+            "tests_by_subject": subjects,
+            "tests_by_qtype": qtypes,
+            "bytes_stored": counters.get("bytes_stored", 0),
+            "artifacts_bytes": counters.get("artifacts_bytes", 0),
+            "artifacts_reclaimed_bytes": counters.get("artifacts_reclaimed_bytes", 0),
+            "db_size": db_size
+        }
+
+    @staticmethod
+    def get_usage(days: int = 1, top_users: int = 5) -> Dict:
+        """Расход токенов Gemini за последние days дней по функциям и по пользователям."""
+        since = (datetime.utcnow() - timedelta(days=max(1, days) - 1)).strftime("%Y-%m-%d")
+        return {
+            "since": since,
+            "by_feature": db.get_usage(since, by="feature"),
+            "by_user": db.get_usage(since, by="user_id", limit=top_users)
+        }
+
+    @staticmethod
+    def reconcile_stats() -> Dict[str, int]:
+        drift = db.reconcile_counters()
+        if drift:
+            logger.warning("Счётчики статистики расходились с данными: %s", drift)
+        return drift
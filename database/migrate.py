@@ -0,0 +1,241 @@
+"""Офлайн-перенос файлового хранилища (users.json и tests_*.json) в SQLite.
+
+Запуск (бот должен быть остановлен):
+
+    python -m database.migrate [--data-dir data] [--batch-size 5000] [--workers 8]
+
+Тесты грузятся пачками через executemany, каждая пачка — одна транзакция.
+Обработанные файлы записываются в таблицу migration_progress вместе с
+контрольной суммой, поэтому прерванный перенос продолжается с места
+остановки. В конце сверяются количества строк и контрольные суммы и
+печатается отчёт со скоростью загрузки.
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import db
+from config.config import DATA_DIR
+
+logger = logging.getLogger("tg-edu-bot")
+
+_TEST_FILE_RE = re.compile(r"^tests_(\d+)_(\d{8})_(\d{6})\.json$")
+
+
+def _checksum(obj) -> str:
+    raw = json.dumps(obj, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _ensure_progress_table(conn) -> None:
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS migration_progress (
+        source TEXT PRIMARY KEY,
+        test_id INTEGER,
+        checksum TEXT NOT NULL
+    )
+    """)
+    conn.commit()
+
+
+def _iter_test_files(data_dir: str) -> Iterator[str]:
+    with os.scandir(data_dir) as it:
+        for entry in it:
+            if entry.is_file() and _TEST_FILE_RE.match(entry.name):
+                yield entry.name
+
+
+def _chunks(items: Iterator[str], size: int) -> Iterator[List[str]]:
+    chunk: List[str] = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _read_test_file(data_dir: str, name: str) -> Optional[Tuple[str, tuple, str]]:
+    """Читает и готовит к вставке один файл. Выполняется в пуле потоков."""
+    try:
+        with open(os.path.join(data_dir, name), "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning("Пропускаю %s: %s", name, e)
+        return None
+    if not isinstance(data, dict):
+        logger.warning("Пропускаю %s: ожидался JSON-объект, получен %s", name, type(data).__name__)
+        return None
+    match = _TEST_FILE_RE.match(name)
+    meta = data.get("meta")
+    meta = meta if isinstance(meta, dict) else {}
+    tests = data.get("tests")
+    tests = tests if isinstance(tests, list) else []
+    try:
+        user_id = int(meta.get("user_id") or match.group(1))
+    except (TypeError, ValueError):
+        user_id = int(match.group(1))
+    created_at = data.get("created_at")
+    if not created_at:
+        created_at = time.strftime(
+            "%Y-%m-%dT%H:%M:%S", time.strptime(match.group(2) + match.group(3), "%Y%m%d%H%M%S")
+        )
+    row = db.build_test_row(user_id, meta, tests, created_at)
+    checksum = _checksum({"user_id": user_id, "meta": meta, "tests": tests})
+    return name, row, checksum
+
+
+def migrate_users(conn, users_path: str) -> Dict:
+    if not os.path.exists(users_path):
+        return {"source": 0, "loaded": 0, "seconds": 0.0}
+    started = time.perf_counter()
+    with open(users_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    rows = []
+    for key, user in (data.items() if isinstance(data, dict) else []):
+        try:
+            uid = int(user.get("id", key))
+        except (TypeError, ValueError, AttributeError):
+            continue
+        rows.append((
+            uid,
+            user.get("username") or "",
+            user.get("phone") or "",
+            int(bool(user.get("accepted"))),
+            user.get("registered_at"),
+            user.get("updated_at")
+        ))
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (id, username, phone, accepted, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+    return {"source": len(rows), "rows": rows, "seconds": time.perf_counter() - started}
+
+
+def migrate_tests(conn, data_dir: str, batch_size: int, workers: int) -> Dict:
+    _ensure_progress_table(conn)
+    done = {r[0] for r in conn.execute("SELECT source FROM migration_progress")}
+    pending = (name for name in _iter_test_files(data_dir) if name not in done)
+
+    placeholders = ", ".join("?" * (len(db.TEST_INSERT_COLUMNS) + 1))
+    insert_sql = f"INSERT INTO tests (id, {', '.join(db.TEST_INSERT_COLUMNS)}) VALUES ({placeholders})"
+
+    loaded = skipped = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for chunk in _chunks(pending, batch_size):
+            prepared = [p for p in pool.map(lambda n: _read_test_file(data_dir, n), chunk) if p]
+            skipped += len(chunk) - len(prepared)
+            if not prepared:
+                continue
+            with conn:
+                # Явно выдаём id внутри транзакции, чтобы связать строки с исходными файлами.
+                conn.execute("BEGIN IMMEDIATE")
+                next_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM tests").fetchone()[0] + 1
+                seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'tests'").fetchone()
+                if seq and seq[0] >= next_id:
+                    next_id = seq[0] + 1
+                test_rows, progress_rows = [], []
+                for offset, (name, row, checksum) in enumerate(prepared):
+                    test_rows.append((next_id + offset,) + row)
+                    progress_rows.append((name, next_id + offset, checksum))
+                conn.executemany(insert_sql, test_rows)
+                conn.executemany(
+                    "INSERT INTO migration_progress (source, test_id, checksum) VALUES (?, ?, ?)",
+                    progress_rows
+                )
+            loaded += len(prepared)
+            elapsed = time.perf_counter() - started
+            logger.info("Перенесено тестов: %s (%.0f строк/с)", loaded, loaded / elapsed if elapsed else 0)
+    return {
+        "already_done": len(done),
+        "loaded": loaded,
+        "skipped": skipped,
+        "seconds": time.perf_counter() - started
+    }
+
+
+def verify(conn, user_rows: List[tuple]) -> Dict:
+    report = {"users_missing": 0, "users_differ": 0, "tests_missing": 0, "tests_checksum_mismatch": 0}
+    for uid, username, phone, accepted, _, _ in user_rows:
+        row = conn.execute("SELECT username, phone, accepted FROM users WHERE id = ?", (uid,)).fetchone()
+        if row is None:
+            report["users_missing"] += 1
+        elif (row[0] or "", row[1] or "", int(bool(row[2]))) != (username, phone, accepted):
+            report["users_differ"] += 1
+
+    last_rowid = 0
+    while True:
+        rows = conn.execute("""
+            SELECT p.rowid, p.checksum, t.user_id, t.meta, t.payload
+            FROM migration_progress p LEFT JOIN tests t ON t.id = p.test_id
+            WHERE p.rowid > ? ORDER BY p.rowid LIMIT 1000
+        """, (last_rowid,)).fetchall()
+        if not rows:
+            break
+        for rowid, checksum, user_id, meta, payload in rows:
+            if user_id is None:
+                report["tests_missing"] += 1
+                continue
+            actual = _checksum({
+                "user_id": user_id,
+                "meta": json.loads(meta) if meta else {},
+                "tests": db.unpack_payload(payload) or []
+            })
+            if actual != checksum:
+                report["tests_checksum_mismatch"] += 1
+        last_rowid = rows[-1][0]
+    report["tests_tracked"] = conn.execute("SELECT COUNT(*) FROM migration_progress").fetchone()[0]
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Перенос users.json и tests_*.json в SQLite")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--users-json", default=None,
+                        help="путь к users.json (по умолчанию DATA_DIR/users.json или users.json.imported)")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=min(8, (os.cpu_count() or 1) * 2))
+    parser.add_argument("--skip-verify", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    users_path = args.users_json
+    if users_path is None:
+        users_path = os.path.join(args.data_dir, "users.json")
+        if not os.path.exists(users_path):
+            users_path += ".imported"
+
+    conn = db.get_connection()
+    users = migrate_users(conn, users_path)
+    tests = migrate_tests(conn, args.data_dir, max(1, args.batch_size), max(1, args.workers))
+    report = {} if args.skip_verify else verify(conn, users.get("rows", []))
+    db.reconcile_counters()
+
+    print("=== Отчёт о переносе ===")
+    print(f"users: в файле {users['source']}, {users['seconds']:.2f} с, "
+          f"{users['source'] / users['seconds'] if users['seconds'] else 0:.0f} строк/с")
+    print(f"tests: перенесено {tests['loaded']}, ранее {tests['already_done']}, "
+          f"пропущено {tests['skipped']}, {tests['seconds']:.2f} с, "
+          f"{tests['loaded'] / tests['seconds'] if tests['seconds'] else 0:.0f} строк/с")
+    if report:
+        print(f"проверка users: нет в БД {report['users_missing']}, отличаются {report['users_differ']}")
+        print(f"проверка tests: отслеживается {report['tests_tracked']}, нет в БД {report['tests_missing']}, "
+              f"несовпадений контрольных сумм {report['tests_checksum_mismatch']}")
+        if report["users_missing"] or report["tests_missing"] or report["tests_checksum_mismatch"]:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
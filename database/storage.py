@@ -0,0 +1,227 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from config.config import WRITE_BATCH_MAX_SIZE, WRITE_BATCH_WINDOW_MS
+from database.database_manager import DatabaseManager
+from utils.cache import MISSING
+
+logger = logging.getLogger("tg-edu-bot")
+
+
+class WriteBehindQueue:
+    """Очередь отложенной записи с групповым коммитом.
+
+    Пока идёт запись предыдущей пачки, новые изменения копятся в очереди;
+    если их несколько, очередь дополнительно ждёт до batch_window секунд
+    (или до max_batch штук) и записывает всё одной транзакцией через
+    DatabaseManager.apply_batch.
+    submit() возвращает результат операции после коммита её пачки, post()
+    ставит операцию в очередь и не ждёт её записи.
+    """
+
+    def __init__(self, run_io, max_batch: int = WRITE_BATCH_MAX_SIZE,
+                 batch_window: float = WRITE_BATCH_WINDOW_MS / 1000):
+        self.run_io = run_io
+        self.max_batch = max(1, max_batch)
+        self.batch_window = max(0.0, batch_window)
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+        self.batches = 0
+        self.ops = 0
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._worker())
+
+    async def submit(self, name: str, *args):
+        if self._closed:
+            raise RuntimeError("Очередь записи закрыта")
+        self._ensure_started()
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((name, args, fut))
+        return await fut
+
+    def post(self, name: str, *args) -> None:
+        if self._closed:
+            raise RuntimeError("Очередь записи закрыта")
+        self._ensure_started()
+        fut = asyncio.get_running_loop().create_future()
+        # Ошибка уже залогирована при записи пачки; забираем её, чтобы asyncio не ругался.
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._queue.put_nowait((name, args, fut))
+
+    def _drain(self, batch: list) -> bool:
+        """Забирает без ожидания всё, что уже в очереди. False — встречен сигнал остановки."""
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return True
+            if item is None:
+                self._queue.put_nowait(None)
+                return False
+            batch.append(item)
+        return True
+
+    async def _collect(self, first) -> list:
+        batch = [first]
+        # Даём одновременно пришедшим запросам попасть в очередь.
+        await asyncio.sleep(0)
+        if not self._drain(batch) or len(batch) == 1:
+            # Одиночную запись не задерживаем: пачки складываются сами,
+            # пока предыдущая пачка коммитится.
+            return batch
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_window
+        while len(batch) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                self._queue.put_nowait(None)
+                break
+            batch.append(item)
+            if not self._drain(batch):
+                break
+        return batch
+
+    async def _worker(self) -> None:
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                return
+            batch = await self._collect(first)
+            ops = [(name, args) for name, args, _ in batch]
+            try:
+                results = await self.run_io(DatabaseManager.apply_batch, ops)
+            except Exception as e:
+                logger.exception("Не удалось записать пачку из %s операций", len(batch))
+                results = [e] * len(batch)
+            self.batches += 1
+            self.ops += len(batch)
+            for (_, _, fut), result in zip(batch, results):
+                if fut.done():
+                    continue
+                if isinstance(result, Exception):
+                    fut.set_exception(result)
+                else:
+                    fut.set_result(result)
+
+    async def close(self) -> None:
+        """Дописывает всё, что уже в очереди, и останавливает обработчик."""
+        self._closed = True
+        if self._task is not None and not self._task.done():
+            self._queue.put_nowait(None)
+            await self._task
+        logger.info("Очередь записи остановлена: пачек %s, операций %s", self.batches, self.ops)
+
+
+class AsyncStorage:
+    """Асинхронный фасад над DatabaseManager.
+
+    Все обращения к SQLite и файлам выполняются в отдельном потоке ввода-вывода,
+    поэтому fsync и сериализация не блокируют event loop aiogram.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage-io")
+        self.writes = WriteBehindQueue(self.run)
+
+    async def run(self, func, *args, **kwargs):
+        """Выполняет func в потоке ввода-вывода хранилища — для модулей со своими таблицами."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def get_user(self, uid: int) -> Optional[Dict]:
+        user = DatabaseManager.get_cached_user(uid)
+        if user is not MISSING:
+            return user
+        return await self.run(DatabaseManager.get_user, uid)
+
+    async def user_exists(self, uid: int) -> bool:
+        return await self.get_user(uid) is not None
+
+    async def list_users(self) -> List[Dict]:
+        return await self.run(DatabaseManager.list_users)
+
+    async def list_users_page(self, after_id: Optional[int] = None, before_id: Optional[int] = None,
+                              limit: int = 20, accepted_only: bool = False,
+                              since: Optional[str] = None) -> Tuple[List[Dict], bool]:
+        return await self.run(DatabaseManager.list_users_page, after_id, before_id, limit, accepted_only, since)
+
+    async def export_users_csv(self, fileobj: BinaryIO, accepted_only: bool = False,
+                               since: Optional[str] = None) -> int:
+        return await self.run(DatabaseManager.export_users_csv, fileobj, accepted_only, since)
+
+    async def add_or_update_user(self, uid: int, username: str, phone: str, accepted: bool = False) -> None:
+        await self.writes.submit("add_or_update_user", uid, username, phone, accepted)
+
+    async def set_accepted(self, uid: int, accepted: bool = True) -> bool:
+        return await self.run(DatabaseManager.set_accepted, uid, accepted)
+
+    async def update_user_phone(self, uid: int, phone: str) -> bool:
+        return await self.run(DatabaseManager.update_user_phone, uid, phone)
+
+    async def remove_user(self, uid: int) -> bool:
+        return await self.run(DatabaseManager.remove_user, uid)
+
+    async def get_or_create_user(self, uid: int, username: str = "", phone: str = "", accepted: bool = False) -> Dict:
+        return await self.run(DatabaseManager.get_or_create_user, uid, username, phone, accepted)
+
+    async def save_test(self, uid: int, meta: Dict, tests: List) -> int:
+        return await self.writes.submit("save_test", uid, meta, tests)
+
+    async def get_test(self, test_id: int) -> Optional[Dict]:
+        return await self.run(DatabaseManager.get_test, test_id)
+
+    async def list_user_tests(self, uid: int, limit: int = 10, before: Optional[Tuple[str, int]] = None
+                              ) -> Tuple[List[Dict], Optional[Tuple[str, int]]]:
+        return await self.run(DatabaseManager.list_user_tests, uid, limit, before)
+
+    async def count_tests(self) -> int:
+        return await self.run(DatabaseManager.count_tests)
+
+    async def get_stats(self) -> Dict:
+        return await self.run(DatabaseManager.get_stats)
+
+    def user_cache_stats(self) -> Dict:
+        """Счётчики кэша профилей живут в памяти процесса, поэтому читаются без исполнителя."""
+        return DatabaseManager.user_cache_stats()
+
+    def record_usage(self, user_id: Optional[int], feature: str, requests: int, prompt_tokens: int,
+                     output_tokens: int, questions: int, latency_ms: int) -> None:
+        """Расход токенов пишется в фоне той же групповой записью: ответ пользователю его не ждёт."""
+        self.writes.post("record_usage", user_id, feature, requests, prompt_tokens, output_tokens,
+                         questions, latency_ms)
+
+    async def get_usage(self, days: int = 1) -> Dict:
+        return await self.run(DatabaseManager.get_usage, days)
+
+    async def periodic_reconcile_stats(self, interval_seconds: int) -> None:
+        try:
+            while True:
+                await asyncio.sleep(interval_seconds)
+                try:
+                    await self.run(DatabaseManager.reconcile_stats)
+                except Exception:
+                    # Например, "database is locked" во время переноса: пробуем в следующий раз.
+                    logger.exception("Ошибка при сверке счётчиков статистики")
+        except asyncio.CancelledError:
+            logger.info("Periodic stats reconciliation cancelled")
+
+    async def close(self) -> None:
+        await self.writes.close()
+        self._executor.shutdown(wait=True)
+        logger.info("Поток хранилища остановлен")
+
+
+storage = AsyncStorage()
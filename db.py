@@ -1,8 +1,10 @@
 import os
 import sqlite3
 import json
+import threading
+import zlib
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,12 +14,53 @@ dir_path = os.path.dirname(DB_PATH)
 if dir_path and not os.path.exists(dir_path):
     os.makedirs(dir_path, exist_ok=True)
 
-def get_connection():
-    conn = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES, check_same_thread=False)
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "16384"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))
+
+# Пул соединений: по одному долгоживущему соединению на поток.
+_local = threading.local()
+_pool_lock = threading.Lock()
+_pool: List[sqlite3.Connection] = []
+_pool_generation = 0
+
+def _open_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        DB_PATH,
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+        check_same_thread=False,
+        cached_statements=256,
+    )
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = NORMAL;")
     conn.execute("PRAGMA foreign_keys = ON;")
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB};")
+    conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE};")
+    return conn
+
+def get_connection() -> sqlite3.Connection:
+    """Соединение текущего потока. Не закрывайте его — оно переиспользуется."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "generation", None) != _pool_generation:
+        conn = _open_connection()
+        with _pool_lock:
+            _pool.append(conn)
+            _local.conn = conn
+            _local.generation = _pool_generation
     return conn
 
+def close_connections() -> None:
+    global _pool_generation
+    with _pool_lock:
+        for conn in _pool:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _pool.clear()
+        _pool_generation += 1
+
 def init_db():
     conn = get_connection()
     cur = conn.cursor()
@@ -37,39 +80,261 @@ def init_db():
         user_id INTEGER,
         meta TEXT,
         tests TEXT,
-        created_at TEXT,
-        FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        created_at TEXT
+    )
+    """)
+    _migrate_tests_table(cur)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tests_user_created ON tests (user_id, created_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tests_subject_topic ON tests (subject, topic)")
+    # Покрывающий индекс для спроса банка вопросов за последние дни.
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_tests_created_combo
+    ON tests (created_at, subject, topic, grade, language, qtype)
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS stats_counters (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS artifacts (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        created_at REAL NOT NULL,
+        last_access REAL NOT NULL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_artifacts_last_access ON artifacts (last_access)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS gemini_cache (
+        key TEXT PRIMARY KEY,
+        payload BLOB NOT NULL,
+        created_at REAL NOT NULL
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS wiki_cache (
+        key TEXT PRIMARY KEY,
+        payload BLOB NOT NULL,
+        created_at REAL NOT NULL,
+        last_access REAL NOT NULL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_wiki_cache_last_access ON wiki_cache (last_access)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS question_bank (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        combo TEXT NOT NULL,
+        qhash TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        UNIQUE (combo, qhash)
     )
     """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS gemini_usage (
+        day TEXT NOT NULL,
+        user_id INTEGER NOT NULL DEFAULT 0,
+        feature TEXT NOT NULL,
+        requests INTEGER NOT NULL DEFAULT 0,
+        prompt_tokens INTEGER NOT NULL DEFAULT 0,
+        output_tokens INTEGER NOT NULL DEFAULT 0,
+        questions INTEGER NOT NULL DEFAULT 0,
+        latency_ms INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, user_id, feature)
+    )
+    """)
+    cur.executescript(_STATS_TRIGGERS)
+    seeded = cur.execute("SELECT 1 FROM stats_counters LIMIT 1").fetchone()
     conn.commit()
-    conn.close()
+    if not seeded:
+        reconcile_counters()
+
+# Архив тестов: метаданные лежат в отдельных колонках для индексов,
+# сами вопросы — сжатым zlib JSON в payload.
+_TESTS_ARCHIVE_COLUMNS = {
+    "subject": "TEXT",
+    "topic": "TEXT",
+    "grade": "TEXT",
+    "language": "TEXT",
+    "qtype": "TEXT",
+    "n_questions": "INTEGER",
+    "payload": "BLOB",
+    "payload_size": "INTEGER",
+}
+
+def _migrate_tests_table(cur: sqlite3.Cursor) -> None:
+    existing = {row[1] for row in cur.execute("PRAGMA table_info(tests)")}
+    for name, decl in _TESTS_ARCHIVE_COLUMNS.items():
+        if name not in existing:
+            cur.execute(f"ALTER TABLE tests ADD COLUMN {name} {decl}")
+    # Раньше tests ссылалась на users с ON DELETE CASCADE, и удаление пользователя
+    # стирало его архив. Ограничение в SQLite не снять ALTER-ом — пересобираем таблицу.
+    if cur.execute("PRAGMA foreign_key_list(tests)").fetchall():
+        columns = ", ".join(["id", "user_id", "meta", "tests", "created_at", *_TESTS_ARCHIVE_COLUMNS])
+        decls = ",\n".join(f"        {name} {decl}" for name, decl in _TESTS_ARCHIVE_COLUMNS.items())
+        cur.execute("DROP TABLE IF EXISTS tests_rebuild")
+        cur.execute(f"""
+        CREATE TABLE tests_rebuild (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            meta TEXT,
+            tests TEXT,
+            created_at TEXT,
+{decls}
+        )
+        """)
+        cur.execute(f"INSERT INTO tests_rebuild ({columns}) SELECT {columns} FROM tests")
+        cur.execute("DROP TABLE tests")
+        cur.execute("ALTER TABLE tests_rebuild RENAME TO tests")
+        cur.connection.commit()
+
+# Счётчики статистики ведутся триггерами в той же транзакции, что и запись,
+# поэтому /stats читает готовые значения. reconcile_counters() пересчитывает
+# их с нуля на случай расхождений.
+def _bump(key_expr: str, delta_expr: str) -> str:
+    return (
+        f"INSERT INTO stats_counters (key, value) VALUES ({key_expr}, {delta_expr}) "
+        "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value;"
+    )
+
+_TEST_BYTES = "COALESCE({row}.payload_size, length({row}.tests), 0) + COALESCE(length({row}.meta), 0)"
+
+_STATS_TRIGGERS = f"""
+CREATE TRIGGER IF NOT EXISTS trg_users_insert_stats AFTER INSERT ON users BEGIN
+    {_bump("'users_total'", "1")}
+    {_bump("'users_accepted'", "NEW.accepted != 0")}
+END;
+CREATE TRIGGER IF NOT EXISTS trg_users_delete_stats AFTER DELETE ON users BEGIN
+    {_bump("'users_total'", "-1")}
+    {_bump("'users_accepted'", "-(OLD.accepted != 0)")}
+END;
+CREATE TRIGGER IF NOT EXISTS trg_users_accepted_stats AFTER UPDATE OF accepted ON users
+WHEN (OLD.accepted != 0) != (NEW.accepted != 0) BEGIN
+    {_bump("'users_accepted'", "(NEW.accepted != 0) - (OLD.accepted != 0)")}
+END;
+CREATE TRIGGER IF NOT EXISTS trg_tests_insert_stats AFTER INSERT ON tests BEGIN
+    {_bump("'tests_total'", "1")}
+    {_bump("'tests_day:' || substr(NEW.created_at, 1, 10)", "1")}
+    {_bump("'tests_subject:' || COALESCE(NEW.subject, '')", "1")}
+    {_bump("'tests_qtype:' || COALESCE(NEW.qtype, '')", "1")}
+    {_bump("'bytes_stored'", _TEST_BYTES.format(row="NEW"))}
+END;
+CREATE TRIGGER IF NOT EXISTS trg_tests_delete_stats AFTER DELETE ON tests BEGIN
+    {_bump("'tests_total'", "-1")}
+    {_bump("'tests_day:' || substr(OLD.created_at, 1, 10)", "-1")}
+    {_bump("'tests_subject:' || COALESCE(OLD.subject, '')", "-1")}
+    {_bump("'tests_qtype:' || COALESCE(OLD.qtype, '')", "-1")}
+    {_bump("'bytes_stored'", "-(" + _TEST_BYTES.format(row="OLD") + ")")}
+END;
+CREATE TRIGGER IF NOT EXISTS trg_artifacts_insert_stats AFTER INSERT ON artifacts BEGIN
+    {_bump("'artifacts_bytes'", "NEW.size")}
+END;
+CREATE TRIGGER IF NOT EXISTS trg_artifacts_delete_stats AFTER DELETE ON artifacts BEGIN
+    {_bump("'artifacts_bytes'", "-OLD.size")}
+END;
+CREATE TRIGGER IF NOT EXISTS trg_artifacts_update_stats AFTER UPDATE OF size ON artifacts BEGIN
+    {_bump("'artifacts_bytes'", "NEW.size - OLD.size")}
+END;
+"""
+
+_CUMULATIVE_COUNTERS = {"artifacts_reclaimed_bytes", "artifacts_removed"}
+
+def bump_counter(conn: sqlite3.Connection, key: str, delta: int) -> None:
+    conn.execute(
+        "INSERT INTO stats_counters (key, value) VALUES (?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+        (key, delta)
+    )
+
+def get_counters(prefix: Optional[str] = None) -> Dict[str, int]:
+    conn = get_connection()
+    if prefix:
+        rows = conn.execute(
+            "SELECT key, value FROM stats_counters WHERE key >= ? AND key < ?",
+            (prefix, prefix + "\uffff")
+        ).fetchall()
+    else:
+        rows = conn.execute("SELECT key, value FROM stats_counters").fetchall()
+    return {r["key"]: r["value"] for r in rows}
+
+def get_counter_values(keys: List[str]) -> Dict[str, int]:
+    """Значения только перечисленных счётчиков; отсутствующие — 0."""
+    if not keys:
+        return {}
+    rows = get_connection().execute(
+        f"SELECT key, value FROM stats_counters WHERE key IN ({', '.join('?' * len(keys))})", keys
+    ).fetchall()
+    values = dict.fromkeys(keys, 0)
+    values.update((r["key"], r["value"]) for r in rows)
+    return values
+
+def top_counters(prefix: str, limit: int) -> List[Tuple[str, int]]:
+    """Наибольшие положительные счётчики с данным префиксом, без префикса в имени."""
+    rows = get_connection().execute(
+        "SELECT key, value FROM stats_counters WHERE key >= ? AND key < ? AND value > 0 "
+        "ORDER BY value DESC LIMIT ?",
+        (prefix, prefix + "\uffff", limit)
+    ).fetchall()
+    return [(r["key"][len(prefix):], r["value"]) for r in rows]
+
+def reconcile_counters() -> Dict[str, int]:
+    """Пересчитывает stats_counters по таблицам. Возвращает поправки (ключ -> разница)."""
+    conn = get_connection()
+    with conn:
+        before = {r["key"]: r["value"] for r in conn.execute("SELECT key, value FROM stats_counters")}
+        conn.execute("DELETE FROM stats_counters")
+        conn.execute("""
+            INSERT INTO stats_counters (key, value)
+            SELECT 'users_total', COUNT(*) FROM users
+            UNION ALL SELECT 'users_accepted', COUNT(*) FROM users WHERE accepted != 0
+            UNION ALL SELECT 'tests_total', COUNT(*) FROM tests
+            UNION ALL SELECT 'bytes_stored', COALESCE(SUM(""" + _TEST_BYTES.format(row="tests") + """), 0) FROM tests
+            UNION ALL SELECT 'tests_day:' || substr(created_at, 1, 10), COUNT(*) FROM tests GROUP BY 1
+            UNION ALL SELECT 'tests_subject:' || COALESCE(subject, ''), COUNT(*) FROM tests GROUP BY 1
+            UNION ALL SELECT 'tests_qtype:' || COALESCE(qtype, ''), COUNT(*) FROM tests GROUP BY 1
+            UNION ALL SELECT 'artifacts_bytes', COALESCE(SUM(size), 0) FROM artifacts
+        """)
+        # Накопительные счётчики не выводятся из таблиц — переносим как есть.
+        conn.executemany(
+            "INSERT OR REPLACE INTO stats_counters (key, value) VALUES (?, ?)",
+            [(k, v) for k, v in before.items() if k in _CUMULATIVE_COUNTERS]
+        )
+        after = {r["key"]: r["value"] for r in conn.execute("SELECT key, value FROM stats_counters")}
+    drift = {}
+    for key in set(before) | set(after):
+        diff = after.get(key, 0) - before.get(key, 0)
+        if diff:
+            drift[key] = diff
+    return drift
+
+def pack_payload(obj: Any) -> bytes:
+    raw = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return zlib.compress(raw, 6)
+
+def unpack_payload(blob: Optional[bytes]) -> Any:
+    if not blob:
+        return None
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
 
 def add_or_update_user(user_id: int, username: Optional[str], phone: Optional[str], accepted: bool = False):
     now = datetime.utcnow().isoformat()
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM users WHERE id = ?", (user_id,))
-    row = cur.fetchone()
-    if row:
-        cur.execute("""
-            UPDATE users
-            SET username = ?, phone = ?, accepted = ?, updated_at = ?
-            WHERE id = ?
-        """, (username, phone, int(bool(accepted)), now, user_id))
-    else:
-        cur.execute("""
+    with conn:
+        conn.execute("""
             INSERT INTO users (id, username, phone, accepted, created_at)
             VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                username = excluded.username,
+                phone = excluded.phone,
+                accepted = excluded.accepted,
+                updated_at = excluded.created_at
         """, (user_id, username, phone, int(bool(accepted)), now))
-    conn.commit()
-    conn.close()
 
 def get_user(user_id: int) -> Optional[Dict[str, Any]]:
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, username, phone, accepted, created_at, updated_at FROM users WHERE id = ?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
+    row = conn.execute("SELECT id, username, phone, accepted, created_at, updated_at FROM users WHERE id = ?", (user_id,)).fetchone()
     if row:
         return {
             "id": row["id"],
@@ -83,10 +348,7 @@ def get_user(user_id: int) -> Optional[Dict[str, Any]]:
 
 def list_users() -> List[Dict[str, Any]]:
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, username, phone, accepted, created_at, updated_at FROM users")
-    rows = cur.fetchall()
-    conn.close()
+    rows = conn.execute("SELECT id, username, phone, accepted, created_at, updated_at FROM users").fetchall()
     return [
         {
             "id": r["id"],
@@ -99,19 +361,129 @@ def list_users() -> List[Dict[str, Any]]:
         for r in rows
     ]
 
+TEST_INSERT_COLUMNS = ("user_id", "meta", "created_at", "subject", "topic", "grade", "language",
+                       "qtype", "n_questions", "payload", "payload_size")
+
+def build_test_row(user_id: int, meta: dict, tests: list, created_at: Optional[str] = None) -> tuple:
+    """Значения колонок TEST_INSERT_COLUMNS для одной записи архива."""
+    meta = meta or {}
+    payload = pack_payload(tests)
+    return (
+        user_id,
+        json.dumps(meta, ensure_ascii=False, separators=(",", ":")),
+        created_at or datetime.utcnow().isoformat(),
+        meta.get("subject"),
+        meta.get("topic"),
+        meta.get("grade"),
+        meta.get("language"),
+        meta.get("qtype"),
+        len(tests or []),
+        payload,
+        len(payload),
+    )
+
+def insert_test(conn: sqlite3.Connection, user_id: int, meta: dict, tests: list,
+                created_at: Optional[str] = None) -> int:
+    """Добавляет тест в архив в рамках уже открытой транзакции."""
+    placeholders = ", ".join("?" * len(TEST_INSERT_COLUMNS))
+    cur = conn.execute(
+        f"INSERT INTO tests ({', '.join(TEST_INSERT_COLUMNS)}) VALUES ({placeholders})",
+        build_test_row(user_id, meta, tests, created_at)
+    )
+    return cur.lastrowid
+
 def save_test(user_id: int, meta: dict, tests: list) -> int:
-    now = datetime.utcnow().isoformat()
-    meta_json = json.dumps(meta, ensure_ascii=False)
-    tests_json = json.dumps(tests, ensure_ascii=False)
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO tests (user_id, meta, tests, created_at)
-        VALUES (?, ?, ?, ?)
-    """, (user_id, meta_json, tests_json, now))
-    last_id = cur.lastrowid
-    conn.commit()
-    conn.close()
-    return last_id
+    with conn:
+        return insert_test(conn, user_id, meta, tests)
+
+def _test_row_to_dict(row: sqlite3.Row, with_tests: bool) -> Dict[str, Any]:
+    item = {
+        "id": row["id"],
+        "user_id": row["user_id"],
+        "meta": json.loads(row["meta"]) if row["meta"] else {},
+        "created_at": row["created_at"],
+        "n_questions": row["n_questions"],
+    }
+    if with_tests:
+        if row["payload"] is not None:
+            item["tests"] = unpack_payload(row["payload"])
+        else:
+            item["tests"] = json.loads(row["tests"]) if row["tests"] else []
+    return item
+
+def get_test(test_id: int) -> Optional[Dict[str, Any]]:
+    conn = get_connection()
+    row = conn.execute("SELECT * FROM tests WHERE id = ?", (test_id,)).fetchone()
+    return _test_row_to_dict(row, with_tests=True) if row else None
+
+def list_user_tests(user_id: int, limit: int = 10,
+                    before: Optional[Tuple[str, int]] = None) -> Tuple[List[Dict[str, Any]], Optional[Tuple[str, int]]]:
+    """Последние тесты пользователя с keyset-пагинацией.
+
+    before — курсор (created_at, id), возвращённый предыдущим вызовом.
+    Возвращает (тесты без payload, курсор следующей страницы или None).
+    """
+    conn = get_connection()
+    columns = "id, user_id, meta, created_at, n_questions"
+    if before:
+        rows = conn.execute(f"""
+            SELECT {columns} FROM tests
+            WHERE user_id = ? AND (created_at, id) < (?, ?)
+            ORDER BY created_at DESC, id DESC LIMIT ?
+        """, (user_id, before[0], before[1], limit)).fetchall()
+    else:
+        rows = conn.execute(f"""
+            SELECT {columns} FROM tests
+            WHERE user_id = ?
+            ORDER BY created_at DESC, id DESC LIMIT ?
+        """, (user_id, limit)).fetchall()
+    items = [_test_row_to_dict(r, with_tests=False) for r in rows]
+    next_cursor = (rows[-1]["created_at"], rows[-1]["id"]) if len(rows) == limit else None
+    return items, next_cursor
+
+def count_tests() -> int:
+    conn = get_connection()
+    return conn.execute("SELECT COUNT(*) FROM tests").fetchone()[0]
+
+def add_usage(conn: sqlite3.Connection, user_id: Optional[int], feature: str, requests: int,
+              prompt_tokens: int, output_tokens: int, questions: int, latency_ms: int,
+              day: Optional[str] = None) -> None:
+    """Добавляет запросы к Gemini в дневную сводку в рамках уже открытой транзакции."""
+    conn.execute("""
+        INSERT INTO gemini_usage (day, user_id, feature, requests, prompt_tokens, output_tokens,
+                                  questions, latency_ms)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(day, user_id, feature) DO UPDATE SET
+            requests = requests + excluded.requests,
+            prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+            output_tokens = output_tokens + excluded.output_tokens,
+            questions = questions + excluded.questions,
+            latency_ms = latency_ms + excluded.latency_ms
+    """, (day or datetime.utcnow().strftime("%Y-%m-%d"), user_id or 0, feature,
+          requests, prompt_tokens, output_tokens, questions, latency_ms))
+
+def record_usage(user_id: Optional[int], feature: str, requests: int, prompt_tokens: int,
+                 output_tokens: int, questions: int, latency_ms: int, day: Optional[str] = None) -> None:
+    """Добавляет запросы к Gemini в дневную сводку по пользователю и функции."""
+    conn = get_connection()
+    with conn:
+        add_usage(conn, user_id, feature, requests, prompt_tokens, output_tokens, questions, latency_ms, day)
+
+def get_usage(since_day: str, by: str = "feature", limit: int = 10) -> List[Dict[str, Any]]:
+    """Сводка расхода токенов с даты since_day, сгруппированная по feature или user_id."""
+    if by not in ("feature", "user_id"):
+        raise ValueError(f"Недопустимая группировка: {by}")
+    conn = get_connection()
+    rows = conn.execute(f"""
+        SELECT {by} AS name, SUM(requests) AS requests, SUM(prompt_tokens) AS prompt_tokens,
+               SUM(output_tokens) AS output_tokens, SUM(questions) AS questions,
+               SUM(latency_ms) AS latency_ms
+        FROM gemini_usage WHERE day >= ?
+        GROUP BY {by}
+        ORDER BY SUM(prompt_tokens) + SUM(output_tokens) DESC
+        LIMIT ?
+    """, (since_day, limit)).fetchall()
+    return [dict(r) for r in rows]
 
 init_db()
\ No newline at end of file
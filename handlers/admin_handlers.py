@@ -1,80 +1,266 @@
-import os
 import asyncio
+import tempfile
 import logging
 from datetime import datetime
+from html import escape
+from typing import List, Optional, Tuple
 from aiogram import types, Dispatcher
 from aiogram.dispatcher import FSMContext
 
 from core.bot import bot, dp
 from states.states import AdminStates
-from database.database_manager import DatabaseManager
-from utils.utils import get_directory_size
-from config.config import DATA_DIR, ADMIN
+from database.storage import storage
+from api.gemini_api import GeminiAPI
+from api.gemini_cache import gemini_cache
+from api.wiki_cache import wiki_cache
+from managers.question_bank import QuestionBank
+from managers.wikipedia_manager import WikipediaManager
+from config.config import ADMIN
+from utils.utils import GEMINI_LIMITER, GEMINI_BREAKER
 
 logger = logging.getLogger("tg-edu-bot")
 
 def register_admin_handlers(dp: Dispatcher):
     dp.register_message_handler(cmd_list_users, commands=["users"])
     dp.register_message_handler(cmd_stats, commands=["stats"])
+    dp.register_message_handler(cmd_usage, commands=["usage"])
     dp.register_message_handler(cmd_broadcast, commands=["broadcast"])
+    dp.register_callback_query_handler(admin_users_cb, lambda c: c.data and c.data.startswith("admin_users:"))
     dp.register_callback_query_handler(admin_callbacks, lambda c: c.data and c.data.startswith("admin:"))
     dp.register_message_handler(admin_broadcast_text, state=AdminStates.broadcast_text)
     dp.register_message_handler(admin_broadcast_photo, content_types=types.ContentType.PHOTO, state=AdminStates.broadcast_photo)
 
+USERS_PAGE_SIZE = 20
+USERS_EXPORT_SPOOL_SIZE = 1024 * 1024
+
+
+def _parse_users_args(args: str) -> Tuple[bool, bool, Optional[str]]:
+    """Разбирает аргументы /users: export, accepted, since=ГГГГ-ММ-ДД."""
+    export = False
+    accepted_only = False
+    since = None
+    for token in (args or "").split():
+        token = token.lower()
+        if token in ("export", "csv"):
+            export = True
+        elif token == "accepted":
+            accepted_only = True
+        elif token.startswith("since="):
+            since = datetime.strptime(token.split("=", 1)[1], "%Y-%m-%d").strftime("%Y-%m-%d")
+        else:
+            raise ValueError(token)
+    return export, accepted_only, since
+
+
+def _users_filter_suffix(accepted_only: bool, since: Optional[str]) -> str:
+    return f"{int(accepted_only)}:{since or ''}"
+
+
+def _render_users_page(users: List[dict], has_prev: bool, has_next: bool,
+                       accepted_only: bool, since: Optional[str]) -> Tuple[str, types.InlineKeyboardMarkup]:
+    lines = []
+    for user in users:
+        lines.append(
+            f"{user['id']} | @{escape(user.get('username') or 'Нет')} | {escape(user.get('phone') or 'Нет')} | "
+            f"Принял: {user.get('accepted', False)} | {user.get('registered_at') or 'Неизвестно'}"
+        )
+    filters = []
+    if accepted_only:
+        filters.append("только принявшие")
+    if since:
+        filters.append(f"с {since}")
+    header = "<b>Список пользователей</b>"
+    if filters:
+        header += f" ({', '.join(filters)})"
+    text = header + ":\n\n" + "\n".join(lines)
+
+    suffix = _users_filter_suffix(accepted_only, since)
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    nav_buttons = []
+    if has_prev:
+        nav_buttons.append(types.InlineKeyboardButton(
+            "◀️ Назад", callback_data=f"admin_users:p:{users[0]['id']}:{suffix}"
+        ))
+    if has_next:
+        nav_buttons.append(types.InlineKeyboardButton(
+            "Вперёд ▶️", callback_data=f"admin_users:n:{users[-1]['id']}:{suffix}"
+        ))
+    if nav_buttons:
+        kb.row(*nav_buttons)
+    kb.add(types.InlineKeyboardButton("📥 Выгрузить CSV", callback_data=f"admin_users:x:0:{suffix}"))
+    return text, kb
+
+
+async def _send_users_export(chat_id: int, accepted_only: bool, since: Optional[str]) -> None:
+    # Пишем CSV порциями в SpooledTemporaryFile: небольшие выгрузки остаются в памяти,
+    # крупные уходят во временный файл, и память не растёт с числом пользователей.
+    with tempfile.SpooledTemporaryFile(max_size=USERS_EXPORT_SPOOL_SIZE) as buf:
+        count = await storage.export_users_csv(buf, accepted_only, since)
+        if not count:
+            await bot.send_message(chat_id, "Список пользователей пуст.")
+            return
+        await bot.send_document(
+            chat_id,
+            types.InputFile(buf, filename=f"users_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.csv"),
+            caption=f"Полный список пользователей: {count}"
+        )
+
+
 async def cmd_list_users(message: types.Message):
     if message.from_user.id != ADMIN:
         await message.answer("Доступ запрещен.")
         return
 
-    users = DatabaseManager.list_users()
+    try:
+        export, accepted_only, since = _parse_users_args(message.get_args())
+    except ValueError:
+        await message.answer(
+            "Использование: /users [accepted] [since=ГГГГ-ММ-ДД] [export]\n"
+            "export — выгрузить CSV вместо постраничного просмотра."
+        )
+        return
+
+    if export:
+        await _send_users_export(message.chat.id, accepted_only, since)
+        return
+
+    users, has_next = await storage.list_users_page(
+        limit=USERS_PAGE_SIZE, accepted_only=accepted_only, since=since
+    )
     if not users:
         await message.answer("Список пользователей пуст.")
         return
 
-    lines = []
-    for user in users:
-        user_id = user.get('id', 'N/A')
-        username = user.get('username', 'Нет')
-        phone = user.get('phone', 'Нет')
-        accepted = user.get('accepted', False)
-        registered = user.get('registered_at', 'Неизвестно')
+    text, kb = _render_users_page(users, False, has_next, accepted_only, since)
+    await message.answer(text, reply_markup=kb)
 
-        lines.append(f"{user_id} | @{username} | {phone} | Принял: {accepted} | {registered}")
 
-    text = "<b>Список пользователей:</b>\n\n" + "\n".join(lines)
+async def admin_users_cb(query: types.CallbackQuery):
+    await query.answer()
 
-    if len(text) <= 4000:
-        await message.answer(text)
+    if query.from_user.id != ADMIN:
+        await query.answer("Доступ запрещен.", show_alert=True)
+        return
+
+    try:
+        _, direction, cursor, accepted_flag, since = query.data.split(":", 4)
+        cursor = int(cursor)
+        accepted_only = accepted_flag == "1"
+        since = since or None
+    except ValueError:
+        await query.answer("Неверные данные страницы.", show_alert=True)
+        return
+
+    if direction == "x":
+        await _send_users_export(query.from_user.id, accepted_only, since)
+        return
+
+    if direction == "p":
+        users, has_more = await storage.list_users_page(
+            before_id=cursor, limit=USERS_PAGE_SIZE, accepted_only=accepted_only, since=since
+        )
+        has_prev, has_next = has_more, True
     else:
-        filename = os.path.join(DATA_DIR, f"users_list_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.txt")
-        with open(filename, "w", encoding="utf-8") as f:
-            f.write("\n".join(lines))
-
-        with open(filename, "rb") as f:
-            await bot.send_document(
-                message.from_user.id,
-                types.InputFile(f, filename=os.path.basename(filename)),
-                caption="Полный список пользователей"
-            )
-        os.remove(filename)
+        users, has_more = await storage.list_users_page(
+            after_id=cursor, limit=USERS_PAGE_SIZE, accepted_only=accepted_only, since=since
+        )
+        has_prev, has_next = True, has_more
 
-async def cmd_stats(message: types.Message):
+    if not users:
+        await query.answer("Больше пользователей нет.", show_alert=True)
+        return
+
+    text, kb = _render_users_page(users, has_prev, has_next, accepted_only, since)
+    try:
+        await bot.edit_message_text(text, query.message.chat.id, query.message.message_id, reply_markup=kb)
+    except Exception as e:
+        logger.exception("Не удалось обновить страницу пользователей: %s", e)
+
+def _usage_line(name: str, row: dict) -> str:
+    tokens = row["prompt_tokens"] + row["output_tokens"]
+    line = (f"   • {name}: запросов {row['requests']}, токенов {tokens} "
+            f"(вход {row['prompt_tokens']}, выход {row['output_tokens']})")
+    if row["questions"]:
+        line += (f", на вопрос {tokens / row['questions']:.0f} ток. и "
+                 f"{row['latency_ms'] / row['questions'] / 1000:.1f} с")
+    return line
+
+
+async def cmd_usage(message: types.Message):
     if message.from_user.id != ADMIN:
         await message.answer("Доступ запрещен.")
         return
 
-    users = DatabaseManager.list_users()
-    total_users = len(users)
-    accepted_users = len([u for u in users if u.get('accepted')])
+    arg = (message.get_args() or "").strip()
+    days = int(arg) if arg.isdigit() and int(arg) > 0 else 1
+    usage = await storage.get_usage(days)
+
+    features = "\n".join(_usage_line(escape(r["name"]), r) for r in usage["by_feature"]) or "   —"
+    users = "\n".join(
+        _usage_line("система" if not r["name"] else f"<code>{r['name']}</code>", r) for r in usage["by_user"]
+    ) or "   —"
+    await message.answer(
+        f"<b>Расход Gemini с {usage['since']}</b>\n\n"
+        f"По функциям:\n{features}\n\n"
+        f"Больше всего у пользователей:\n{users}"
+    )
+
+
+async def cmd_stats(message: types.Message):
+    if message.from_user.id != ADMIN:
+        await message.answer("Доступ запрещен.")
+        return
 
-    test_files = [f for f in os.listdir(DATA_DIR) if f.startswith('tests_') and f.endswith('.json')]
+    stats = await storage.get_stats()
+    user_cache = storage.user_cache_stats()
+    cache_stats = gemini_cache.stats()
+    wiki_stats = wiki_cache.stats()
+    wiki_lookup = WikipediaManager.cache_stats()
+    gen_stats = GeminiAPI.generation_stats
+    limiter_stats = GEMINI_LIMITER.stats()
+    breaker_stats = GEMINI_BREAKER.stats()
+    bank_stats = await storage.run(QuestionBank.stats)
+    breaker_state = {
+        "closed": "работает",
+        "half_open": "пробный запрос",
+        "open": f"разомкнут, ещё {breaker_stats['retry_in']:.0f} с"
+    }[breaker_stats["state"]]
+
+    subjects = "\n".join(f"   • {escape(name)}: {count}" for name, count in stats["tests_by_subject"]) or "   —"
+    qtypes = ", ".join(f"{escape(name)}: {count}" for name, count in stats["tests_by_qtype"].items()) or "—"
 
     text = (
         f"<b>Статистика бота</b>\n\n"
-        f"👥 Всего пользователей: <b>{total_users}</b>\n"
-        f"✅ Зарегистрированных: <b>{accepted_users}</b>\n"
-        f"📊 Файлов тестов: <b>{len(test_files)}</b>\n"
-        f"💾 Размер данных: <b>{get_directory_size(DATA_DIR) / 1024 / 1024:.2f} MB</b>"
+        f"👥 Всего пользователей: <b>{stats['users_total']}</b>\n"
+        f"✅ Зарегистрированных: <b>{stats['users_accepted']}</b>\n"
+        f"👤 Кэш профилей: попаданий <b>{user_cache['hit_ratio'] * 100:.1f}%</b> "
+        f"({user_cache['hits']}/{user_cache['hits'] + user_cache['misses']}), "
+        f"в памяти {user_cache['size']}/{user_cache['maxsize']}, вытеснено {user_cache['evictions']}\n"
+        f"📊 Тестов в архиве: <b>{stats['tests_total']}</b> (сегодня: {stats['tests_today']})\n"
+        f"📚 Популярные предметы:\n{subjects}\n"
+        f"🧩 Типы вопросов: {qtypes}\n"
+        f"💾 Архив тестов: <b>{stats['bytes_stored'] / 1024 / 1024:.2f} MB</b>, "
+        f"файл БД: <b>{stats['db_size'] / 1024 / 1024:.2f} MB</b>\n"
+        f"📄 Документы: <b>{stats['artifacts_bytes'] / 1024 / 1024:.2f} MB</b>, "
+        f"очищено сборщиком: <b>{stats['artifacts_reclaimed_bytes'] / 1024 / 1024:.2f} MB</b>\n"
+        f"🧠 Кэш ответов ИИ: попаданий <b>{cache_stats['hit_ratio'] * 100:.1f}%</b> "
+        f"(память {cache_stats['memory_hits']}, диск {cache_stats['disk_hits']}, "
+        f"промахов {cache_stats['misses']}, объединено запросов {cache_stats['coalesced']})\n"
+        f"🩹 Дозапросы: <b>{gen_stats['topups']}</b>, сохранено вопросов {gen_stats['salvaged']}, "
+        f"~{gen_stats['tokens_saved']} токенов и {gen_stats['seconds_saved']:.1f} с\n"
+        f"🚦 Запросы к ИИ: лимит <b>{limiter_stats['limit']}</b>, в работе {limiter_stats['in_flight']}, "
+        f"в очереди {limiter_stats['queued']}, ожидание в среднем {limiter_stats['avg_wait']:.1f} с "
+        f"(макс. {limiter_stats['max_wait']:.1f} с), ответов 429/503 {limiter_stats['throttled']}\n"
+        f"🔌 Предохранитель ИИ: <b>{breaker_state}</b>, сбоев подряд {breaker_stats['failures']}, "
+        f"срабатываний {breaker_stats['trips']}, отклонено запросов {breaker_stats['rejected']}\n"
+        f"🏦 Банк вопросов: <b>{bank_stats['size']}</b>, выдано тестов {bank_stats['hits']} "
+        f"({bank_stats['hit_ratio'] * 100:.1f}%), сгенерировано в фоне {bank_stats['generated']}\n"
+        f"📘 Кэш статей Википедии: попаданий <b>{wiki_stats['hit_ratio'] * 100:.1f}%</b> "
+        f"(память {wiki_stats['memory_hits']}, диск {wiki_stats['disk_hits']}, промахов {wiki_stats['misses']})\n"
+        f"🔎 Кэш Википедии: поиск {wiki_lookup['search']['hits']}/"
+        f"{wiki_lookup['search']['hits'] + wiki_lookup['search']['misses']} попаданий, "
+        f"страницы {wiki_lookup['pages']['hits']}/"
+        f"{wiki_lookup['pages']['hits'] + wiki_lookup['pages']['misses']}"
     )
 
     await message.answer(text)
@@ -128,7 +314,7 @@ async def admin_broadcast_text(message: types.Message, state: FSMContext):
         await message.answer("Доступ запрещен.")
         return
 
-    users = DatabaseManager.list_users()
+    users = await storage.list_users()
     total_sent = 0
     failed = 0
 
@@ -178,7 +364,7 @@ async def admin_broadcast_photo(message: types.Message, state: FSMContext):
     photo = message.photo[-1].file_id
     caption = message.caption or ""
 
-    users = DatabaseManager.list_users()
+    users = await storage.list_users()
     total_sent = 0
     failed = 0
 
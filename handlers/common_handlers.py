@@ -6,7 +6,7 @@ from aiogram.dispatcher import FSMContext
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 from core.bot import bot, dp
-from database.database_manager import DatabaseManager
+from database.storage import storage
 from managers.keyboard_manager import KeyboardManager
 from utils.utils import pending_contacts, safe_state_transaction
 from config.config import ADMIN
@@ -25,7 +25,7 @@ def register_common_handlers(dp: Dispatcher):
 
 async def cmd_start(message: types.Message):
     try:
-        user = DatabaseManager.get_user(message.from_user.id)
+        user = await storage.get_user(message.from_user.id)
         accepted = bool(user and user.get("accepted"))
         greeting = (
             f"👋 <b>Добро пожаловать, {message.from_user.full_name or message.from_user.username or 'Пользователь'}!</b>\n\n"
@@ -62,7 +62,7 @@ async def cb_help(query: types.CallbackQuery):
             "   - Получите новые варианты в Word — идеально для создания альтернативных тестов без плагиата.\n\n"
             "Если возникнут проблемы, обратитесь к администратору. Наслаждайтесь использованием! 🚀"
         )
-        user = DatabaseManager.get_user(query.from_user.id)
+        user = await storage.get_user(query.from_user.id)
         user_accepted = bool(user and user.get("accepted"))
         await bot.send_message(query.from_user.id, text, reply_markup=KeyboardManager.get_main_kb(user_accepted))
     except Exception as e:
@@ -123,7 +123,7 @@ async def cb_accept_privacy(query: types.CallbackQuery):
         if not pending:
             await query.answer("Данные контакта не найдены. Отправьте контакт заново.", show_alert=True)
             return
-        DatabaseManager.add_or_update_user(
+        await storage.add_or_update_user(
             uid,
             pending.get("username", ""),
             pending.get("phone", ""),
@@ -162,7 +162,7 @@ async def cb_cancel(query: types.CallbackQuery, state: FSMContext):
     try:
         async with safe_state_transaction(state):
             await state.finish()
-            user = DatabaseManager.get_user(query.from_user.id)
+            user = await storage.get_user(query.from_user.id)
             user_accepted = bool(user and user.get("accepted"))
             await bot.send_message(
                 query.from_user.id,
@@ -175,7 +175,7 @@ async def cb_cancel(query: types.CallbackQuery, state: FSMContext):
 
 async def fallback_handler(message: types.Message):
     try:
-        user = DatabaseManager.get_user(message.from_user.id)
+        user = await storage.get_user(message.from_user.id)
         user_accepted = bool(user and user.get("accepted"))
         await message.answer(
             "Я не понял ваш запрос. Используйте кнопки в меню или команду /start для начала работы.",
@@ -1,18 +1,22 @@
 import os
+import time
 import logging
 from datetime import datetime
+from html import escape
 from aiogram import types, Dispatcher
 from aiogram.dispatcher import FSMContext
 from aiogram.types import InputFile
 
 from core.bot import bot, dp
 from states.states import States
-from database.database_manager import DatabaseManager
+from database.storage import storage
 from api.gemini_api import GeminiAPI
 from api.image_generator import ImageGenerator
 from api.document_generator import DocumentGenerator
 from managers.keyboard_manager import KeyboardManager
 from managers.progress_manager import ProgressManager
+from managers.artifact_manager import ArtifactManager
+from managers.question_bank import QuestionBank
 from utils.utils import user_exports, safe_state_transaction
 from config.config import DATA_DIR
 
@@ -32,7 +36,7 @@ def register_gen_handlers(dp: Dispatcher):
 async def cb_start_gen(query: types.CallbackQuery):
     await query.answer()
 
-    user = DatabaseManager.get_user(query.from_user.id)
+    user = await storage.get_user(query.from_user.id)
     if not user or not user.get("accepted"):
         await bot.send_message(
             query.from_user.id,
@@ -53,7 +57,7 @@ async def subject_handler(message: types.Message, state: FSMContext):
 
     if text.lower() == "отмена":
         await state.finish()
-        user_accepted = bool(DatabaseManager.get_user(message.from_user.id))
+        user_accepted = bool(await storage.get_user(message.from_user.id))
         await message.answer("Генерация отменена.", reply_markup=KeyboardManager.get_main_kb(user_accepted))
         return
 
@@ -69,7 +73,7 @@ async def topic_handler(message: types.Message, state: FSMContext):
 
     if text.lower() == "отмена":
         await state.finish()
-        user_accepted = bool(DatabaseManager.get_user(message.from_user.id))
+        user_accepted = bool(await storage.get_user(message.from_user.id))
         await message.answer("Генерация отменена.", reply_markup=KeyboardManager.get_main_kb(user_accepted))
         return
 
@@ -85,7 +89,7 @@ async def grade_handler(message: types.Message, state: FSMContext):
 
     if text.lower() == "отмена":
         await state.finish()
-        user_accepted = bool(DatabaseManager.get_user(message.from_user.id))
+        user_accepted = bool(await storage.get_user(message.from_user.id))
         await message.answer("Генерация отменена.", reply_markup=KeyboardManager.get_main_kb(user_accepted))
         return
 
@@ -101,7 +105,7 @@ async def count_selected(query: types.CallbackQuery, state: FSMContext):
 
     try:
         count = int(query.data.split(":", 1)[1])
-        if count not in (5, 10, 15):
+        if count not in (5, 10, 15, 20, 30):
             await query.answer("Недопустимое количество вопросов.", show_alert=True)
             return
 
@@ -176,9 +180,31 @@ async def confirm_gen(query: types.CallbackQuery, state: FSMContext):
             "🛠 Формирую запрос для ИИ-модели...", "🚀"
         )
 
-        tests, raw_response = await GeminiAPI.call_gemini(
-            subject, topic, grade, language, count, qtype=qtype
-        )
+        last_edit = 0.0
+
+        async def on_question(test: dict, total: int):
+            # Telegram ограничивает частоту правок сообщения, поэтому обновляем не чаще раза в секунду.
+            nonlocal last_edit
+            now = time.monotonic()
+            if now - last_edit < 1.0 and test["index"] < total:
+                return
+            last_edit = now
+            preview = test["question"] if len(test["question"]) <= 120 else test["question"][:117] + "..."
+            await ProgressManager.safe_edit_progress(
+                query.from_user.id, progress_msg.message_id, 10 + 30 * test["index"] // total,
+                f"✍️ Получено вопросов: {test['index']} из {total}\n{escape(preview)}", "🚀"
+            )
+
+        tests = await QuestionBank.take_async(subject, topic, grade, language, qtype, count)
+        if tests is not None:
+            raw_response = None
+            logger.info("Вопросы для %s взяты из банка", query.from_user.id)
+        else:
+            tests, raw_response = await GeminiAPI.call_gemini(
+                subject, topic, grade, language, count, qtype=qtype, on_question=on_question,
+                user_id=query.from_user.id,
+                on_queue=ProgressManager.queue_reporter(query.from_user.id, progress_msg.message_id, 10)
+            )
 
         if tests is None:
             await ProgressManager.safe_edit_progress(
@@ -193,7 +219,7 @@ async def confirm_gen(query: types.CallbackQuery, state: FSMContext):
             )
 
             await state.finish()
-            user_accepted = bool(DatabaseManager.get_user(query.from_user.id))
+            user_accepted = bool(await storage.get_user(query.from_user.id))
             await bot.send_message(
                 query.from_user.id,
                 "Попробуйте заново или измените параметры.",
@@ -238,7 +264,7 @@ async def confirm_gen(query: types.CallbackQuery, state: FSMContext):
             "qtype": qtype
         }
 
-        json_path = DatabaseManager.save_test(query.from_user.id, meta, tests)
+        test_id = await storage.save_test(query.from_user.id, meta, tests)
 
         await ProgressManager.safe_edit_progress(
             query.from_user.id, progress_msg.message_id, 60,
@@ -252,7 +278,7 @@ async def confirm_gen(query: types.CallbackQuery, state: FSMContext):
         )
 
         ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-        base_name = os.path.splitext(json_path)[0]
+        base_name = os.path.join(DATA_DIR, f"tests_{query.from_user.id}_{test_id}")
 
         student_docx = base_name + "_student.docx"
         teacher_docx = base_name + "_teacher.docx"
@@ -264,9 +290,11 @@ async def confirm_gen(query: types.CallbackQuery, state: FSMContext):
             meta, tests, header_buf, teacher_docx, True, qtype
         )
 
+        await ArtifactManager.register_async(student_path, teacher_path)
+
         if student_path and teacher_path:
             user_exports[query.from_user.id] = {
-                "json_path": json_path,
+                "test_id": test_id,
                 "student_docx": student_path,
                 "teacher_docx": teacher_path,
                 "created_at": datetime.utcnow().isoformat()
@@ -326,7 +354,7 @@ async def confirm_gen(query: types.CallbackQuery, state: FSMContext):
             "✅ Генерация завершена успешно!", "🎉"
         )
 
-        user_accepted = bool(DatabaseManager.get_user(query.from_user.id))
+        user_accepted = bool(await storage.get_user(query.from_user.id))
         await bot.send_message(
             query.from_user.id,
             "Если нужно создать ещё тесты, нажмите соответствующую кнопку в меню. Удачи на уроках! 📖",
@@ -370,6 +398,8 @@ async def cb_export_word(query: types.CallbackQuery):
             await query.answer("Файл не найден.", show_alert=True)
             return
 
+        await ArtifactManager.touch_async(file_path)
+
         with open(file_path, "rb") as f:
             caption = ("Документ Word для учителя (с ответами)" if mode == "teacher"
                        else "Документ Word для учеников (без ответов)")
@@ -9,12 +9,13 @@ from typing import List
 
 from core.bot import bot, dp
 from states.states import ModifyStates
-from database.database_manager import DatabaseManager
+from database.storage import storage
 from api.gemini_api import GeminiAPI
 from api.image_generator import ImageGenerator
 from api.document_generator import DocumentGenerator
 from managers.keyboard_manager import KeyboardManager
 from managers.progress_manager import ProgressManager
+from managers.artifact_manager import ArtifactManager
 from utils.utils import modify_sessions
 from config.config import DATA_DIR
 
@@ -53,7 +54,7 @@ async def modify_collect_q(message: types.Message, state: FSMContext):
     if text.lower() == "отмена":
         modify_sessions.pop(message.from_user.id, None)
         await state.finish()
-        user_accepted = bool(DatabaseManager.get_user(message.from_user.id))
+        user_accepted = bool(await storage.get_user(message.from_user.id))
         await message.answer("Модификация отменена.", reply_markup=KeyboardManager.get_main_kb(user_accepted))
         return
 
@@ -89,7 +90,7 @@ async def modify_collect_answers(message: types.Message, state: FSMContext):
     if text.lower() == "отмена":
         modify_sessions.pop(message.from_user.id, None)
         await state.finish()
-        user_accepted = bool(DatabaseManager.get_user(message.from_user.id))
+        user_accepted = bool(await storage.get_user(message.from_user.id))
         await message.answer("Модификация отменена.", reply_markup=KeyboardManager.get_main_kb(user_accepted))
         return
 
@@ -163,7 +164,8 @@ async def modify_choice_cb(query: types.CallbackQuery, state: FSMContext):
         tests, raw_response = await GeminiAPI.call_gemini(
             subject, topic, grade, language, num_questions,
             qtype="open", context_examples=context_examples,
-            modify_mode=choice
+            modify_mode=choice, user_id=query.from_user.id,
+            on_queue=ProgressManager.queue_reporter(query.from_user.id, progress_msg.message_id, 40)
         )
 
         if tests is None:
@@ -249,6 +251,8 @@ async def modify_choice_cb(query: types.CallbackQuery, state: FSMContext):
             "📤 Подготавливаю документы к отправке...", "📤"
         )
 
+        await ArtifactManager.register_async(student_path, teacher_path)
+
         if student_path and os.path.exists(student_path) and teacher_path and os.path.exists(teacher_path):
             try:
                 with open(student_path, "rb") as f:
@@ -9,15 +9,16 @@ from typing import List
 
 from core.bot import bot, dp
 from states.states import WikiStates
-from database.database_manager import DatabaseManager
+from database.storage import storage
 from managers.keyboard_manager import KeyboardManager
 from managers.progress_manager import ProgressManager
 from managers.wikipedia_manager import WikipediaManager
+from managers.artifact_manager import ArtifactManager
 from api.gemini_api import GeminiAPI
 from api.image_generator import ImageGenerator
 from api.document_generator import DocumentGenerator
 from utils.utils import wiki_sessions, safe_state_transaction
-from config.config import DATA_DIR
+from config.config import DATA_DIR, WIKI_IMAGES_COUNT
 
 logger = logging.getLogger("tg-edu-bot")
 
@@ -46,7 +47,7 @@ async def wiki_query_handler(message: types.Message, state: FSMContext):
 
     if text.lower() == "отмена":
         await state.finish()
-        user_accepted = bool(DatabaseManager.get_user(message.from_user.id))
+        user_accepted = bool(await storage.get_user(message.from_user.id))
         await message.answer("Поиск отменен.", reply_markup=KeyboardManager.get_main_kb(user_accepted))
         return
 
@@ -129,7 +130,9 @@ async def process_wiki_result(user_id: int, title: str, progress_msg_id: int, st
         )
 
         improved_content = await GeminiAPI.call_gemini_for_text_improvement(
-            page.get("content", ""), "ru"
+            page.get("content", ""), "ru", user_id=user_id,
+            on_queue=ProgressManager.queue_reporter(user_id, progress_msg_id, 50),
+            title=page["title"], revision=page.get("revision_id")
         )
 
         await ProgressManager.safe_edit_progress(
@@ -137,14 +140,11 @@ async def process_wiki_result(user_id: int, title: str, progress_msg_id: int, st
             "🖼 Скачиваю изображения...", "🖼"
         )
 
-        images_bytes = []
-        for img_url in (page.get("images") or [])[:3]:
-            try:
-                img_buffer = await WikipediaManager.download_image(img_url)
-                if img_buffer:
-                    images_bytes.append(img_buffer)
-            except Exception as e:
-                logger.warning("Не удалось скачать изображение %s: %s", img_url, e)
+        try:
+            images_bytes = await WikipediaManager.download_images(page.get("images") or [], WIKI_IMAGES_COUNT)
+        except Exception as e:
+            logger.warning("Не удалось скачать изображения: %s", e)
+            images_bytes = []
 
         await ProgressManager.safe_edit_progress(
             user_id, progress_msg_id, 80,
@@ -190,6 +190,7 @@ async def process_wiki_result(user_id: int, title: str, progress_msg_id: int, st
             created = False
 
         if created:
+            await ArtifactManager.register_async(out_path)
             try:
                 with open(out_path, "rb") as f:
                     await bot.send_document(
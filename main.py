@@ -3,6 +3,7 @@ import logging
 from dotenv import load_dotenv
 from aiogram import executor
 from db import init_db
+from database.database_manager import DatabaseManager
 
 load_dotenv()
 
@@ -21,7 +22,7 @@ from handlers.gen_handlers import register_gen_handlers
 from handlers.wiki_handlers import register_wiki_handlers
 from handlers.modify_handlers import register_modify_handlers
 from handlers.admin_handlers import register_admin_handlers
-from utils.utils import on_shutdown
+from utils.utils import on_startup, on_shutdown
 
 logging.basicConfig(
     level=logging.INFO,
@@ -50,10 +51,12 @@ if __name__ == "__main__":
     try:
         logger.info("Бот запущен и работает.")
         init_db()
+        DatabaseManager.import_users_json()
         register_all_handlers(dp)
         executor.start_polling(
             dp,
             skip_updates=True,
+            on_startup=on_startup,
             on_shutdown=on_shutdown,
         )
     except Exception as e:
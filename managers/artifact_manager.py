@@ -0,0 +1,135 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Callable, Dict, Iterable, Optional, Set
+
+import db
+from config.config import DATA_DIR, ARTIFACTS_MAX_BYTES, ARTIFACTS_TTL
+from database.storage import storage
+
+logger = logging.getLogger("tg-edu-bot")
+
+_ARTIFACT_SUFFIXES = (".docx",)
+
+
+class ArtifactManager:
+    """Учёт и сборка мусора для сгенерированных файлов в DATA_DIR.
+
+    Каждый созданный документ регистрируется в таблице artifacts, каждое
+    скачивание обновляет last_access. Сборщик удаляет файлы старше TTL, а при
+    превышении бюджета — самые давно скачанные, не трогая те, на которые
+    ещё ссылается user_exports.
+    """
+
+    @staticmethod
+    def register(path: str) -> None:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            logger.warning("Артефакт %s не найден при регистрации", path)
+            return
+        now = time.time()
+        conn = db.get_connection()
+        with conn:
+            conn.execute("""
+                INSERT INTO artifacts (path, size, created_at, last_access) VALUES (?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET size = excluded.size, last_access = excluded.last_access
+            """, (os.path.abspath(path), size, now, now))
+
+    @staticmethod
+    def touch(path: str) -> None:
+        conn = db.get_connection()
+        with conn:
+            conn.execute("UPDATE artifacts SET last_access = ? WHERE path = ?",
+                         (time.time(), os.path.abspath(path)))
+
+    @staticmethod
+    async def register_async(*paths: Optional[str]) -> None:
+        for path in paths:
+            if path:
+                await storage.run(ArtifactManager.register, path)
+
+    @staticmethod
+    async def touch_async(path: str) -> None:
+        await storage.run(ArtifactManager.touch, path)
+
+    @staticmethod
+    def adopt_existing(data_dir: str = DATA_DIR) -> int:
+        """Ставит на учёт файлы в DATA_DIR, которых ещё нет в таблице (например, созданные до сборщика)."""
+        rows = []
+        with os.scandir(data_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(_ARTIFACT_SUFFIXES):
+                    st = entry.stat()
+                    rows.append((os.path.abspath(entry.path), st.st_size, st.st_mtime, st.st_mtime))
+        conn = db.get_connection()
+        with conn:
+            cur = conn.executemany(
+                "INSERT OR IGNORE INTO artifacts (path, size, created_at, last_access) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            adopted = cur.rowcount
+        if adopted:
+            logger.info("Поставлено на учёт старых артефактов: %s", adopted)
+        return adopted
+
+    @staticmethod
+    def _remove(conn, path: str, size: int) -> int:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            size = 0
+        except OSError as e:
+            logger.warning("Не удалось удалить артефакт %s: %s", path, e)
+            return -1
+        conn.execute("DELETE FROM artifacts WHERE path = ?", (path,))
+        return size
+
+    @staticmethod
+    def collect(max_bytes: int = ARTIFACTS_MAX_BYTES, ttl_seconds: float = ARTIFACTS_TTL,
+                protected: Iterable[str] = ()) -> Dict[str, int]:
+        protected_paths: Set[str] = {os.path.abspath(p) for p in protected if p}
+        conn = db.get_connection()
+        reclaimed = removed = 0
+        with conn:
+            candidates = conn.execute(
+                "SELECT path, size, last_access FROM artifacts ORDER BY last_access"
+            ).fetchall()
+            total = sum(r["size"] for r in candidates)
+            expire_before = time.time() - ttl_seconds if ttl_seconds > 0 else None
+            for row in candidates:
+                expired = expire_before is not None and row["last_access"] < expire_before
+                if not expired and total <= max_bytes:
+                    break
+                if row["path"] in protected_paths:
+                    continue
+                freed = ArtifactManager._remove(conn, row["path"], row["size"])
+                if freed < 0:
+                    continue
+                total -= row["size"]
+                reclaimed += freed
+                removed += 1
+            if removed:
+                db.bump_counter(conn, "artifacts_reclaimed_bytes", reclaimed)
+                db.bump_counter(conn, "artifacts_removed", removed)
+        if removed:
+            logger.info("Сборщик артефактов: удалено %s файлов, освобождено %.2f MB",
+                        removed, reclaimed / 1024 / 1024)
+        return {"removed": removed, "reclaimed_bytes": reclaimed, "tracked_bytes": total}
+
+    @staticmethod
+    async def periodic_collect(interval_seconds: int, protected: Callable[[], Iterable[str]]) -> None:
+        try:
+            try:
+                await storage.run(ArtifactManager.adopt_existing)
+            except Exception:
+                logger.exception("Не удалось поставить на учёт существующие артефакты")
+            while True:
+                try:
+                    await storage.run(ArtifactManager.collect, protected=list(protected()))
+                except Exception:
+                    logger.exception("Ошибка в сборщике артефактов")
+                await asyncio.sleep(interval_seconds)
+        except asyncio.CancelledError:
+            logger.info("Periodic artifact collection cancelled")
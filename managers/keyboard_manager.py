@@ -52,9 +52,9 @@ class KeyboardManager:
                                  callback_data="count:10"),
             InlineKeyboardButton("15", 
                                  callback_data="count:15"),
-            InlineKeyboardButton("20 [СКОРО]", 
+            InlineKeyboardButton("20", 
                                  callback_data="count:20"),
-            InlineKeyboardButton("30 [СКОРО]", 
+            InlineKeyboardButton("30", 
                                  callback_data="count:30")
         )
         return kb
@@ -19,4 +19,14 @@ class ProgressManager:
             return True
         except Exception as e:
             logger.error(f"Ошибка обновления прогресса: {e}")
-            return False
\ No newline at end of file
+            return False
+
+    @staticmethod
+    def queue_reporter(chat_id: int, message_id: int, percent: int):
+        """Колбэк для on_queue: показывает место пользователя в очереди к ИИ."""
+        async def report(position: int) -> None:
+            await ProgressManager.safe_edit_progress(
+                chat_id, message_id, percent,
+                f"Ожидание ИИ: вы №{position} в очереди", "⏳"
+            )
+        return report
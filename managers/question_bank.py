@@ -0,0 +1,182 @@
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+import db
+from api.gemini_api import GeminiAPI
+from database.storage import storage
+from config.config import (
+    QUESTION_BANK_TARGET, QUESTION_BANK_BATCH, QUESTION_BANK_TOPICS,
+    QUESTION_BANK_DEMAND_DAYS, QUESTION_BANK_MIN_DEMAND
+)
+from utils.cache import normalize
+from utils.utils import GEMINI_LIMITER, GEMINI_BREAKER
+
+logger = logging.getLogger("tg-edu-bot")
+
+_BANK_USER = "question-bank"
+
+
+class QuestionBank:
+    """Банк заранее сгенерированных вопросов для популярных сочетаний предмета, темы и класса.
+
+    Фоновая задача смотрит, что чаще всего генерировали за последние дни, и в
+    моменты, когда к ИИ нет очереди, пополняет пулы до QUESTION_BANK_TARGET
+    вопросов. confirm_gen забирает N вопросов из пула сразу и идёт к ИИ только
+    если их не хватает. Выданные вопросы из банка удаляются, чтобы разные
+    пользователи не получали одинаковые тесты.
+    """
+
+    hits = 0
+    misses = 0
+    generated = 0
+
+    @staticmethod
+    def combo_key(subject: str, topic: str, grade: str, language: str, qtype: str) -> str:
+        return "|".join(normalize(x) for x in (subject, topic, grade, language, qtype or "closed"))
+
+    @staticmethod
+    def _qhash(item: Dict) -> str:
+        return hashlib.sha1(normalize(item.get("question")).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def demand(days: int = QUESTION_BANK_DEMAND_DAYS, limit: int = QUESTION_BANK_TOPICS,
+               min_count: int = QUESTION_BANK_MIN_DEMAND) -> List[Dict]:
+        since = (datetime.utcnow() - timedelta(days=days)).isoformat()
+        # Унарный плюс не даёт планировщику взять idx_tests_subject_topic: читается
+        # только окно по idx_tests_created_combo, а не весь архив.
+        rows = db.get_connection().execute("""
+            SELECT subject, topic, grade, language, qtype, COUNT(*) AS cnt
+            FROM tests
+            WHERE created_at >= ? AND qtype IS NOT NULL AND +subject IS NOT NULL AND +topic IS NOT NULL
+            GROUP BY subject, topic, grade, language, qtype
+        """, (since,)).fetchall()
+        # lower() в SQLite не понимает кириллицу, поэтому сочетания склеиваем здесь.
+        combos: Dict[str, Dict] = {}
+        for row in rows:
+            key = QuestionBank.combo_key(row["subject"], row["topic"], row["grade"], row["language"], row["qtype"])
+            entry = combos.get(key)
+            if entry is None or row["cnt"] > entry["top"]:
+                total = row["cnt"] + (entry["cnt"] if entry else 0)
+                combos[key] = dict(row, cnt=total, top=row["cnt"])
+            else:
+                entry["cnt"] += row["cnt"]
+        ranked = sorted((c for c in combos.values() if c["cnt"] >= min_count), key=lambda c: -c["cnt"])
+        return ranked[:limit]
+
+    @staticmethod
+    def available(combo: str) -> int:
+        return db.get_connection().execute(
+            "SELECT COUNT(*) FROM question_bank WHERE combo = ?", (combo,)
+        ).fetchone()[0]
+
+    @staticmethod
+    def add(combo: str, items: List[Dict]) -> int:
+        rows = [
+            (combo, QuestionBank._qhash(item),
+             json.dumps({k: v for k, v in item.items() if k != "index"}, ensure_ascii=False), time.time())
+            for item in items
+        ]
+        conn = db.get_connection()
+        with conn:
+            cur = conn.executemany(
+                "INSERT OR IGNORE INTO question_bank (combo, qhash, payload, created_at) VALUES (?, ?, ?, ?)",
+                rows
+            )
+        return cur.rowcount
+
+    @staticmethod
+    def take(subject: str, topic: str, grade: str, language: str, qtype: str, n: int) -> Optional[List[Dict]]:
+        """Забирает n разных вопросов из пула или возвращает None, если их меньше n."""
+        combo = QuestionBank.combo_key(subject, topic, grade, language, qtype)
+        conn = db.get_connection()
+        with conn:
+            rows = conn.execute(
+                "SELECT id, payload FROM question_bank WHERE combo = ? ORDER BY random() LIMIT ?",
+                (combo, n)
+            ).fetchall()
+            if len(rows) < n:
+                QuestionBank.misses += 1
+                return None
+            conn.executemany("DELETE FROM question_bank WHERE id = ?", [(r["id"],) for r in rows])
+        QuestionBank.hits += 1
+        tests = [json.loads(r["payload"]) for r in rows]
+        for i, item in enumerate(tests, start=1):
+            item["index"] = i
+        return tests
+
+    @staticmethod
+    async def take_async(subject: str, topic: str, grade: str, language: str, qtype: str,
+                         n: int) -> Optional[List[Dict]]:
+        try:
+            return await storage.run(QuestionBank.take, subject, topic, grade, language, qtype, n)
+        except Exception:
+            logger.exception("Ошибка чтения банка вопросов")
+            return None
+
+    @staticmethod
+    def _upstream_idle() -> bool:
+        limiter = GEMINI_LIMITER.stats()
+        return (limiter["queued"] == 0 and limiter["in_flight"] < max(1, limiter["limit"] - 1)
+                and GEMINI_BREAKER.state == GEMINI_BREAKER.CLOSED)
+
+    @staticmethod
+    async def refill(target: int = QUESTION_BANK_TARGET, batch: int = QUESTION_BANK_BATCH) -> int:
+        """Один проход пополнения; останавливается, как только к ИИ появляется очередь."""
+        added_total = 0
+        combos = await storage.run(QuestionBank.demand)
+        for row in combos:
+            combo = QuestionBank.combo_key(row["subject"], row["topic"], row["grade"], row["language"], row["qtype"])
+            have = await storage.run(QuestionBank.available, combo)
+            while have < target:
+                if not QuestionBank._upstream_idle():
+                    logger.info("Пополнение банка вопросов отложено: ИИ занят")
+                    return added_total
+                tests, error = await GeminiAPI.call_gemini(
+                    row["subject"], row["topic"], row["grade"], row["language"],
+                    min(batch, target - have), qtype=row["qtype"], use_cache=False, user_id=_BANK_USER,
+                    feature="bank", store=False
+                )
+                if tests is None:
+                    logger.warning("Не удалось пополнить банк для %s: %s", combo, error)
+                    break
+                added = await storage.run(QuestionBank.add, combo, tests)
+                QuestionBank.generated += added
+                added_total += added
+                if added == 0:
+                    # Модель повторяет уже известные вопросы — пул для этой темы исчерпан.
+                    break
+                have += added
+        if added_total:
+            logger.info("Банк вопросов пополнен на %s вопросов", added_total)
+        return added_total
+
+    @staticmethod
+    async def periodic_refill(interval_seconds: int) -> None:
+        try:
+            while True:
+                # Небольшой разброс, чтобы не совпадать с другими периодическими задачами.
+                await asyncio.sleep(interval_seconds * random.uniform(0.9, 1.1))
+                try:
+                    await QuestionBank.refill()
+                except Exception:
+                    logger.exception("Ошибка пополнения банка вопросов")
+        except asyncio.CancelledError:
+            logger.info("Periodic question bank refill cancelled")
+
+    @staticmethod
+    def stats() -> Dict[str, Any]:
+        size = db.get_connection().execute("SELECT COUNT(*) FROM question_bank").fetchone()[0]
+        total = QuestionBank.hits + QuestionBank.misses
+        return {
+            "size": size,
+            "hits": QuestionBank.hits,
+            "misses": QuestionBank.misses,
+            "generated": QuestionBank.generated,
+            "hit_ratio": QuestionBank.hits / total if total else 0.0
+        }
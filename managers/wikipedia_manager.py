@@ -1,64 +1,231 @@
-import aiohttp
-import wikipedia
+import re
+import asyncio
 from io import BytesIO
-from typing import List, Optional, Dict
+from typing import Any, List, Optional, Dict
+from urllib.parse import quote
+from PIL import Image
 from utils.utils import get_aiohttp_session
+from utils.cache import TTLCache, normalize
+from config.config import (
+    WIKI_API_URL, WIKI_TIMEOUT, WIKI_SEARCH_CACHE_SIZE, WIKI_SEARCH_CACHE_TTL,
+    WIKI_PAGE_CACHE_SIZE, WIKI_PAGE_CACHE_TTL, WIKI_IMAGE_WIDTH, WIKI_IMAGE_MAX_BYTES,
+    WIKI_IMAGE_TIMEOUT
+)
 import logging
 
 logger = logging.getLogger("tg-edu-bot")
 
+# Код языкового раздела подставляется в адрес API, поэтому пропускаем только буквы и дефис.
+_LANG_RE = re.compile(r"^[a-z][a-z\-]{1,15}$")
+_HEADERS = {"User-Agent": "tg-education-helper-bot/1.0 (Telegram bot; aiohttp)"}
+# Растровые форматы, которые python-docx вставляет как есть.
+_DOCX_MIME = ("image/jpeg", "image/png", "image/gif")
+# WebP python-docx не понимает: такие картинки перекодируются в PNG.
+_CONVERT_MIME = ("image/webp",)
+_RASTER_MIME = _DOCX_MIME + _CONVERT_MIME
+# Картинки меньше этого размера по любой стороне — значки, флажки и прочее оформление.
+_MIN_IMAGE_SIDE = 150
+
+# Результаты поиска по (язык, запрос) и страницы по (язык, заголовок): повторные
+# запросы и возврат к списку результатов обходятся без сети.
+_search_cache = TTLCache(maxsize=WIKI_SEARCH_CACHE_SIZE, ttl=WIKI_SEARCH_CACHE_TTL)
+_page_cache = TTLCache(maxsize=WIKI_PAGE_CACHE_SIZE, ttl=WIKI_PAGE_CACHE_TTL)
+# Статья без изображений из-за сбоя их запроса хранится недолго: следующий запрос попробует снова.
+_PARTIAL_PAGE_TTL = 60
+
+
+def _to_png(buffer: BytesIO) -> Optional[BytesIO]:
+    try:
+        with Image.open(buffer) as img:
+            out = BytesIO()
+            img.save(out, "PNG")
+    except (OSError, ValueError) as e:
+        logger.warning("Не удалось перекодировать изображение в PNG: %s", e)
+        return None
+    out.seek(0)
+    return out
+
+
 class WikipediaManager:
+    """Клиент MediaWiki API поверх общей aiohttp-сессии.
+
+    Язык передаётся в каждом запросе, а не через глобальное состояние, поэтому
+    пользователи разных языковых разделов не мешают друг другу.
+    """
+
+    @staticmethod
+    def _api_url(lang: str) -> str:
+        if not _LANG_RE.match(lang or ""):
+            raise ValueError(f"Недопустимый код языка: {lang!r}")
+        return WIKI_API_URL.format(lang=lang)
+
+    @staticmethod
+    async def _query(lang: str, params: Dict[str, Any]) -> Dict:
+        query = {"action": "query", "format": "json", "formatversion": "2", **params}
+        session = get_aiohttp_session()
+        async with session.get(WikipediaManager._api_url(lang), params=query,
+                               headers=_HEADERS, timeout=WIKI_TIMEOUT) as resp:
+            if resp.status != 200:
+                raise RuntimeError(f"HTTP ошибка {resp.status}")
+            data = await resp.json(content_type=None)
+        if "error" in data:
+            raise RuntimeError(data["error"].get("info") or data["error"].get("code"))
+        return data
+
     @staticmethod
     async def search(query: str, lang: str = "ru", results: int = 20) -> List[str]:
+        key = (lang, normalize(query), results)
+        cached = _search_cache.get(key)
+        if cached is not None:
+            return list(cached)
         try:
-            wikipedia.set_lang(lang)
-            return wikipedia.search(query, results=results)
+            data = await WikipediaManager._query(lang, {
+                "list": "search",
+                "srsearch": query,
+                "srlimit": results,
+                "srprop": "",
+                "srinfo": ""
+            })
+            titles = [item["title"] for item in data.get("query", {}).get("search", [])]
+            _search_cache.set(key, titles)
+            return list(titles)
         except Exception as e:
             logger.error(f"Ошибка поиска в Википедии: {e}")
             return []
 
+    @staticmethod
+    async def _page_images(title: str, lang: str) -> List[str]:
+        """Адреса подходящих иллюстраций статьи: только растровые и не мельче значков.
+
+        Отбор идёт по метаданным из imageinfo, без скачивания. Вместо оригиналов
+        берутся превью шириной WIKI_IMAGE_WIDTH — для документа этого хватает.
+        """
+        data = await WikipediaManager._query(lang, {
+            "titles": title,
+            "redirects": "1",
+            "generator": "images",
+            "gimlimit": "max",
+            "prop": "imageinfo",
+            "iiprop": "url|mime|size",
+            "iiurlwidth": WIKI_IMAGE_WIDTH
+        })
+        images = []
+        for page in data.get("query", {}).get("pages", []):
+            for info in page.get("imageinfo") or []:
+                if info.get("mime") not in _RASTER_MIME:
+                    continue
+                if min(info.get("width") or 0, info.get("height") or 0) < _MIN_IMAGE_SIDE:
+                    continue
+                url = info.get("thumburl") or info.get("url")
+                if url:
+                    images.append(url)
+        return images
+
     @staticmethod
     async def get_page(title: str, lang: str = "ru") -> Optional[Dict]:
+        """Текст, ревизия, адрес и изображения статьи за два параллельных запроса к API."""
+        key = (lang, normalize(title, casefold=False))
+        cached = _page_cache.get(key)
+        if cached is not None:
+            return dict(cached, images=list(cached["images"]))
         try:
-            wikipedia.set_lang(lang)
-            page = wikipedia.page(title, auto_suggest=False)
-            return {
-                "title": page.title,
-                "content": page.content,
-                "summary": page.summary,
-                "images": page.images,
-                "url": page.url
+            content_task = WikipediaManager._query(lang, {
+                "titles": title,
+                "redirects": "1",
+                "prop": "extracts|revisions|info|pageprops",
+                "explaintext": "1",
+                "exsectionformat": "wiki",
+                "rvprop": "ids",
+                "inprop": "url",
+                "ppprop": "disambiguation"
+            })
+            data, images = await asyncio.gather(
+                content_task, WikipediaManager._page_images(title, lang), return_exceptions=True
+            )
+            if isinstance(data, BaseException):
+                raise data
+            ttl = None
+            if isinstance(images, BaseException):
+                logger.warning("Не удалось получить изображения статьи '%s': %s", title, images)
+                images = []
+                ttl = min(_PARTIAL_PAGE_TTL, WIKI_PAGE_CACHE_TTL or _PARTIAL_PAGE_TTL)
+
+            pages = data.get("query", {}).get("pages") or []
+            page = pages[0] if pages else {}
+            if not page or page.get("missing") or page.get("invalid"):
+                logger.warning(f"Страница не найдена '{title}'")
+                return None
+            if "disambiguation" in (page.get("pageprops") or {}):
+                logger.warning(f"Неоднозначный запрос '{title}'")
+                return None
+
+            content = page.get("extract") or ""
+            revisions = page.get("revisions") or [{}]
+            page_title = page.get("title", title)
+            result = {
+                "title": page_title,
+                "content": content,
+                # Преамбула до первого заголовка раздела — то же, что отдаёт exintro, без лишнего запроса.
+                "summary": content.split("\n==", 1)[0].strip(),
+                "images": images,
+                "url": page.get("fullurl") or f"https://{lang}.wikipedia.org/wiki/{quote(page_title.replace(' ', '_'))}",
+                # Номер ревизии идёт в ключ кэша улучшенного текста.
+                "revision_id": revisions[0].get("revid")
             }
-        except wikipedia.DisambiguationError as e:
-            logger.warning(f"Неоднозначный запрос '{title}': {e}")
-            return None
-        except wikipedia.PageError as e:
-            logger.warning(f"Страница не найдена '{title}': {e}")
-            return None
+            _page_cache.set(key, result, ttl)
+            if page_title != key[1]:
+                # Перенаправление: та же статья доступна и под итоговым заголовком.
+                _page_cache.set((lang, page_title), result, ttl)
+            return dict(result, images=list(images))
         except Exception as e:
             logger.error(f"Ошибка получения страницы Википедии '{title}': {e}")
             return None
 
     @staticmethod
-    async def download_image(url: str) -> Optional[BytesIO]:
-        if not url.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')):
-            return None
+    def cache_stats() -> Dict[str, Dict[str, Any]]:
+        return {"search": _search_cache.stats(), "pages": _page_cache.stats()}
 
+    @staticmethod
+    async def download_image(url: str, max_bytes: int = WIKI_IMAGE_MAX_BYTES) -> Optional[BytesIO]:
+        """Скачивает изображение потоком; бросает загрузку на неверном Content-Type или сверх max_bytes."""
         session = get_aiohttp_session()
         try:
-            async with session.get(url, timeout=30) as resp:
+            async with session.get(url, headers=_HEADERS, timeout=WIKI_IMAGE_TIMEOUT) as resp:
                 if resp.status != 200:
                     return None
 
                 content_type = resp.headers.get('Content-Type', '')
-                if not any(img_type in content_type for img_type in ['image/jpeg', 'image/png', 'image/webp']):
+                mime = next((img_type for img_type in _RASTER_MIME if img_type in content_type), None)
+                if mime is None:
+                    return None
+                if int(resp.headers.get('Content-Length') or 0) > max_bytes:
+                    logger.warning("Изображение %s больше %s байт, пропускаю", url, max_bytes)
                     return None
 
-                image_data = await resp.read()
-                buffer = BytesIO(image_data)
+                buffer = BytesIO()
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    buffer.write(chunk)
+                    if buffer.tell() > max_bytes:
+                        logger.warning("Изображение %s больше %s байт, пропускаю", url, max_bytes)
+                        return None
                 buffer.seek(0)
+                if mime in _CONVERT_MIME:
+                    return await asyncio.to_thread(_to_png, buffer)
                 return buffer
 
         except Exception as e:
             logger.error(f"Ошибка скачивания изображения {url}: {e}")
-            return None
\ No newline at end of file
+            return None
+
+    @staticmethod
+    async def download_images(urls: List[str], count: int) -> List[BytesIO]:
+        """Первые count изображений из списка: качает параллельно, неудачные заменяет следующими."""
+        images: List[BytesIO] = []
+        pos = 0
+        while len(images) < count and pos < len(urls):
+            batch = urls[pos:pos + count - len(images)]
+            pos += len(batch)
+            for buffer in await asyncio.gather(*(WikipediaManager.download_image(url) for url in batch)):
+                if buffer:
+                    images.append(buffer)
+        return images
@@ -0,0 +1,34 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Модули проекта читают настройки при импорте, поэтому задаём их до первого импорта.
+os.environ.setdefault("TELEGRAM_API_TOKEN", "123456:test")
+os.environ.setdefault("API_BASE", "http://gemini.test/v1beta")
+os.environ.setdefault("GEMINI_MODEL", "test-model")
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+_TMP = tempfile.mkdtemp(prefix="tg_edu_tests_")
+os.environ["DB_PATH"] = os.path.join(_TMP, "bot.sqlite3")
+# config создаёт ./data относительно текущего каталога — пусть это будет временный.
+os.chdir(_TMP)
+
+import db  # noqa: E402
+
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    """Чистая база для теста: пул соединений переоткрывается на новом файле."""
+    from database.database_manager import _user_cache
+
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "bot.sqlite3"))
+    db.close_connections()
+    _user_cache.clear()
+    db.init_db()
+    yield db
+    db.close_connections()
+    _user_cache.clear()
@@ -0,0 +1,34 @@
+import asyncio
+
+from api.gemini_cache import GeminiCache
+from api.wiki_cache import WikiCache
+from utils.cache import normalize
+
+
+def test_normalize_collapses_spaces_and_case():
+    assert normalize("  Дроби \n и  проценты ") == "дроби и проценты"
+    assert normalize(" Дробь  (математика)", casefold=False) == "Дробь (математика)"
+    assert normalize(None) == ""
+
+
+def test_memory_miss_falls_back_to_disk_and_is_promoted(fresh_db):
+    gemini, wiki = GeminiCache(), WikiCache()
+    tests = [{"question": "Вопрос", "options": ["а", "б"], "answer": 1}]
+
+    async def scenario():
+        await gemini.set("g", tests, "raw")
+        await wiki.set("w", "Статья")
+        # Перезапуск процесса: память пуста, запись остаётся только в SQLite.
+        gemini._memory.clear()
+        wiki._memory.clear()
+        first = await gemini.get("g"), await wiki.get("w")
+        again = await gemini.get("g"), await wiki.get("w")
+        return first, again, await gemini.get("нет"), await wiki.get("нет")
+
+    first, again, gemini_miss, wiki_miss = asyncio.run(scenario())
+    assert first == again == ((tests, "raw"), "Статья")
+    assert gemini_miss is None and wiki_miss is None
+    for cache in (gemini, wiki):
+        stats = cache.stats()
+        assert (stats["memory_hits"], stats["disk_hits"], stats["misses"]) == (1, 1, 1)
+    assert gemini.stats()["bypassed"] == gemini.stats()["coalesced"] == 0
@@ -0,0 +1,25 @@
+import os
+import json
+
+import pytest
+
+from api.gemini_api import GeminiAPI
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "gemini_responses.jsonl")
+
+
+def _load_corpus():
+    with open(CORPUS, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+@pytest.mark.parametrize("case", _load_corpus(), ids=lambda case: case["name"])
+def test_extract_json_array_corpus(case):
+    """expected — сколько вопросов должно извлечься из записанного ответа, 0 — ничего."""
+    items = GeminiAPI.extract_json_array(case["text"])
+    if not case["expected"]:
+        assert items is None
+        return
+    assert items is not None
+    assert len(items) == case["expected"]
+    assert all("question" in item for item in items)
@@ -0,0 +1,95 @@
+import asyncio
+import json
+
+import pytest
+
+import api.gemini_api as gemini_api
+from api.gemini_api import GeminiAPI
+
+
+def _items(n):
+    return [
+        {"question": f"Вопрос {i}", "options": ["а", "б", "в", "г"], "answer": 1}
+        for i in range(1, n + 1)
+    ]
+
+
+@pytest.fixture
+def fake_api(fresh_db, monkeypatch):
+    """Подменяет HTTP-вызовы Gemini счётчиком; расход собирается в список вместо БД."""
+    state = {"calls": 0, "usage": [], "delay": 0.05}
+
+    async def call_api(session, url, headers, payload, timeout=120):
+        state["calls"] += 1
+        await asyncio.sleep(state["delay"])
+        text = json.dumps(_items(3), ensure_ascii=False)
+        usage = {"promptTokenCount": 10, "candidatesTokenCount": 30}
+        return {"candidates": [{"content": {"parts": [{"text": text}]}}], "usageMetadata": usage}, None, None
+
+    async def call_stream(session, url, headers, payload, on_item, timeout=120):
+        state["calls"] += 1
+        for item in _items(3):
+            await asyncio.sleep(state["delay"])
+            await on_item(item)
+        usage = {"promptTokenCount": 10, "candidatesTokenCount": 30}
+        return json.dumps(_items(3), ensure_ascii=False), usage, None, None
+
+    def record_usage(user_id, feature, spent, questions):
+        state["usage"].append((user_id, dict(spent), questions))
+
+    monkeypatch.setattr(GeminiAPI, "call_api", staticmethod(call_api))
+    monkeypatch.setattr(GeminiAPI, "_call_stream", staticmethod(call_stream))
+    monkeypatch.setattr(GeminiAPI, "_record_usage", staticmethod(record_usage))
+    monkeypatch.setattr(gemini_api, "get_aiohttp_session", lambda: None)
+    GeminiAPI._inflight.clear()
+    yield state
+    GeminiAPI._inflight.clear()
+
+
+def test_concurrent_identical_calls_hit_api_once(fake_api):
+    async def scenario():
+        return await asyncio.gather(*(
+            GeminiAPI.call_gemini("Математика", "Дроби-coalesce", "5", "Русский", 3, user_id=uid)
+            for uid in range(50)
+        ))
+
+    results = asyncio.run(scenario())
+    assert fake_api["calls"] == 1
+    assert all(tests and len(tests) == 3 for tests, _ in results)
+    # Расход одного запроса делится между всеми дождавшимися, без потерь и без двойного учёта.
+    assert sum(spent["output_tokens"] for _, spent, _ in fake_api["usage"]) == 30
+    assert sum(questions for _, _, questions in fake_api["usage"]) == 3
+    assert sorted(uid for uid, _, _ in fake_api["usage"]) == list(range(50))
+
+
+def test_every_waiter_gets_progress_and_cancelled_one_stops(fake_api):
+    got = {"first": [], "late": [], "cancelled": []}
+
+    def collector(name):
+        async def on_question(item, total):
+            got[name].append(item["index"])
+        return on_question
+
+    async def scenario():
+        call = lambda name, uid: GeminiAPI.call_gemini(
+            "История", "Шёлковый путь-coalesce", "7", "Русский", 3,
+            on_question=collector(name), user_id=uid
+        )
+        first = asyncio.ensure_future(call("first", 1))
+        cancelled = asyncio.ensure_future(call("cancelled", 2))
+        await asyncio.sleep(fake_api["delay"] * 1.5)
+        # Присоединившийся после первого вопроса сначала получает уже показанные.
+        late = asyncio.ensure_future(call("late", 3))
+        cancelled.cancel()
+        received_before_cancel = list(got["cancelled"])
+        results = await asyncio.gather(first, late)
+        return results, received_before_cancel
+
+    (first, late), before_cancel = asyncio.run(scenario())
+    assert fake_api["calls"] == 1
+    assert got["first"] == [1, 2, 3]
+    assert got["late"] == [1, 2, 3]
+    assert got["cancelled"] == before_cancel == [1]
+    assert first[0] == late[0]
+    # Отменённый вызов не платит за генерацию, которую не дождался.
+    assert {uid for uid, _, _ in fake_api["usage"]} == {1, 3}
@@ -0,0 +1,101 @@
+import re
+import json
+import asyncio
+import itertools
+
+import pytest
+
+import api.gemini_api as gemini_api
+from api.gemini_api import GeminiAPI
+
+_ASKED_RE = re.compile(r"ровно (\d+)")
+_PART_RE = re.compile(r"Это часть (\d+) из (\d+)")
+
+
+@pytest.fixture
+def stub_api(fresh_db, monkeypatch):
+    """Заглушка Gemini: ответ на каждый запрос задаёт сценарий теста по номеру части и попытке."""
+    state = {"asked": [], "script": None}
+    counter = itertools.count(1)
+
+    def respond(payload):
+        prompt = payload["contents"][0]["parts"][0]["text"]
+        asked = int(_ASKED_RE.search(prompt).group(1))
+        part = _PART_RE.search(prompt)
+        topup = "Эти вопросы уже есть" in prompt
+        state["asked"].append(asked)
+        count, error = state["script"](part and (int(part.group(1)), int(part.group(2))), asked, topup)
+        items = [{"question": f"Вопрос {next(counter)}", "options": ["а", "б", "в", "г"], "answer": 1}
+                 for _ in range(count)]
+        return items, error
+
+    async def call_api(session, url, headers, payload, timeout=120):
+        items, error = respond(payload)
+        if error:
+            return None, error, None
+        text = json.dumps(items, ensure_ascii=False)
+        return {"candidates": [{"content": {"parts": [{"text": text}]}}]}, None, None
+
+    async def call_stream(session, url, headers, payload, on_item, timeout=120):
+        items, error = respond(payload)
+        if error:
+            return None, None, error, None
+        for item in items:
+            await on_item(item)
+        return json.dumps(items, ensure_ascii=False), None, None, None
+
+    monkeypatch.setattr(GeminiAPI, "call_api", staticmethod(call_api))
+    monkeypatch.setattr(GeminiAPI, "_call_stream", staticmethod(call_stream))
+    monkeypatch.setattr(GeminiAPI, "_record_usage", staticmethod(lambda *args: None))
+    monkeypatch.setattr(gemini_api, "get_aiohttp_session", lambda: None)
+    monkeypatch.setattr(gemini_api.GEMINI_RETRY, "delay", lambda *args: 0)
+    monkeypatch.setattr(gemini_api.GEMINI_BREAKER, "allow", lambda: True)
+    return state
+
+
+def _generate(n, streaming):
+    streamed = []
+
+    async def on_question(item, total):
+        streamed.append(item["index"])
+
+    async def scenario():
+        return await GeminiAPI._generate_sharded(
+            "Математика", "Дроби", "5", "Русский", n, "closed", None, None,
+            on_question if streaming else None
+        )
+
+    tests, _ = asyncio.run(scenario())
+    return tests, streamed
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_shard_keeps_accepted_questions_when_its_topup_fails(stub_api, streaming):
+    def script(part, asked, topup):
+        if part == (1, 3):
+            # Первая часть отдала 7 из 8, а её дозапрос дважды получил 503.
+            return (7, None) if asked == 8 else (0, "HTTP ошибка 503: перегрузка")
+        return asked, None
+
+    stub_api["script"] = script
+    tests, streamed = _generate(24, streaming)
+    assert len(tests) == 24
+    # Общий дозапрос просит ровно недостающий вопрос, а не всю часть заново.
+    assert stub_api["asked"][-1] == 1
+    assert stub_api["asked"].count(8) == 3
+    if streaming:
+        assert streamed == list(range(1, 25))
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_topup_after_failed_shards_is_sharded_too(stub_api, streaming):
+    def script(part, asked, topup):
+        if part in ((1, 3), (2, 3)) and not topup:
+            return 0, "HTTP ошибка 503: перегрузка"
+        return asked, None
+
+    stub_api["script"] = script
+    tests, _ = _generate(24, streaming)
+    assert len(tests) == 24
+    assert max(stub_api["asked"]) <= gemini_api.GEMINI_SHARD_SIZE
+    assert sorted(stub_api["asked"][-2:]) == [8, 8]
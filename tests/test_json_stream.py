@@ -0,0 +1,58 @@
+import json
+import asyncio
+
+import pytest
+
+import api.gemini_api as gemini_api
+from api.gemini_api import GeminiAPI
+from api.json_stream import JSONArrayStream
+
+ITEMS = [{"question": f"Вопрос {i}", "options": ["а", "б", "в", "г"], "answer": 1} for i in range(1, 4)]
+ARRAY = json.dumps(ITEMS, ensure_ascii=False)
+
+
+def _feed(text, chunk):
+    parser = JSONArrayStream()
+    items = []
+    for pos in range(0, len(text), chunk):
+        items += parser.feed(text[pos:pos + chunk])
+    return items, parser.done
+
+
+@pytest.mark.parametrize("chunk", [1, 7, 10_000])
+@pytest.mark.parametrize("text", [
+    ARRAY,
+    "```json\n" + ARRAY + "\n```",
+    "[Черновик] " + ARRAY,
+    "Ответы [1, 2] и [ ] ниже:\n[\n  " + ARRAY[1:],
+])
+def test_stream_skips_brackets_that_are_not_an_array_of_objects(text, chunk):
+    assert _feed(text, chunk) == (ITEMS, True)
+
+
+def test_stream_keeps_objects_of_a_truncated_array():
+    items, done = _feed("[Черновик] " + ARRAY[:-30], 5)
+    assert items == ITEMS[:2] and not done
+
+
+def test_streaming_generate_falls_back_to_full_parse(fresh_db, monkeypatch):
+    calls = []
+
+    async def call_stream(session, url, headers, payload, on_item, timeout=120):
+        # on_item не вызывается: поток не разбил ответ на элементы, весь текст пришёл целиком.
+        calls.append(payload)
+        return json.dumps({"questions": ITEMS}, ensure_ascii=False), None, None, None
+
+    monkeypatch.setattr(GeminiAPI, "_call_stream", staticmethod(call_stream))
+    monkeypatch.setattr(GeminiAPI, "_record_usage", staticmethod(lambda *args: None))
+    monkeypatch.setattr(gemini_api, "get_aiohttp_session", lambda: None)
+    streamed = []
+
+    async def on_question(item, total):
+        streamed.append(item["question"])
+
+    tests, _ = asyncio.run(GeminiAPI._generate(
+        "Математика", "Дроби", "5", "Русский", 3, "closed", None, None, on_question
+    ))
+    assert len(calls) == 1
+    assert [t["question"] for t in tests] == streamed == [item["question"] for item in ITEMS]
@@ -0,0 +1,135 @@
+import asyncio
+
+from utils.limiter import AdaptiveLimiter
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_round_robin_does_not_starve_other_keys():
+    order = []
+
+    async def scenario():
+        limiter = AdaptiveLimiter(initial=1, max_limit=1)
+        await limiter.acquire("holder")
+
+        async def worker(key):
+            async with limiter.slot(key):
+                order.append(key)
+                await asyncio.sleep(0)
+
+        tasks = [asyncio.ensure_future(worker("heavy")) for _ in range(5)]
+        await _settle()
+        tasks.append(asyncio.ensure_future(worker("light")))
+        await _settle()
+        assert limiter.queued == 6
+        limiter.release()
+        await asyncio.gather(*tasks)
+        return limiter.stats()
+
+    stats = asyncio.run(scenario())
+    # Ключ с одним запросом проходит вторым, а не после всей пачки другого ключа.
+    assert order == ["heavy", "light", "heavy", "heavy", "heavy", "heavy"]
+    assert stats["in_flight"] == 0 and stats["granted"] == 7
+
+
+def test_positions_reflect_round_robin_order():
+    positions = {}
+
+    async def scenario():
+        limiter = AdaptiveLimiter(initial=1, max_limit=1)
+        await limiter.acquire("holder")
+
+        def report(name):
+            async def on_position(position):
+                positions[name] = position
+            return on_position
+
+        tasks = [asyncio.ensure_future(limiter.acquire("a", report(f"a{i}"))) for i in range(3)]
+        await _settle()
+        tasks.append(asyncio.ensure_future(limiter.acquire("b", report("b0"))))
+        await _settle()
+        snapshot = dict(positions)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return snapshot, limiter
+
+    snapshot, limiter = asyncio.run(scenario())
+    # Пришедший позже b0 встаёт вторым: перед ним только первый запрос ключа a.
+    assert snapshot == {"a0": 1, "a1": 3, "a2": 4, "b0": 2}
+    assert limiter.queued == 0 and limiter.in_flight == 1
+
+
+def test_cancel_after_grant_returns_the_slot():
+    async def scenario():
+        limiter = AdaptiveLimiter(initial=1, max_limit=1)
+        await limiter.acquire("holder")
+        granted_then_cancelled = asyncio.ensure_future(limiter.acquire("a"))
+        await _settle()
+        # Слот передаётся ожидающему, но тот отменяется раньше, чем успел им воспользоваться.
+        limiter.release()
+        granted_then_cancelled.cancel()
+        await asyncio.gather(granted_then_cancelled, return_exceptions=True)
+        assert limiter.in_flight == 0
+        await asyncio.wait_for(limiter.acquire("b"), 1)
+        return limiter.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["in_flight"] == 1 and stats["queued"] == 0
+
+
+def test_cancel_while_queued_leaves_the_queue():
+    async def scenario():
+        limiter = AdaptiveLimiter(initial=1, max_limit=1)
+        await limiter.acquire("holder")
+        queued = asyncio.ensure_future(limiter.acquire("a"))
+        await _settle()
+        queued.cancel()
+        await asyncio.gather(queued, return_exceptions=True)
+        assert limiter.queued == 0
+        limiter.release()
+        return limiter.in_flight
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_record_halves_on_throttle_with_cooldown_and_floor():
+    limiter = AdaptiveLimiter(initial=8, min_limit=2, max_limit=16, cooldown=60)
+    limiter.record(1.0, throttled=True)
+    assert limiter.limit == 4
+    # Второй сигнал в пределах cooldown — тот же всплеск перегрузки, лимит не трогаем.
+    limiter.record(1.0, throttled=True)
+    assert limiter.limit == 4 and limiter.throttled == 2
+
+    limiter.cooldown = 0
+    for _ in range(5):
+        limiter.record(1.0, throttled=True)
+    assert limiter.limit == 2
+
+
+def test_record_grows_additively_only_for_fast_answers():
+    limiter = AdaptiveLimiter(initial=2, max_limit=3, latency_target=10)
+    limiter.record(30.0)
+    assert limiter.limit == 2
+    limiter.record(1.0)
+    assert limiter.limit == 2.5
+    for _ in range(10):
+        limiter.record(1.0)
+    assert limiter.limit == 3
+
+
+def test_growth_dispatches_waiters_without_a_release():
+    async def scenario():
+        limiter = AdaptiveLimiter(initial=1, max_limit=4, latency_target=10)
+        await limiter.acquire("holder")
+        waiter = asyncio.ensure_future(limiter.acquire("a"))
+        await _settle()
+        assert not waiter.done()
+        limiter.record(1.0)
+        await asyncio.wait_for(waiter, 1)
+        return limiter.in_flight
+
+    assert asyncio.run(scenario()) == 2
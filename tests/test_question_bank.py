@@ -0,0 +1,70 @@
+import json
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import api.gemini_api as gemini_api
+from api.gemini_api import GeminiAPI, PROMPT_VERSION
+from api.gemini_cache import gemini_cache
+from managers.question_bank import QuestionBank
+
+META = {"subject": "Физика", "topic": "Оптика", "grade": "9", "language": "Русский", "qtype": "closed"}
+
+
+def _archive(db, meta, count, days_ago):
+    conn = db.get_connection()
+    created = (datetime.utcnow() - timedelta(days=days_ago)).isoformat()
+    with conn:
+        for _ in range(count):
+            db.insert_test(conn, 1, meta, [], created)
+
+
+def test_demand_reads_only_the_window(fresh_db):
+    _archive(fresh_db, META, 3, days_ago=1)
+    _archive(fresh_db, dict(META, topic="Механика"), 50, days_ago=400)
+
+    statements = []
+    conn = fresh_db.get_connection()
+    conn.set_trace_callback(statements.append)
+    try:
+        demand = QuestionBank.demand(days=14, min_count=1)
+    finally:
+        conn.set_trace_callback(None)
+
+    assert [(row["topic"], row["cnt"]) for row in demand] == [("Оптика", 3)]
+    (sql,) = [s for s in statements if "GROUP BY" in s]
+    plan = " ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql))
+    assert "idx_tests_created_combo (created_at>?)" in plan
+
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    calls = []
+
+    async def call_api(session, url, headers, payload, timeout=120):
+        calls.append(payload)
+        items = [{"question": f"Вопрос {len(calls)}.{i}", "options": ["а", "б", "в", "г"], "answer": 1}
+                 for i in range(3)]
+        text = json.dumps(items, ensure_ascii=False)
+        return {"candidates": [{"content": {"parts": [{"text": text}]}}]}, None, None
+
+    monkeypatch.setattr(GeminiAPI, "call_api", staticmethod(call_api))
+    monkeypatch.setattr(GeminiAPI, "_record_usage", staticmethod(lambda *args: None))
+    monkeypatch.setattr(gemini_api, "get_aiohttp_session", lambda: None)
+    return calls
+
+
+def test_refill_does_not_leave_bank_questions_in_the_cache(fresh_db, fake_api):
+    _archive(fresh_db, META, 3, days_ago=1)
+
+    async def scenario():
+        added = await QuestionBank.refill(target=3, batch=3)
+        key = gemini_cache.make_key(PROMPT_VERSION, META["subject"], META["topic"], META["grade"],
+                                    META["language"], 3, META["qtype"])
+        return added, await gemini_cache.get(key)
+
+    added, cached = asyncio.run(scenario())
+    assert added == 3 and len(fake_api) == 1
+    # Вопросы банка выдаются один раз; копия в кэше досталась бы следующему пользователю.
+    assert cached is None
@@ -0,0 +1,100 @@
+import pytest
+
+import utils.retry as retry
+from utils.retry import CircuitBreaker, RetryPolicy, parse_retry_after
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(retry, "time", fake)
+    return fake
+
+
+@pytest.fixture
+def max_jitter(monkeypatch):
+    """Джиттер всегда берёт верхнюю границу, чтобы паузы были предсказуемы."""
+    class Random:
+        @staticmethod
+        def uniform(a, b):
+            return b
+    monkeypatch.setattr(retry, "random", Random)
+
+
+def test_delay_grows_exponentially_up_to_cap(max_jitter):
+    policy = RetryPolicy(attempts=5, base=1.5, cap=20)
+    assert [policy.delay(n) for n in range(1, 6)] == [1.5, 3.0, 6.0, 12.0, 20]
+
+
+def test_delay_honours_retry_after(max_jitter):
+    policy = RetryPolicy(base=1.5, cap=20)
+    # Срок сервера короче своей паузы — ждём свою.
+    assert policy.delay(3, retry_after=2) == 6.0
+    # Срок длиннее — не повторяем раньше него, в том числе сверх потолка.
+    assert policy.delay(1, retry_after=9) == 9
+    assert policy.delay(1, retry_after=45) == 45
+
+
+def test_parse_retry_after_header_date_and_body(clock):
+    assert parse_retry_after("7") == 7.0
+    assert parse_retry_after("Thu, 01 Jan 1970 00:17:00 GMT") == 20.0
+    assert parse_retry_after(None, '{"error": {"details": [{"retryDelay": "12.5s"}]}}') == 12.5
+    assert parse_retry_after("soon") is None
+
+
+def test_breaker_opens_after_threshold_and_rejects(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.allow() and breaker.state == breaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN and breaker.trips == 1
+    assert not breaker.allow()
+    clock.now += 10
+    assert breaker.retry_in() == 20
+    assert not breaker.allow() and breaker.rejected == 2
+
+
+def test_half_open_lets_exactly_one_probe_through(clock):
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow() and breaker.state == breaker.HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED and breaker.allow() and breaker.allow()
+
+
+def test_failed_probe_reopens(clock):
+    breaker = CircuitBreaker("test", failure_threshold=5, reset_timeout=30)
+    for _ in range(5):
+        breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+    # Одного сбоя пробного запроса достаточно, порог здесь не нужен.
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN and breaker.retry_in() == 30 and breaker.trips == 2
+
+
+def test_abandoned_probe_is_replaced_after_reset_timeout(clock):
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+    # Пробный запрос отменён и ничего не сообщил: до reset_timeout новых проб нет...
+    clock.now += 29
+    assert not breaker.allow()
+    # ...а после него пускаем новую, чтобы предохранитель не завис полуоткрытым.
+    clock.now += 1
+    assert breaker.allow() and not breaker.allow()
@@ -0,0 +1,100 @@
+import gc
+import time
+import asyncio
+
+from database.database_manager import DatabaseManager
+from database.storage import AsyncStorage
+
+WRITERS = 200
+META = {"subject": "Математика", "topic": "Дроби", "grade": "5", "language": "Русский", "qtype": "closed"}
+TESTS = [{"index": i, "question": f"Вопрос {i}", "options": ["1", "2", "3", "4"], "answer": 1}
+         for i in range(1, 21)]
+
+
+async def _max_stall(workload) -> float:
+    """Наибольшая задержка тикера с периодом 1 мс, пока выполняется workload."""
+    stall = 0.0
+    done = asyncio.Event()
+
+    async def ticker():
+        nonlocal stall
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            stall = max(stall, time.perf_counter() - started - 0.001)
+
+    # Полная сборка мусора после импорта aiohttp занимает десятки мс и к хранилищу
+    # отношения не имеет — не даём ей попасть в замер.
+    gc.collect()
+    gc.disable()
+    try:
+        tick = asyncio.create_task(ticker())
+        await asyncio.sleep(0.01)
+        await workload()
+        done.set()
+        await tick
+    finally:
+        gc.enable()
+    return stall
+
+
+def test_storage_writes_do_not_stall_event_loop(fresh_db):
+    async def scenario():
+        storage = AsyncStorage()
+
+        async def through_storage():
+            await asyncio.gather(*(
+                op for uid in range(WRITERS) for op in (
+                    storage.add_or_update_user(uid, f"user{uid}", "+7000", True),
+                    storage.save_test(uid, META, TESTS),
+                )
+            ))
+
+        async def inline():
+            # Так handlers работали раньше: синхронные вызовы прямо из корутин.
+            for uid in range(WRITERS, 2 * WRITERS):
+                DatabaseManager.add_or_update_user(uid, f"user{uid}", "+7000", True)
+                DatabaseManager.save_test(uid, META, TESTS)
+
+        async_stall = await _max_stall(through_storage)
+        inline_stall = await _max_stall(inline)
+        await storage.close()
+        return async_stall, inline_stall
+
+    async_stall, inline_stall = asyncio.run(scenario())
+    assert async_stall < 0.05
+    assert async_stall < inline_stall
+    assert DatabaseManager.count_tests() == 2 * WRITERS
+
+
+def test_write_queue_batches_and_flushes_on_close(fresh_db):
+    async def scenario():
+        storage = AsyncStorage()
+        ids = await asyncio.gather(*(storage.save_test(uid, META, TESTS) for uid in range(100)))
+        # Последние записи не ждём: close() обязан дописать их сам.
+        pending = [asyncio.ensure_future(storage.add_or_update_user(uid, "late", "", False)) for uid in range(10)]
+        await asyncio.sleep(0)
+        await storage.close()
+        await asyncio.gather(*pending)
+        return ids, storage.writes
+
+    ids, queue = asyncio.run(scenario())
+    assert len(set(ids)) == 100
+    assert queue.ops == 110
+    assert queue.batches < queue.ops
+    assert all(DatabaseManager.get_user(uid)["username"] == "late" for uid in range(10))
+
+
+def test_usage_rows_are_written_through_the_queue(fresh_db):
+    async def scenario():
+        storage = AsyncStorage()
+        for _ in range(3):
+            storage.record_usage(7, "generate", 1, 10, 20, 5, 100)
+        # close() дописывает всё, что уже поставлено в очередь.
+        await storage.close()
+        return storage.writes.ops
+
+    assert asyncio.run(scenario()) == 3
+    (row,) = fresh_db.get_usage("1970-01-01")
+    assert row["name"] == "generate"
+    assert (row["requests"], row["prompt_tokens"], row["output_tokens"], row["questions"]) == (3, 30, 60, 15)
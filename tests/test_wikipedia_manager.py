@@ -0,0 +1,206 @@
+import asyncio
+from io import BytesIO
+
+import pytest
+from PIL import Image
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import managers.wikipedia_manager as wiki
+from config.config import WIKI_IMAGE_MAX_BYTES
+from managers.wikipedia_manager import WikipediaManager
+from utils.utils import get_aiohttp_session
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"0" * 1024
+
+
+def _encode(fmt):
+    buf = BytesIO()
+    Image.new("RGB", (4, 4), (200, 30, 30)).save(buf, fmt)
+    return buf.getvalue()
+
+
+WEBP = _encode("WEBP")
+GIF = _encode("GIF")
+# SVG и значки отсеиваются, вместо оригиналов берутся превью.
+IMAGES = ["/img/thumb/Fraction.png", "/img/thumb/Photo.jpg", "/img/thumb/Map.webp", "/img/thumb/Anim.gif"]
+ARTICLE = "Вводная часть о дробях.\n\n== История ==\nДроби знали в Египте.\n\n== Свойства ==\nСокращение дробей."
+
+
+def _image(name, mime, width, height):
+    return {
+        "title": f"Файл:{name}",
+        "imageinfo": [{
+            "url": f"/img/{name}", "thumburl": f"/img/thumb/{name}",
+            "mime": mime, "width": width, "height": height
+        }]
+    }
+
+
+class StandIn:
+    """Локальная замена MediaWiki API: отвечает в формате formatversion=2 и считает запросы."""
+
+    def __init__(self):
+        self.requests = []
+        self.fail_images = False
+
+    async def api(self, request):
+        params = request.query
+        self.requests.append((request.match_info["lang"], dict(params)))
+        assert params["format"] == "json" and params["formatversion"] == "2"
+        if params.get("list") == "search":
+            titles = ["Дробь", "Десятичная дробь", "Обыкновенная дробь"][:int(params["srlimit"])]
+            return web.json_response({"query": {"search": [{"title": t} for t in titles]}})
+        if params.get("generator") == "images":
+            if self.fail_images:
+                return web.json_response({}, status=503)
+            return web.json_response({"query": {"pages": [
+                _image("Fraction.png", "image/png", 800, 600),
+                _image("Diagram.svg", "image/svg+xml", 800, 600),
+                _image("Icon.png", "image/png", 20, 20),
+                _image("Photo.jpg", "image/jpeg", 1200, 900),
+                _image("Map.webp", "image/webp", 800, 600),
+                _image("Anim.gif", "image/gif", 640, 480),
+            ]}})
+        title = params["titles"]
+        if title == "Нет такой":
+            return web.json_response({"query": {"pages": [{"title": title, "missing": True}]}})
+        if title == "Дробь (значения)":
+            return web.json_response({"query": {"pages": [
+                {"title": title, "pageprops": {"disambiguation": ""}, "extract": "Дробь может означать"}
+            ]}})
+        return web.json_response({"query": {"pages": [{
+            "title": "Дробь (математика)" if title == "Дробь" else title,
+            "extract": ARTICLE,
+            "revisions": [{"revid": 4242}],
+            "fullurl": "https://ru.wikipedia.org/wiki/Дробь_(математика)"
+        }]}})
+
+    async def image(self, request):
+        name = request.match_info["name"]
+        if name.startswith("big"):
+            return web.Response(body=PNG + b"0" * WIKI_IMAGE_MAX_BYTES, content_type="image/png")
+        if name.startswith("page"):
+            return web.Response(text="<html></html>", content_type="text/html")
+        if name.startswith("missing"):
+            return web.Response(status=404)
+        if name.endswith(".webp"):
+            return web.Response(body=WEBP, content_type="image/webp")
+        if name.endswith(".gif"):
+            return web.Response(body=GIF, content_type="image/gif")
+        return web.Response(body=PNG, content_type="image/png")
+
+
+@pytest.fixture
+def stand_in(monkeypatch):
+    wiki._search_cache.clear()
+    wiki._page_cache.clear()
+    handler = StandIn()
+    app = web.Application()
+    app.router.add_get("/{lang}/w/api.php", handler.api)
+    app.router.add_get("/img/{name:.+}", handler.image)
+
+    def run(scenario):
+        async def main():
+            server = TestServer(app)
+            await server.start_server()
+            handler.base = f"http://{server.host}:{server.port}/"
+            monkeypatch.setattr(wiki, "WIKI_API_URL", handler.base + "{lang}/w/api.php")
+            try:
+                return await scenario()
+            finally:
+                await get_aiohttp_session().close()
+                await server.close()
+        return asyncio.run(main())
+
+    handler.run = run
+    yield handler
+    wiki._search_cache.clear()
+    wiki._page_cache.clear()
+
+
+def test_search_uses_lang_and_caches(stand_in):
+    async def scenario():
+        first = await WikipediaManager.search("дробь", lang="kk", results=2)
+        again = await WikipediaManager.search("  Дробь ", lang="kk", results=2)
+        return first, again
+
+    first, again = stand_in.run(scenario)
+    assert first == again == ["Дробь", "Десятичная дробь"]
+    assert len(stand_in.requests) == 1
+    lang, params = stand_in.requests[0]
+    assert lang == "kk" and params["srsearch"] == "дробь"
+
+
+def test_invalid_lang_never_reaches_the_server(stand_in):
+    async def scenario():
+        return await WikipediaManager.search("дробь", lang="ru.evil.com/x")
+
+    assert stand_in.run(scenario) == []
+    assert stand_in.requests == []
+
+
+def test_get_page_parses_article_and_filters_images(stand_in):
+    async def scenario():
+        page = await WikipediaManager.get_page("Дробь")
+        # Итоговый заголовок после перенаправления берётся из кэша.
+        redirected = await WikipediaManager.get_page("Дробь (математика)")
+        return page, redirected
+
+    page, redirected = stand_in.run(scenario)
+    assert page["title"] == "Дробь (математика)"
+    assert page["content"] == ARTICLE
+    assert page["summary"] == "Вводная часть о дробях."
+    assert page["revision_id"] == 4242
+    assert page["url"].startswith("https://ru.wikipedia.org/wiki/")
+    assert page["images"] == IMAGES
+    assert redirected == page
+    assert len(stand_in.requests) == 2
+
+
+def test_page_without_images_after_failure_is_cached_briefly(stand_in, monkeypatch):
+    stand_in.fail_images = True
+    monkeypatch.setattr(wiki, "_PARTIAL_PAGE_TTL", 0.05)
+
+    async def scenario():
+        degraded = await WikipediaManager.get_page("Дробь")
+        cached = await WikipediaManager.get_page("Дробь")
+        stand_in.fail_images = False
+        await asyncio.sleep(0.1)
+        return degraded, cached, await WikipediaManager.get_page("Дробь")
+
+    degraded, cached, recovered = stand_in.run(scenario)
+    assert degraded["images"] == cached["images"] == []
+    assert recovered["images"] == IMAGES
+    assert len(stand_in.requests) == 4
+
+
+def test_get_page_missing_and_disambiguation(stand_in):
+    async def scenario():
+        return (await WikipediaManager.get_page("Нет такой"),
+                await WikipediaManager.get_page("Дробь (значения)"))
+
+    assert stand_in.run(scenario) == (None, None)
+
+
+def test_download_images_skips_oversized_and_non_images(stand_in):
+    async def scenario():
+        urls = [stand_in.base + path for path in (
+            "img/big.png", "img/page.png", "img/missing.png", "img/a.png", "img/b.png", "img/c.png"
+        )]
+        return await WikipediaManager.download_images(urls, 2)
+
+    images = stand_in.run(scenario)
+    assert [buf.getvalue() for buf in images] == [PNG, PNG]
+
+
+def test_download_converts_webp_for_docx(stand_in):
+    async def scenario():
+        return await WikipediaManager.download_images(
+            [stand_in.base + "img/thumb/Map.webp", stand_in.base + "img/thumb/Anim.gif"], 2
+        )
+
+    webp, gif = stand_in.run(scenario)
+    # python-docx не вставляет WebP, поэтому он приходит уже в PNG; GIF вставляется как есть.
+    assert webp.getvalue().startswith(b"\x89PNG")
+    assert gif.getvalue() == GIF
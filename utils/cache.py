@@ -0,0 +1,130 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+logger = logging.getLogger("tg-edu-bot")
+
+MISSING = object()
+
+
+def normalize(value: Any, casefold: bool = True) -> str:
+    """Схлопывает пробелы и (если casefold) регистр, чтобы « Дроби» и «дроби» давали один ключ кэша."""
+    text = " ".join(str(value or "").split())
+    return text.casefold() if casefold else text
+
+
+class TTLCache:
+    """Потокобезопасный LRU-кэш с ограничением по размеру и времени жизни записей."""
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self.evictions += 1
+            self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits / total) if total else 0.0
+        }
+
+
+class TieredCache:
+    """LRU-кэш в памяти поверх таблицы SQLite.
+
+    Подклассы задают _disk_get и _disk_set; они выполняются через run_io
+    (AsyncStorage.run), поэтому запросы к диску не блокируют цикл событий.
+    Промах памяти идёт на диск, найденное там поднимается обратно в память.
+    """
+
+    def __init__(self, run_io: Callable, label: str, maxsize: int, ttl: Optional[float] = None):
+        self.run_io = run_io
+        self.label = label
+        self._memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._writes = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _disk_get(self, key: str) -> Any:
+        raise NotImplementedError
+
+    def _disk_set(self, key: str, value: Any) -> None:
+        raise NotImplementedError
+
+    async def get(self, key: str) -> Any:
+        value = self._memory.get(key)
+        if value is None:
+            try:
+                value = await self.run_io(self._disk_get, key)
+            except Exception:
+                logger.exception(f"Ошибка чтения кэша {self.label}")
+                value = None
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._memory.set(key, value)
+        return value
+
+    async def set(self, key: str, value: Any) -> None:
+        self._memory.set(key, value)
+        try:
+            await self.run_io(self._disk_set, key, value)
+        except Exception:
+            logger.exception(f"Ошибка записи кэша {self.label}")
+
+    def stats(self) -> Dict[str, Any]:
+        memory_hits = self._memory.hits
+        total = memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": (memory_hits + self.disk_hits) / total if total else 0.0,
+            "memory_size": len(self._memory)
+        }
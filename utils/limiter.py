@@ -0,0 +1,160 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional
+
+logger = logging.getLogger("tg-edu-bot")
+
+OnPosition = Callable[[int], Awaitable[None]]
+
+
+class _Waiter:
+    __slots__ = ("key", "future", "on_position", "position", "enqueued_at")
+
+    def __init__(self, key: Hashable, on_position: Optional[OnPosition]):
+        self.key = key
+        self.future = asyncio.get_running_loop().create_future()
+        self.on_position = on_position
+        self.position = 0
+        self.enqueued_at = time.monotonic()
+
+
+class AdaptiveLimiter:
+    """Ограничитель параллельных запросов к внешнему API с AIMD и честной очередью.
+
+    Лимит растёт на 1/limit после каждого успешного запроса, уложившегося в
+    latency_target, и уменьшается вдвое (не чаще раза в cooldown секунд),
+    когда API отвечает 429/503 или не отвечает вовсе. Ожидающие разбиты по
+    ключу (обычно user_id) и обслуживаются по кругу, поэтому один пользователь
+    с пачкой запросов не задерживает остальных дольше, чем на один свой запрос.
+    """
+
+    def __init__(self, initial: int = 3, min_limit: int = 1, max_limit: int = 16,
+                 latency_target: float = 30.0, cooldown: float = 5.0):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._queues: "OrderedDict[Hashable, Deque[_Waiter]]" = OrderedDict()
+        self._last_decrease = 0.0
+        self.granted = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def _grant(self, waiter: Optional[_Waiter] = None) -> None:
+        self.in_flight += 1
+        self.granted += 1
+        if waiter is not None:
+            waited = time.monotonic() - waiter.enqueued_at
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            waiter.future.set_result(None)
+
+    def _dispatch(self) -> None:
+        while self._queues and self._has_capacity():
+            key, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            # Ключ уходит в конец круга, даже если у него остались ожидающие.
+            del self._queues[key]
+            if queue:
+                self._queues[key] = queue
+            if waiter.future.done():
+                continue
+            self._grant(waiter)
+        self._notify_positions()
+
+    def _notify_positions(self) -> None:
+        # Позиция при круговом обслуживании: j-й в своей очереди пройдёт после
+        # j своих запросов, j+1 запросов каждого ключа раньше по кругу и j — позже.
+        keys = list(self._queues)
+        for r, (key, queue) in enumerate(self._queues.items()):
+            for j, waiter in enumerate(queue):
+                others = sum(min(len(self._queues[k]), j + (i < r)) for i, k in enumerate(keys) if i != r)
+                position = j + others + 1
+                if position != waiter.position:
+                    waiter.position = position
+                    if waiter.on_position is not None:
+                        asyncio.ensure_future(self._call_position(waiter.on_position, position))
+
+    @staticmethod
+    async def _call_position(callback: OnPosition, position: int) -> None:
+        try:
+            await callback(position)
+        except Exception:
+            logger.exception("Ошибка обработчика позиции в очереди")
+
+    async def acquire(self, key: Hashable = None, on_position: Optional[OnPosition] = None) -> None:
+        if not self._queues and self._has_capacity():
+            self._grant()
+            return
+        waiter = _Waiter(key, on_position)
+        self._queues.setdefault(key, deque()).append(waiter)
+        self._notify_positions()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Слот уже выдан — возвращаем его.
+                self.release()
+            else:
+                queue = self._queues.get(key)
+                if queue is not None and waiter in queue:
+                    queue.remove(waiter)
+                    if not queue:
+                        del self._queues[key]
+                self._notify_positions()
+            raise
+
+    def release(self) -> None:
+        self.in_flight = max(0, self.in_flight - 1)
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, key: Hashable = None, on_position: Optional[OnPosition] = None):
+        await self.acquire(key, on_position)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def record(self, latency: float, throttled: bool = False) -> None:
+        """Сообщает результат одного запроса к API, по нему подстраивается лимит."""
+        if throttled:
+            self.throttled += 1
+            now = time.monotonic()
+            if now - self._last_decrease >= self.cooldown:
+                self._last_decrease = now
+                old = self.limit
+                self.limit = max(float(self.min_limit), self.limit / 2)
+                if int(old) != int(self.limit):
+                    logger.warning("Лимит параллельных запросов к ИИ снижен: %s -> %s", int(old), int(self.limit))
+            return
+        if latency <= self.latency_target and self.limit < self.max_limit:
+            old = self.limit
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            if int(old) != int(self.limit):
+                logger.info("Лимит параллельных запросов к ИИ увеличен до %s", int(self.limit))
+                self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "granted": self.granted,
+            "throttled": self.throttled,
+            "avg_wait": self.total_wait / self.granted if self.granted else 0.0,
+            "max_wait": self.max_wait
+        }
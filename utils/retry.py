@@ -0,0 +1,116 @@
+import re
+import time
+import random
+import logging
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger("tg-edu-bot")
+
+_RETRY_DELAY_RE = re.compile(r'"retryDelay"\s*:\s*"(\d+(?:\.\d+)?)s"')
+
+
+def parse_retry_after(header: Optional[str], body: str = "") -> Optional[float]:
+    """Пауза из заголовка Retry-After (секунды или HTTP-дата) или из RetryInfo в теле ответа Google API."""
+    if header:
+        header = header.strip()
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(header).timestamp() - time.time())
+        except (TypeError, ValueError, IndexError):
+            pass
+    if body:
+        match = _RETRY_DELAY_RE.search(body)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+class RetryPolicy:
+    """Экспоненциальная пауза с полным джиттером: случайно от 0 до min(cap, base * 2^(n-1))."""
+
+    def __init__(self, attempts: int = 3, base: float = 1.0, cap: float = 20.0):
+        self.attempts = max(1, attempts)
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        backoff = random.uniform(0, min(self.cap, self.base * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            # Сервер сам назвал срок — ждём не меньше него, даже если он больше cap:
+            # потолок ограничивает только собственную паузу, а повтор раньше срока получит тот же 429.
+            return max(backoff, retry_after)
+        return backoff
+
+
+class CircuitBreaker:
+    """Предохранитель: после failure_threshold сбоев подряд перестаёт пускать запросы
+    на reset_timeout секунд, затем пропускает один пробный запрос."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self.rejected = 0
+        self._probe_started = None
+
+    def retry_in(self) -> float:
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN:
+            if self.retry_in() > 0:
+                self.rejected += 1
+                return False
+            self.state = self.HALF_OPEN
+            self._probe_started = None
+            logger.info("Предохранитель %s: пробный запрос", self.name)
+        if self.state == self.HALF_OPEN:
+            now = time.monotonic()
+            # Пробный запрос мог быть отменён, не сообщив результат, — тогда через
+            # reset_timeout разрешаем новый.
+            if self._probe_started is not None and now - self._probe_started < self.reset_timeout:
+                self.rejected += 1
+                return False
+            self._probe_started = now
+        return True
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info("Предохранитель %s закрыт, сервис снова отвечает", self.name)
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_started = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.trips += 1
+                logger.warning("Предохранитель %s разомкнут после %s сбоев подряд на %s с",
+                               self.name, self.failures, self.reset_timeout)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probe_started = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected,
+            "retry_in": self.retry_in()
+        }
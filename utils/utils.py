@@ -1,22 +1,42 @@
-import os
 import aiohttp
 import asyncio
 import logging
 import tempfile
 from datetime import datetime
 from contextlib import asynccontextmanager
-from typing import Dict, Optional
+from typing import Dict, List, Optional
+
+from db import close_connections
+from database.storage import storage
+from config.config import (
+    STATS_RECONCILE_INTERVAL, ARTIFACTS_GC_INTERVAL, GEMINI_CONCURRENCY_INITIAL,
+    GEMINI_CONCURRENCY_MIN, GEMINI_CONCURRENCY_MAX, GEMINI_LATENCY_TARGET, GEMINI_RETRY_ATTEMPTS,
+    GEMINI_BACKOFF_BASE, GEMINI_BACKOFF_CAP, GEMINI_BREAKER_THRESHOLD, GEMINI_BREAKER_RESET,
+    QUESTION_BANK_INTERVAL
+)
+from managers.artifact_manager import ArtifactManager
+from utils.limiter import AdaptiveLimiter
+from utils.retry import CircuitBreaker, RetryPolicy
 
 logger = logging.getLogger("tg-edu-bot")
 
 HTTP_CONNECTOR_LIMIT = 40
 _global_aiohttp_session: Optional[aiohttp.ClientSession] = None
-GEMINI_SEMAPHORE = asyncio.Semaphore(3)
+GEMINI_LIMITER = AdaptiveLimiter(
+    initial=GEMINI_CONCURRENCY_INITIAL,
+    min_limit=GEMINI_CONCURRENCY_MIN,
+    max_limit=GEMINI_CONCURRENCY_MAX,
+    latency_target=GEMINI_LATENCY_TARGET
+)
+GEMINI_RETRY = RetryPolicy(attempts=GEMINI_RETRY_ATTEMPTS, base=GEMINI_BACKOFF_BASE, cap=GEMINI_BACKOFF_CAP)
+GEMINI_BREAKER = CircuitBreaker("gemini", failure_threshold=GEMINI_BREAKER_THRESHOLD,
+                                reset_timeout=GEMINI_BREAKER_RESET)
 
 pending_contacts: Dict[int, Dict] = {}
 user_exports: Dict[int, Dict] = {}
 wiki_sessions: Dict[int, Dict] = {}
 modify_sessions: Dict[int, Dict] = {}
+_background_tasks: List[asyncio.Task] = []
 
 
 def get_aiohttp_session() -> aiohttp.ClientSession:
@@ -76,8 +96,39 @@ class SessionManager:
             logger.exception("Ошибка в периодической очистке сессий")
 
 
+def exported_paths() -> List[str]:
+    """Файлы, на которые ещё ссылается user_exports — их сборщик не трогает."""
+    paths = []
+    for info in list(user_exports.values()):
+        paths.extend(p for p in (info.get("student_docx"), info.get("teacher_docx")) if p)
+    return paths
+
+
+async def on_startup(dp):
+    if STATS_RECONCILE_INTERVAL > 0:
+        _background_tasks.append(asyncio.create_task(
+            storage.periodic_reconcile_stats(STATS_RECONCILE_INTERVAL)
+        ))
+    if ARTIFACTS_GC_INTERVAL > 0:
+        _background_tasks.append(asyncio.create_task(
+            ArtifactManager.periodic_collect(ARTIFACTS_GC_INTERVAL, exported_paths)
+        ))
+    if QUESTION_BANK_INTERVAL > 0:
+        # Банк вопросов зависит от GeminiAPI, который сам импортирует этот модуль.
+        from managers.question_bank import QuestionBank
+        _background_tasks.append(asyncio.create_task(
+            QuestionBank.periodic_refill(QUESTION_BANK_INTERVAL)
+        ))
+    logger.info("Фоновые задачи запущены: %s", len(_background_tasks))
+
+
 async def on_shutdown(dp):
     logger.info("Завершение работы бота...")
+    for task in _background_tasks:
+        task.cancel()
+    if _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
     global _global_aiohttp_session
     try:
         if _global_aiohttp_session and not _global_aiohttp_session.closed:
@@ -85,19 +136,13 @@ async def on_shutdown(dp):
             logger.info("aiohttp session закрыт")
     except Exception:
         logger.exception("Ошибка при закрытии aiohttp session")
+    try:
+        await storage.close()
+    except Exception:
+        logger.exception("Ошибка при остановке потока хранилища")
+    try:
+        close_connections()
+        logger.info("Соединения SQLite закрыты")
+    except Exception:
+        logger.exception("Ошибка при закрытии соединений SQLite")
     logger.info("Бот успешно остановлен")
-
-
-def get_directory_size(path: str) -> int:
-    total_size = 0
-    if not os.path.exists(path):
-        return 0
-    for dirpath, dirnames, filenames in os.walk(path):
-        for filename in filenames:
-            filepath = os.path.join(dirpath, filename)
-            try:
-                if os.path.isfile(filepath):
-                    total_size += os.path.getsize(filepath)
-            except Exception:
-                logger.debug("Не удалось получить размер файла: %s", filepath, exc_info=True)
-    return total_size
\ No newline at end of file